@@ -148,7 +148,7 @@ def auto_locations(paragraph_list, default_city=''):
     """
     result, report = [], []
     addresses_seen = set()
-    geocoder = SmartGeocoder()
+    geocoder = SmartGeocoder(use_block_index=True)
     for para in paragraph_list:
         for addy, city in parse_addresses(para):
             # Skip addresses if they have a city that's a known suburb.
@@ -0,0 +1,137 @@
+#   Copyright 2012 OpenPlans, and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import django.test
+import mock
+import threading
+import time
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>%(name)s</title>
+<item><title>First %(name)s story</title><link>http://example.com/%(name)s/1</link>
+<description>The first story.</description></item>
+<item><title>Second %(name)s story</title><link>http://example.com/%(name)s/2</link>
+<description>The second story.</description></item>
+</channel></rss>
+"""
+
+
+class _StubRetriever(object):
+    """
+    Stands in for UnicodeRetriever.  Serves a two-item feed for each
+    seed, slowly, except that the "broken" seed's feed can't be
+    fetched.  Keeps count of how many feeds are fetched at once.
+    """
+    lock = threading.Lock()
+    in_flight = max_in_flight = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def fetch_encoding_data_and_headers(self, url):
+        from ebdata.retrieval import RetrievalError
+        cls = _StubRetriever
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(0.2)
+        with cls.lock:
+            cls.in_flight -= 1
+        name = url.split('/')[-2]
+        if name == 'broken':
+            raise RetrievalError("Could not GET %r" % url)
+        return ('utf-8', FEED % {'name': name},
+                {'status': '200', 'content-type': 'application/rss+xml'})
+
+
+# Other threads can't see uncommitted data, so this can't be a TestCase.
+class TestUpdateFeeds(django.test.TransactionTestCase):
+
+    fixtures = ['crimes.json']
+
+    def setUp(self):
+        _StubRetriever.in_flight = _StubRetriever.max_in_flight = 0
+        self.patchers = [
+            mock.patch('ebdata.blobs.update_feeds.UnicodeRetriever', _StubRetriever),
+            mock.patch('ebdata.blobs.update_feeds.save_locations_for_page'),
+            ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def _make_seeds(self, *names):
+        from ebdata.blobs.models import Seed
+        seeds = []
+        for name in names:
+            seeds.append(Seed.objects.create(
+                    url='http://example.com/%s/feed.xml' % name,
+                    base_url='http://example.com/', delay=0, depth=1,
+                    is_crawled=False, is_rss_feed=True, is_active=True,
+                    rss_full_entry=True, normalize_www=3, pretty_name=name,
+                    schema_id=1, autodetect_locations=False,
+                    guess_article_text=False, strip_noise=False))
+        return seeds
+
+    def test_update(self):
+        from ebdata.blobs.models import Page
+        from ebdata.blobs.update_feeds import update
+        seeds = self._make_seeds('a', 'b')
+        results = update()
+        self.assertEqual([result.seed.id for result in results], [seed.id for seed in seeds])
+        self.assertEqual([result.num_created for result in results], [2, 2])
+        self.assertEqual(_StubRetriever.max_in_flight, 1)
+        page = Page.objects.get(url='http://example.com/a/1')
+        self.assertEqual((page.article_headline, page.html),
+                         (u'First a story', u'The first story.'))
+        # Nothing new the second time.
+        self.assertEqual([result.num_created for result in update()], [0, 0])
+        self.assertEqual(Page.objects.count(), 4)
+
+    def test_update__concurrent(self):
+        from ebdata.blobs.models import Page
+        from ebdata.blobs.update_feeds import update
+        seeds = self._make_seeds('a', 'b', 'c')
+        results = update(concurrency=3)
+        self.assertEqual([result.seed.id for result in results], [seed.id for seed in seeds])
+        self.assertEqual([result.num_created for result in results], [2, 2, 2])
+        self.assert_(1 < _StubRetriever.max_in_flight <= 3)
+        self.assertEqual(Page.objects.count(), 6)
+
+    def test_update__errors(self):
+        # One seed failing doesn't stop the others.
+        from ebdata.blobs.models import Page
+        from ebdata.blobs.update_feeds import update
+        self._make_seeds('a', 'broken', 'c')
+        results = update(concurrency=2)
+        self.assertEqual([result.num_created for result in results], [2, 0, 2])
+        self.assertEqual([result.error is None for result in results], [True, False, True])
+        self.assertEqual(Page.objects.count(), 4)
+
+    def test_seed_result(self):
+        from ebdata.blobs.update_feeds import update
+        self._make_seeds('a', 'broken')
+        ok, broken = update()
+        self.assert_(unicode(ok).startswith(
+                u'a (seed %d): 0 pages fetched, 2 new Pages, ' % ok.seed.id))
+        self.assert_(unicode(ok).endswith(u' seconds'))
+        self.assert_(unicode(broken).endswith(
+                u", failed: RetrievalError: Could not GET 'http://example.com/broken/feed.xml'"),
+                     unicode(broken))
@@ -42,6 +42,7 @@ RSS-feed retriever
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from django.db import transaction
 from ebdata.blobs.geotagging import save_locations_for_page
 from ebdata.blobs.models import Seed, Page
 from ebdata.retrieval import UnicodeRetriever
@@ -53,7 +54,10 @@ import feedparser
 import cgi
 import datetime
 import logging
+import optparse
+import Queue
 import re
+import threading
 import time
 import urllib
 import urlparse
@@ -136,18 +140,40 @@ def normalize_url(base_href, url, normalize_www_flag):
 
 
 class FeedUpdater(object):
-    def __init__(self, seed, retriever, logger):
+    """
+    Creates a Page for each new article in a Seed's RSS feed.
+
+    If ``timeout`` (in seconds) is given, stops going through the
+    feed's articles once it's been that long.
+    """
+    def __init__(self, seed, retriever, logger, timeout=None):
         self.seed = seed
         self.retriever = retriever
         self.logger = logger
+        self.timeout = timeout
+        self.timed_out = False
+        # Counts, for reporting.
+        self.num_fetched = 0
+        self.num_created = 0
 
     def update(self):
+        start = time.time()
+        # Fetch it with the retriever, which has a timeout, rather than
+        # letting feedparser do it.  feedparser works out the encoding
+        # from the raw bytes and headers.
+        encoding, content, headers = self.retriever.fetch_encoding_data_and_headers(self.seed.url)
         try:
-            feed = feedparser.parse(self.seed.url)
+            feed = feedparser.parse(content, response_headers=headers)
         except UnicodeDecodeError:
             self.logger.info('UnicodeDecodeError on %r', self.seed.url)
             return
         for entry in feed['entries']:
+            if self.timeout is not None and time.time() - start > self.timeout:
+                self.logger.warning('Timed out after %s seconds updating %s',
+                                    self.timeout, self.seed.url)
+                self.timed_out = True
+                break
+
             if 'feedburner_origlink' in entry:
                 url = entry['feedburner_origlink']
             elif 'pheedo_origLink' in entry:
@@ -269,6 +295,7 @@ class FeedUpdater(object):
                 times_skipped=0,
                 robot_report='',
             )
+            self.num_created += 1
             self.logger.info('Created %s story %r', self.seed.base_url, article_headline)
             save_locations_for_page(p)
 
@@ -286,6 +313,7 @@ class FeedUpdater(object):
         return True
 
     def get_article_page(self, url):
+        self.num_fetched += 1
         return self.retriever.fetch_data(url)
 
     def get_printer_friendly_url(self, url):
@@ -325,19 +353,104 @@ class FeedUpdater(object):
         """
         return None
 
-def update(seed_id=None):
+class SeedResult(object):
+    """
+    What happened when updating one Seed.
+    """
+    def __init__(self, seed, updater, elapsed, error=None):
+        self.seed = seed
+        self.num_fetched = updater.num_fetched
+        self.num_created = updater.num_created
+        self.timed_out = updater.timed_out
+        self.elapsed = elapsed
+        self.error = error
+
+    def __unicode__(self):
+        summary = u'%s (seed %s): %d pages fetched, %d new Pages, %.1f seconds' % (
+            self.seed.pretty_name, self.seed.id, self.num_fetched,
+            self.num_created, self.elapsed)
+        if self.timed_out:
+            summary += u', timed out'
+        if self.error is not None:
+            summary += u', failed: %s' % self.error
+        return summary
+
+def update_seed(seed, retriever, logger, timeout=None):
+    """
+    Updates one Seed, and returns a SeedResult.  Errors are logged
+    and returned in the result rather than raised, so they don't stop
+    other seeds from updating.
+    """
+    updater = FeedUpdater(seed, retriever, logger, timeout=timeout)
+    start = time.time()
+    error = None
+    try:
+        updater.update()
+    except Exception, e:
+        logger.exception('Error updating %s', seed.url)
+        error = '%s: %s' % (e.__class__.__name__, e)
+        # Don't leave the connection in a failed transaction for the
+        # next seed.
+        transaction.rollback_unless_managed()
+    return SeedResult(seed, updater, time.time() - start, error)
+
+def update(seed_id=None, concurrency=1, timeout=None):
     """
     Retrieves and saves every new item for every Seed that is an RSS feed.
+
+    Updates ``concurrency`` seeds at once, each with its own
+    Retriever, spacing out its article downloads by the seed's
+    ``delay``.  ``timeout`` limits the seconds spent on each seed.
+
+    Returns a list of SeedResults, in Seed order.
     """
-    retriever = UnicodeRetriever(cache=None)
     logger = logging.getLogger('eb.retrieval.blob_rss')
     qs = Seed.objects.filter(is_rss_feed=True, is_active=True)
     if seed_id is not None:
         qs = qs.filter(id=seed_id)
-    for seed in qs:
-        updater = FeedUpdater(seed, retriever, logger)
-        updater.update()
+    seeds = list(qs)
+    if concurrency <= 1 or len(seeds) <= 1:
+        retriever = UnicodeRetriever(cache=None)
+        return [update_seed(seed, retriever, logger, timeout) for seed in seeds]
+
+    results = [None] * len(seeds)
+    todo = Queue.Queue()
+    for i, seed in enumerate(seeds):
+        todo.put((i, seed))
+
+    def work():
+        from django.db import connection
+        try:
+            while True:
+                try:
+                    i, seed = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = update_seed(seed, UnicodeRetriever(cache=None),
+                                         logger, timeout)
+        finally:
+            # Each thread gets its own database connection.
+            connection.close()
+
+    threads = [threading.Thread(target=work) for i in range(min(concurrency, len(seeds)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--seed', type='int', dest='seed_id', default=None,
+                      help='Only update the Seed with this id.')
+    parser.add_option('-j', '--concurrency', type='int', default=1,
+                      help='Number of seeds to update at once. Default 1.')
+    parser.add_option('-t', '--timeout', type='float', default=None,
+                      help='Stop updating a seed after this many seconds.')
+    options, args = parser.parse_args(argv)
+    for result in update(options.seed_id, options.concurrency, options.timeout):
+        print unicode(result).encode('utf8')
 
 if __name__ == "__main__":
     from ebdata.retrieval import log_debug
-    update()
+    main()
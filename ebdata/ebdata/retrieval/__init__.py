@@ -16,4 +16,4 @@
 #   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from retrievers import RetrievalError, PageNotFoundError, Retriever, UnicodeRetriever
+from retrievers import RetrievalError, PageNotFoundError, Retriever, UnicodeRetriever, PooledRetriever
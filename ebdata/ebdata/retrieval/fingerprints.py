@@ -0,0 +1,123 @@
+#   Copyright 2011 OpenPlans, and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Content fingerprints, so scrapers can skip what hasn't changed.
+
+A fingerprint is a hash of a raw list page or of a cleaned record.
+Stores remember the last fingerprint seen for each (kind, scope, key):
+kind is 'page' or 'record', scope is the scraper name (for pages) or
+the schema slug (for records), and key is the page URL or a unique
+key for the record.
+"""
+
+from ebpub.db.models import ScraperFingerprint
+import datetime
+import hashlib
+
+
+def fingerprint(value):
+    """
+    Returns a hex SHA-1 digest of ``value``, which may be a string or
+    a record: a dictionary (or list) of strings, numbers, dates,
+    geometries and the like.  Equal records have equal fingerprints
+    regardless of key order.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    elif not isinstance(value, str):
+        value = _canonical(value)
+    return hashlib.sha1(value).hexdigest()
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(['%s: %s' % (_canonical(k), _canonical(v))
+                                   for k, v in sorted(value.items())])
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join([_canonical(v) for v in value])
+    if hasattr(value, 'ewkt'):
+        # Geometries' repr() includes their memory address.
+        return value.ewkt
+    return repr(value)
+
+
+class FingerprintStore(object):
+    """
+    Remembers fingerprints in memory, for the life of the store.
+    Subclasses can persist them by overriding _load() and _save().
+    """
+
+    def __init__(self):
+        self._digests = {}
+
+    def get(self, kind, scope, key):
+        """
+        Returns the last fingerprint remembered for the key, or None.
+        """
+        return self._scope(kind, scope).get(key)
+
+    def unchanged(self, kind, scope, key, digest):
+        """
+        Returns True if ``digest`` is the fingerprint remembered for
+        the key.
+        """
+        return self.get(kind, scope, key) == digest
+
+    def remember(self, kind, scope, key, digest):
+        digests = self._scope(kind, scope)
+        old_digest = digests.get(key)
+        if old_digest == digest:
+            return
+        self._save(kind, scope, key, digest, old_digest is not None)
+        digests[key] = digest
+
+    def _scope(self, kind, scope):
+        try:
+            return self._digests[(kind, scope)]
+        except KeyError:
+            digests = self._digests[(kind, scope)] = self._load(kind, scope)
+            return digests
+
+    def _load(self, kind, scope):
+        """
+        Returns a {key: digest} dictionary of the fingerprints
+        already stored for the scope.
+        """
+        return {}
+
+    def _save(self, kind, scope, key, digest, exists):
+        pass
+
+
+class DatabaseFingerprintStore(FingerprintStore):
+    """
+    Stores fingerprints in the ScraperFingerprint table.  Each scope
+    is loaded with one query the first time it's used.
+    """
+
+    def _load(self, kind, scope):
+        return dict(ScraperFingerprint.objects.filter(kind=kind, scope=scope
+                                                      ).values_list('key', 'digest'))
+
+    def _save(self, kind, scope, key, digest, exists):
+        now = datetime.datetime.now()
+        if exists and ScraperFingerprint.objects.filter(
+                kind=kind, scope=scope, key=key).update(digest=digest, last_changed=now):
+            return
+        ScraperFingerprint.objects.create(kind=kind, scope=scope, key=key,
+                                          digest=digest, last_changed=now)
@@ -44,17 +44,29 @@ class BaseScraper(object):
     sleep = 0
     timeout = 20
 
+    # If set to a number greater than 1, create_newsitem() doesn't save
+    # each NewsItem immediately, but buffers them and saves them
+    # batch_size at a time with NewsItem.objects.bulk_create_with_attributes().
+    # Subclasses that set this must call flush_newsitems() when done,
+    # and can't rely on NewsItems having an id (or being found by
+    # queries) until then.
+    batch_size = None
+
+    # Set this to ebdata.retrieval.PooledRetriever for connection
+    # reuse, conditional requests, and backoff on errors.
+    retriever_class = Retriever
+
     def __init__(self, use_cache=True):
         if not use_cache:
-            self.retriever = Retriever(cache=None, sleep=self.sleep, timeout=self.timeout)
+            self.retriever = self.retriever_class(cache=None, sleep=self.sleep, timeout=self.timeout)
         else:
-            self.retriever = Retriever(sleep=self.sleep, timeout=self.timeout)
+            self.retriever = self.retriever_class(sleep=self.sleep, timeout=self.timeout)
         self.logger = logging.getLogger('eb.retrieval.%s' % self.logname)
         self.start_time = datetime.datetime.now()
         self.num_added = 0
         self.num_changed = 0
         self.num_skipped = 0
-
+        self._pending_newsitems = []
 
     def geocode(self, location_name, **kwargs):
         """
@@ -118,7 +130,8 @@ class BaseScraper(object):
             # Fall back to reverse-geocoding.
             from ebpub.geocoder import reverse
             try:
-                block, distance = reverse.reverse_geocode(point)
+                block, distance = reverse.reverse_geocode(
+                    point, max_distance=reverse.NEARBY_DISTANCE)
                 self.logger.debug(" Reverse-geocoded point to %r" % block.pretty_name)
                 location_name = block.pretty_name
             except reverse.ReverseGeocodeError:
@@ -155,6 +168,10 @@ class BaseScraper(object):
         Creates and saves a NewsItem with the given kwargs. Returns the new
         NewsItem.
 
+        If ``self.batch_size`` is set, the NewsItem isn't saved
+        until ``batch_size`` of them have been created, or
+        ``flush_newsitems()`` is called.
+
         kwargs MUST have the following keys:
         *   title
         *   item_date
@@ -204,7 +221,7 @@ class BaseScraper(object):
         # kwargs, which raises an error when using multiple schemas.
         schema = kwargs.get('schema', None) or self.schema
 
-        ni = NewsItem.objects.create(
+        ni = NewsItem(
             schema=schema,
             title=kwargs['title'],
             description=kwargs.get('description', ''),
@@ -215,12 +232,32 @@ class BaseScraper(object):
             location_name=location_name,
             location_object=kwargs.get('location_object', None),
         )
+        if self.batch_size and self.batch_size > 1:
+            self._pending_newsitems.append((ni, attributes))
+            if len(self._pending_newsitems) >= self.batch_size:
+                self.flush_newsitems()
+            return ni
+        ni.save()
         if attributes is not None:
             ni.attributes = attributes
         self.num_added += 1
         self.logger.info(u'Created NewsItem %s: %s (total created in this scrape: %s)', schema.slug, ni.id, self.num_added)
         return ni
 
+    def flush_newsitems(self):
+        """
+        Saves any NewsItems that create_newsitem() has buffered (see
+        ``batch_size``), in one transaction. Returns the list of
+        NewsItems saved.
+        """
+        pending, self._pending_newsitems = self._pending_newsitems, []
+        if not pending:
+            return []
+        newsitems = NewsItem.objects.bulk_create_with_attributes(pending)
+        self.num_added += len(newsitems)
+        self.logger.info(u'Created %d NewsItems (total created in this scrape: %s)', len(newsitems), self.num_added)
+        return newsitems
+
 
     @transaction.commit_on_success
     def update_existing(self, newsitem, new_values, new_attributes):
@@ -231,6 +268,9 @@ class BaseScraper(object):
 
         Returns the NewsItem.
         """
+        if newsitem.id is None:
+            # Still waiting in the create_newsitem() buffer.
+            self.flush_newsitems()
         newsitem_updated = False
         # First, check the NewsItem's values.
         for k, v in new_values.items():
@@ -246,7 +286,9 @@ class BaseScraper(object):
             newsitem.save()
         else:
             self.logger.debug("No change to %s <%s>" % (newsitem.id, newsitem))
-        # Next, check the NewsItem's attributes.
+        # Next, check the NewsItem's attributes, and save all the
+        # changed ones at once.
+        changed_attributes = {}
         for k, v in new_attributes.items():
             if isinstance(v, datetime.datetime) and v.tzinfo is not None:
                 # Django datetime fields are not timezone-aware, so we
@@ -260,8 +302,9 @@ class BaseScraper(object):
             elif newsitem.attributes.get(k) != v:
                 self.logger.debug('ID %s %s changed from %r to %r' %
                                  (newsitem.id, k, newsitem.attributes[k], v))
-            newsitem.attributes[k] = v
+            changed_attributes[k] = v
             newsitem_updated = True
+        newsitem.attributes.set_many(changed_attributes)
         if newsitem_updated:
             self.num_changed += 1
             self.logger.debug('Total changed in this scrape: %s', self.num_changed)
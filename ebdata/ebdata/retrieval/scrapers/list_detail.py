@@ -17,6 +17,12 @@
 #
 
 from base import BaseScraper, ScraperBroken
+from ebdata.retrieval.fingerprints import fingerprint
+from ebdata.retrieval.retrievers import HostThrottle
+import collections
+import Queue
+import sys
+import threading
 
 
 class SkipRecord(Exception):
@@ -56,8 +62,34 @@ class ListDetailScraper(BaseScraper):
 
         * clean_list_record()
         * clean_detail_record()
+
+    To fetch detail pages concurrently, set detail_concurrency to the
+    maximum number of detail pages to fetch at once.  get_detail() is
+    then called in worker threads, each with its own copy of
+    self.retriever; everything else (including existing_record(),
+    parse_detail(), clean_detail_record() and save()) is still called
+    in the main thread, in list order.  Note that existing_record()
+    may be called for a record before the ones ahead of it are saved.
+    Requests to each host are spaced out by detail_host_delay seconds,
+    which defaults to the scraper's sleep.
+
+    To skip list pages and records that haven't changed since the last
+    run, set fingerprint_store to an
+    ebdata.retrieval.fingerprints.FingerprintStore.  List pages are
+    then skipped if their content is the same as last time they were
+    fetched from the same URL, and records are skipped -- before
+    existing_record() is called, and without fetching the detail page
+    -- if record_key() returns a key and the clean list record is the
+    same as last time it was saved.  If save() buffers NewsItems (see
+    batch_size), fingerprints aren't remembered until
+    flush_newsitems() has saved them.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(ListDetailScraper, self).__init__(*args, **kwargs)
+        # (kind, fingerprint) pairs waiting for flush_newsitems().
+        self._pending_fingerprints = []
+
     ################################
     # MAIN METHODS FOR OUTSIDE USE #
     ################################
@@ -135,7 +167,17 @@ class ListDetailScraper(BaseScraper):
         self.logger.info("update() in %s started" % str(self.__class__))
         try:
             for page in self.list_pages():
+                # Even if the server said the page hasn't changed since
+                # we last fetched it, we may not have finished
+                # processing it then; only the fingerprint store knows.
+                page_fingerprint = self._page_fingerprint(page)
+                if page_fingerprint is not None and \
+                        self.fingerprint_store.unchanged('page', *page_fingerprint):
+                    self.logger.info("List page %s unchanged, skipping it" % page_fingerprint[1])
+                    continue
                 self.update_from_string(page)
+                if page_fingerprint is not None:
+                    self._remember_fingerprint('page', page_fingerprint)
         except StopScraping:
             pass
         finally:
@@ -150,44 +192,166 @@ class ListDetailScraper(BaseScraper):
 
         Subclasses should not have to override this method.
         """
+        if self.has_detail and (self.detail_concurrency or 1) > 1:
+            return self._update_from_string_concurrently(page)
         for list_record in self.parse_list(page):
+            prepared = self._prepare_list_record(list_record)
+            if prepared is None:
+                continue
+            list_record, old_record, record_fingerprint = prepared
+            get_page = None
+            if self.has_detail and self.detail_required(list_record, old_record):
+                get_page = lambda: self.get_detail(list_record)
+            self._finish_record(list_record, old_record, get_page, record_fingerprint)
+
+    def _update_from_string_concurrently(self, page):
+        """
+        Like update_from_string(), but keeps up to detail_concurrency
+        detail pages downloading at once.
+        """
+        delay = self.detail_host_delay
+        if delay is None:
+            delay = self.sleep
+        retriever = self.retriever
+        self.retriever = _ThreadLocalRetriever(retriever, HostThrottle(delay))
+        fetcher = _DetailFetcher(self.get_detail, self.detail_concurrency)
+        # (list_record, old_record, _Fetch or None, record_fingerprint),
+        # in list order.
+        pending = collections.deque()
+        try:
+            for list_record in self.parse_list(page):
+                prepared = self._prepare_list_record(list_record)
+                if prepared is None:
+                    continue
+                list_record, old_record, record_fingerprint = prepared
+                fetch = None
+                if self.detail_required(list_record, old_record):
+                    fetch = fetcher.submit(list_record)
+                pending.append((list_record, old_record, fetch, record_fingerprint))
+                # Finish what we can without waiting, and wait when
+                # there are too many pages in flight.
+                while pending and (len(pending) > self.detail_concurrency
+                                   or pending[0][2] is None or pending[0][2].done()):
+                    self._finish_pending(pending.popleft())
+            while pending:
+                self._finish_pending(pending.popleft())
+        finally:
+            fetcher.close()
+            self.retriever = retriever
+
+    def _finish_pending(self, pending_record):
+        list_record, old_record, fetch, record_fingerprint = pending_record
+        self._finish_record(list_record, old_record, fetch and fetch.get,
+                            record_fingerprint)
+
+    def _prepare_list_record(self, list_record):
+        """
+        Cleans a list record and finds the existing record.  Returns a
+        tuple of (list_record, old_record, record_fingerprint), or
+        None if the record should be skipped.
+        """
+        try:
+            list_record = self.clean_list_record(list_record)
+        except SkipRecord, e:
+            self.num_skipped += 1
+            self.logger.debug(u"Skipping list record for %r: %s " % (list_record, e))
+            return None
+        except ScraperBroken, e:
+            # Re-raise the ScraperBroken with some addtional helpful information.
+            raise ScraperBroken('%r -- %s' % (list_record, e))
+        self.logger.debug("Clean list record: %r" % list_record)
+
+        record_fingerprint = self._record_fingerprint(list_record)
+        if record_fingerprint is not None and \
+                self.fingerprint_store.unchanged('record', *record_fingerprint):
+            self.num_skipped += 1
+            self.logger.debug(u"Skipping unchanged list record %r" % list_record)
+            return None
+
+        old_record = self.existing_record(list_record)
+        self.logger.debug("Existing record: %r" % old_record)
+        return list_record, old_record, record_fingerprint
+
+    def _finish_record(self, list_record, old_record, get_page, record_fingerprint=None):
+        """
+        Parses and cleans the detail page, if ``get_page`` (a
+        callable returning it) is given, and saves the record.  If
+        that works, remembers ``record_fingerprint``.
+        """
+        if get_page is not None:
+            self.logger.debug("Detail page is required")
             try:
-                list_record = self.clean_list_record(list_record)
+                page = get_page()
+                detail_record = self.parse_detail(page, list_record)
+                detail_record = self.clean_detail_record(detail_record)
             except SkipRecord, e:
                 self.num_skipped += 1
-                self.logger.debug(u"Skipping list record for %r: %s " % (list_record, e))
-                continue
+                self.logger.debug("Skipping detail record for list %r: %s" % (list_record, e))
+                return
             except ScraperBroken, e:
-                # Re-raise the ScraperBroken with some addtional helpful information.
+                # Re-raise the ScraperBroken with some additional helpful information.
                 raise ScraperBroken('%r -- %s' % (list_record, e))
-            self.logger.debug("Clean list record: %r" % list_record)
+            self.logger.debug("Clean detail record: %r" % detail_record)
+        else:
+            self.logger.debug("Detail page is not required")
+            detail_record = None
 
-            old_record = self.existing_record(list_record)
-            self.logger.debug("Existing record: %r" % old_record)
+        try:
+            self.save(old_record, list_record, detail_record)
+        except SkipRecord, e:
+            self.logger.debug(u"Skipping list record during save: %r " % e)
+            self.num_skipped += 1
+            return
+        if record_fingerprint is not None:
+            self._remember_fingerprint('record', record_fingerprint)
+
+    def _remember_fingerprint(self, kind, value):
+        """
+        Remembers a (scope, key, digest) fingerprint of the given kind,
+        or, if there are NewsItems waiting to be saved, holds on to it
+        until they have been.
+        """
+        if self._pending_newsitems:
+            self._pending_fingerprints.append((kind, value))
+        else:
+            self.fingerprint_store.remember(kind, *value)
 
-            if self.has_detail and self.detail_required(list_record, old_record):
-                self.logger.debug("Detail page is required")
-                try:
-                    page = self.get_detail(list_record)
-                    detail_record = self.parse_detail(page, list_record)
-                    detail_record = self.clean_detail_record(detail_record)
-                except SkipRecord, e:
-                    self.num_skipped += 1
-                    self.logger.debug("Skipping detail record for list %r: %s" % (list_record, e))
-                    continue
-                except ScraperBroken, e:
-                    # Re-raise the ScraperBroken with some additional helpful information.
-                    raise ScraperBroken('%r -- %s' % (list_record, e))
-                self.logger.debug("Clean detail record: %r" % detail_record)
-            else:
-                self.logger.debug("Detail page is not required")
-                detail_record = None
+    def flush_newsitems(self):
+        """
+        Saves any buffered NewsItems, and then remembers the
+        fingerprints of the pages and records they came from.  If
+        saving fails, those fingerprints are forgotten, so the pages
+        and records are processed again next time.
+        """
+        fingerprints, self._pending_fingerprints = self._pending_fingerprints, []
+        newsitems = super(ListDetailScraper, self).flush_newsitems()
+        for kind, value in fingerprints:
+            self.fingerprint_store.remember(kind, *value)
+        return newsitems
 
-            try:
-                self.save(old_record, list_record, detail_record)
-            except SkipRecord, e:
-                self.logger.debug(u"Skipping list record during save: %r " % e)
-                self.num_skipped += 1
+    def _page_fingerprint(self, page):
+        """
+        Returns (scope, key, digest) for a list page just fetched by
+        self.retriever, or None if it can't be fingerprinted.
+        """
+        if self.fingerprint_store is None:
+            return None
+        uri = getattr(self.retriever, 'last_uri', None)
+        if not isinstance(uri, basestring):
+            return None
+        return (self.fingerprint_scope('page'), uri, fingerprint(page))
+
+    def _record_fingerprint(self, list_record):
+        """
+        Returns (scope, key, digest) for a clean list record, or None
+        if it can't be fingerprinted.
+        """
+        if self.fingerprint_store is None:
+            return None
+        key = self.record_key(list_record)
+        if key is None:
+            return None
+        return (self.fingerprint_scope('record'), key, fingerprint(list_record))
 
     def update_from_dir(self, dirname):
         """
@@ -215,6 +379,9 @@ class ListDetailScraper(BaseScraper):
     parse_list_re = None
     parse_detail_re = None
     has_detail = True
+    detail_concurrency = None
+    detail_host_delay = None
+    fingerprint_store = None
 
     def list_pages(self):
         """
@@ -293,6 +460,26 @@ class ListDetailScraper(BaseScraper):
         """
         raise NotImplementedError()
 
+    def record_key(self, list_record):
+        """
+        Given a cleaned list record, returns a string that uniquely
+        identifies it (within the fingerprint_scope()), or None.
+        Records are only skipped as unchanged if this returns a key.
+
+        Don't implement this if the detail page (or anything else
+        that isn't in the list record) can change without the list
+        record changing.
+        """
+        return None
+
+    def fingerprint_scope(self, kind):
+        """
+        Returns the scope that fingerprints of the given kind ('page'
+        or 'record') are stored under.  By default, that's the
+        scraper's full class name.
+        """
+        return '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+
     def detail_required(self, list_record, old_record):
         """
         Given a cleaned list record and the old record (which might be None),
@@ -375,6 +562,88 @@ class ListDetailScraper(BaseScraper):
         raise NotImplementedError()
 
 
+class _Fetch(object):
+    "The eventual result of a call in a _DetailFetcher thread."
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.isSet()
+
+    def get(self):
+        "Waits for the call to finish, and returns or raises what it did."
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class _DetailFetcher(object):
+    """
+    A fixed number of threads that call ``func`` with the arguments
+    given to submit().
+    """
+    def __init__(self, func, num_threads):
+        self.func = func
+        self._queue = Queue.Queue()
+        self._threads = [threading.Thread(target=self._work) for i in range(num_threads)]
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, *args):
+        fetch = _Fetch()
+        self._queue.put((fetch, args))
+        return fetch
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fetch, args = item
+            try:
+                fetch._result = self.func(*args)
+            except:
+                fetch._exc_info = sys.exc_info()
+            fetch._done.set()
+
+    def close(self):
+        "Drops any calls that haven't started, and stops the threads."
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class _ThreadLocalRetriever(object):
+    """
+    Stands in for a scraper's retriever while detail pages are being
+    fetched concurrently.  httplib2 connections can't be shared
+    between threads, so each thread uses its own clone of the
+    retriever, all sharing one HostThrottle.
+    """
+    def __init__(self, retriever, throttle):
+        self._retriever = retriever
+        self._throttle = throttle
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        retriever = getattr(self._local, 'retriever', None)
+        if retriever is None:
+            retriever = self._retriever.clone()
+            retriever.throttle = self._throttle
+            self._local.retriever = retriever
+        return getattr(retriever, name)
+
+
 class RssListDetailScraper(ListDetailScraper):
     """
     A ListDetailScraper for sites whose lists are RSS feeds.
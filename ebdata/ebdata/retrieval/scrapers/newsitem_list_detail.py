@@ -17,6 +17,7 @@
 #
 
 from django.conf import settings
+from ebdata.retrieval.fingerprints import DatabaseFingerprintStore
 from ebdata.retrieval.scrapers.list_detail import ListDetailScraper
 from ebdata.retrieval.utils import locations_are_close
 from ebpub.db.models import Schema, NewsItem, Lookup, DataUpdate, field_mapping
@@ -57,9 +58,15 @@ class NewsItemListDetailScraper(ListDetailScraper):
     SchemaField, mapping the name to the real_name.
     If schema_slugs has more than one element, self.schema_field_mapping
     is a dictionary in the format {schema_slug: {name: real_name}}.
+
+    Set use_fingerprints = True (and implement record_key()) to skip
+    unchanged list pages and records, remembering what was seen in
+    the ScraperFingerprint table.  Record fingerprints are scoped by
+    schema slug, so they're shared by all scrapers of the schema.
     """
     schema_slugs = None
     logname = None
+    use_fingerprints = False
 
     def __init__(self, *args, **kwargs):
         if self.logname is None:
@@ -70,6 +77,8 @@ class NewsItemListDetailScraper(ListDetailScraper):
         self._lookups_cache = None
         self._schema_fields_cache = None
         self._schema_field_mapping_cache = None
+        if self.use_fingerprints:
+            self.fingerprint_store = DatabaseFingerprintStore()
 
     # schemas, schema, lookups and schema_field_mapping are all lazily loaded
     # so that this scraper can be run (in raw_data(), xml_data() or
@@ -121,6 +130,11 @@ class NewsItemListDetailScraper(ListDetailScraper):
         return self._schema_field_mapping_cache
 
 
+    def fingerprint_scope(self, kind):
+        if kind == 'record':
+            return ','.join(self.schema_slugs)
+        return super(NewsItemListDetailScraper, self).fingerprint_scope(kind)
+
     def get_or_create_lookup(self, schema_field_name, name, code, description='', schema=None, make_text_slug=True):
         """
         Returns the Lookup instance matching the given Schema slug, SchemaField
@@ -151,6 +165,7 @@ class NewsItemListDetailScraper(ListDetailScraper):
         try:
             got_error = True
             super(NewsItemListDetailScraper, self).update()
+            self.flush_newsitems()
             got_error = False
         finally:
             # Rollback, in case the database is in an aborted
@@ -160,6 +175,15 @@ class NewsItemListDetailScraper(ListDetailScraper):
             from django.db import connection
             connection._rollback()
 
+            # Save whatever create_newsitem() buffered before the error.
+            num_pending = len(self._pending_newsitems)
+            if num_pending:
+                try:
+                    self.flush_newsitems()
+                except:
+                    self.logger.exception('Failed to save %d buffered NewsItems' % num_pending)
+                    connection._rollback()
+
             update_finish = datetime.datetime.now()
 
             # Clear the Schema cache, in case the schemas have been
@@ -201,4 +201,392 @@ class TestCreateNewsitem(django.test.TestCase):
         scraper.create_or_update(item, attrs, title='Kurtzman')
         self.assertEqual(item.title, 'Kurtzman')
 
+    def test_create_newsitem__batched(self):
+        from ebpub.db.models import NewsItem
+        scraper = self._make_scraper()
+        scraper.batch_size = 2
+        schema = self._get_schema()
+        kwargs = {'item_date': datetime.date(2012, 2, 1),
+                  'location_name': '123 Anywhere',
+                  'schema': schema}
+        item1 = scraper.create_newsitem({'attr1': 'value 1'}, title=u'Batch 1', **kwargs)
+        self.assertEqual(item1.id, None)
+        self.assertEqual(scraper.num_added, 0)
+        item2 = scraper.create_newsitem({'attr1': 'value 2'}, title=u'Batch 2', **kwargs)
+        # The buffer was full, so both got saved.
+        self.assert_(item1.id and item2.id)
+        self.assertEqual(scraper.num_added, 2)
+        item3 = scraper.create_newsitem(None, title=u'Batch 3', **kwargs)
+        self.assertEqual(item3.id, None)
+        self.assertEqual(scraper.flush_newsitems(), [item3])
+        self.assertEqual(scraper.flush_newsitems(), [])
+        self.assertEqual(scraper.num_added, 3)
+        self.assertEqual(NewsItem.objects.get(id=item2.id).attributes['attr1'], 'value 2')
+        self.assertEqual(len(NewsItem.objects.get(id=item3.id).attributes), 0)
+
+    def test_update_existing__buffered(self):
+        scraper = self._make_scraper()
+        scraper.batch_size = 10
+        schema = self._get_schema()
+        item = scraper.create_newsitem({'attr1': 'value 1'},
+                                       title=u'Test Title',
+                                       item_date=datetime.date(2012, 2, 1),
+                                       location_name='123 Anywhere',
+                                       schema=schema)
+        scraper.update_existing(item, {}, {'attr1': u'New Value'})
+        self.assert_(item.id)
+        self.assertEqual(scraper.num_added, 1)
+        self.assertEqual(scraper.num_changed, 1)
+        self.assertEqual(item.attributes['attr1'], u'New Value')
+
+
+class _StandInServer(object):
+    """
+    A local HTTP server, in a thread.
+
+    * /detail/N returns "detail N" after a short delay.
+    * /etag returns the same content with an ETag, or 304 if the
+      request had that ETag.
+    * /gzip returns gzip-compressed content.
+    * /flaky returns 503 twice, then 200.
+    """
+    def __init__(self, delay=0.1):
+        import BaseHTTPServer
+        import SocketServer
+        import threading
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests.append((self.path, dict(self.headers)))
+                if self.path.startswith('/detail/'):
+                    self.detail()
+                elif self.path == '/etag':
+                    if self.headers.get('if-none-match') == '"v1"':
+                        self.respond('', status=304, headers={'ETag': '"v1"'})
+                    else:
+                        self.respond('etag content', headers={'ETag': '"v1"'})
+                elif self.path == '/gzip':
+                    import gzip
+                    from StringIO import StringIO
+                    buf = StringIO()
+                    f = gzip.GzipFile(fileobj=buf, mode='wb')
+                    f.write('gzip content')
+                    f.close()
+                    self.respond(buf.getvalue(), headers={'Content-Encoding': 'gzip'})
+                elif self.path == '/flaky':
+                    count = len([p for p, h in server.requests if p == '/flaky'])
+                    if count <= 2:
+                        self.respond('', status=503, headers={'Retry-After': '0'})
+                    else:
+                        self.respond('finally')
+                else:
+                    self.respond('', status=404)
+
+            def detail(self):
+                import time
+                with server.lock:
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                time.sleep(delay)
+                with server.lock:
+                    server.in_flight -= 1
+                self.respond('detail %s' % self.path.split('/')[-1])
+
+            def respond(self, body, status=200, headers={}):
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if status != 304:
+                    self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestListDetailScraper(django.test.TestCase):
+
+    def setUp(self):
+        self.server = _StandInServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _make_scraper(self, detail_concurrency=None):
+        from ebdata.retrieval.scrapers.list_detail import ListDetailScraper, SkipRecord
+        server = self.server
+
+        class StandInScraper(ListDetailScraper):
+            def parse_list(self, page):
+                for num in page.split():
+                    yield {'num': num}
+
+            def existing_record(self, record):
+                return None
+
+            def detail_required(self, list_record, old_record):
+                return list_record['num'] != '3'
+
+            def get_detail(self, record):
+                return self.fetch_data('%s/detail/%s' % (server.url, record['num']))
+
+            def parse_detail(self, page, list_record):
+                return {'body': page}
+
+            def clean_detail_record(self, record):
+                if record['body'] == 'detail 5':
+                    raise SkipRecord()
+                return record
+
+            def save(self, old_record, list_record, detail_record):
+                self.saved.append((list_record['num'], detail_record))
+
+        scraper = StandInScraper(use_cache=False)
+        scraper.logger = mock.Mock()
+        scraper.detail_concurrency = detail_concurrency
+        scraper.num_skipped = 0
+        scraper.saved = []
+        return scraper
+
+    expected = [('1', {'body': 'detail 1'}), ('2', {'body': 'detail 2'}),
+                ('3', None), ('4', {'body': 'detail 4'}),
+                ('6', {'body': 'detail 6'}), ('7', {'body': 'detail 7'}),
+                ('8', {'body': 'detail 8'})]
+
+    def test_update_from_string(self):
+        scraper = self._make_scraper()
+        scraper.update_from_string('1 2 3 4 5 6 7 8')
+        self.assertEqual(scraper.saved, self.expected)
+        self.assertEqual(scraper.num_skipped, 1)
+        self.assertEqual(self.server.max_in_flight, 1)
+
+    def test_update_from_string__concurrent(self):
+        scraper = self._make_scraper(detail_concurrency=3)
+        retriever = scraper.retriever
+        scraper.update_from_string('1 2 3 4 5 6 7 8')
+        # Saved in list order.
+        self.assertEqual(scraper.saved, self.expected)
+        self.assertEqual(scraper.num_skipped, 1)
+        self.assert_(1 < self.server.max_in_flight <= 3)
+        self.assert_(scraper.retriever is retriever)
+
+    def test_update_from_string__concurrent_errors(self):
+        from ebdata.retrieval import PageNotFoundError
+        scraper = self._make_scraper(detail_concurrency=3)
+        scraper.get_detail = lambda record: scraper.fetch_data('%s/nope' % self.server.url)
+        self.assertRaises(PageNotFoundError, scraper.update_from_string, '1 2 3')
+        self.assertEqual(scraper.saved, [])
+
+    def test_update_from_string__fingerprints(self):
+        from ebdata.retrieval.fingerprints import FingerprintStore
+        store = FingerprintStore()
+        scraper = self._make_scraper()
+        scraper.fingerprint_store = store
+        scraper.record_key = lambda record: record['num']
+        scraper.update_from_string('1 2 3')
+        num_requests = len(self.server.requests)
+        # Only the new record is saved (or has its detail page fetched).
+        scraper = self._make_scraper(detail_concurrency=3)
+        scraper.fingerprint_store = store
+        scraper.record_key = lambda record: record['num']
+        scraper.update_from_string('1 2 3 4')
+        self.assertEqual(scraper.saved, [('4', {'body': 'detail 4'})])
+        self.assertEqual(scraper.num_skipped, 3)
+        self.assertEqual(len(self.server.requests), num_requests + 1)
+
+    def test_update_from_string__fingerprints_batched(self):
+        # Fingerprints of records whose NewsItems are still buffered
+        # aren't remembered unless they're saved.
+        from ebdata.retrieval.fingerprints import FingerprintStore
+        store = FingerprintStore()
+
+        def make_scraper():
+            scraper = self._make_scraper()
+            scraper.fingerprint_store = store
+            scraper.record_key = lambda record: record['num']
+            scraper.batch_size = 10
+
+            def save(old_record, list_record, detail_record):
+                scraper._pending_newsitems.append((mock.Mock(), None))
+                scraper.saved.append(list_record['num'])
+            scraper.save = save
+            return scraper
+
+        scraper = make_scraper()
+        scraper.update_from_string('1 2 3')
+        scope = scraper.fingerprint_scope('record')
+        self.assertEqual(store.get('record', scope, '1'), None)
+        with mock.patch('ebdata.retrieval.scrapers.base.NewsItem') as newsitem_class:
+            newsitem_class.objects.bulk_create_with_attributes.side_effect = ValueError
+            self.assertRaises(ValueError, scraper.flush_newsitems)
+        self.assertEqual(store.get('record', scope, '1'), None)
+
+        scraper = make_scraper()
+        scraper.update_from_string('1 2 3')
+        self.assertEqual(scraper.saved, ['1', '2', '3'])
+        with mock.patch('ebdata.retrieval.scrapers.base.NewsItem') as newsitem_class:
+            newsitem_class.objects.bulk_create_with_attributes.side_effect = lambda pending: pending
+            scraper.flush_newsitems()
+        self.assert_(store.get('record', scope, '1'))
+
+        scraper = make_scraper()
+        scraper.update_from_string('1 2 3')
+        self.assertEqual(scraper.saved, [])
+
+    def test_update__page_fingerprints(self):
+        from ebdata.retrieval.fingerprints import FingerprintStore
+        store = FingerprintStore()
+        url = self.server.url + '/etag'
+        for i in range(2):
+            scraper = self._make_scraper()
+            scraper.fingerprint_store = store
+            scraper.list_pages = lambda: [scraper.fetch_data(url)]
+            scraper.update()
+            if i == 0:
+                self.assertEqual(len(scraper.saved), 2)
+        # The list page was fetched again, but not parsed.
+        self.assertEqual(scraper.saved, [])
+        self.assertEqual([path for path, headers in self.server.requests],
+                         ['/etag', '/detail/etag', '/detail/content', '/etag'])
+
+    def test_update__not_modified_after_error(self):
+        # A list page that failed is processed again next time, even
+        # if the server says it hasn't changed.
+        import shutil
+        import tempfile
+        from ebdata.retrieval import PooledRetriever
+        cache_dir = tempfile.mkdtemp()
+        try:
+            url = self.server.url + '/etag'
+            scraper = self._make_scraper()
+            scraper.retriever = PooledRetriever(cache=cache_dir)
+            scraper.list_pages = lambda: [scraper.fetch_data(url)]
+            scraper.save = mock.Mock(side_effect=ValueError)
+            self.assertRaises(ValueError, scraper.update)
+            scraper = self._make_scraper()
+            scraper.retriever = PooledRetriever(cache=cache_dir)
+            scraper.list_pages = lambda: [scraper.fetch_data(url)]
+            scraper.update()
+            self.assertEqual(scraper.retriever.not_modified, True)
+            self.assertEqual(len(scraper.saved), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestFingerprints(django.test.TestCase):
+
+    def test_fingerprint(self):
+        from ebdata.retrieval.fingerprints import fingerprint
+        from django.contrib.gis.geos import Point
+        record = {'title': u'Caf\xe9', 'date': datetime.date(2011, 1, 1),
+                  'point': Point(1.0, 2.0, srid=4326)}
+        same = dict(reversed(record.items()))
+        same['point'] = Point(1.0, 2.0, srid=4326)
+        self.assertEqual(fingerprint(record), fingerprint(same))
+        self.assertNotEqual(fingerprint(record), fingerprint(dict(record, title=u'Cafe')))
+        self.assertEqual(fingerprint(u'Caf\xe9'), fingerprint(u'Caf\xe9'.encode('utf8')))
+
+    def test_database_store(self):
+        from ebdata.retrieval.fingerprints import DatabaseFingerprintStore
+        from ebpub.db.models import ScraperFingerprint
+        store = DatabaseFingerprintStore()
+        self.assertEqual(store.get('record', 'crime', '1'), None)
+        store.remember('record', 'crime', '1', 'aaa')
+        store.remember('page', 'crime', '1', 'bbb')
+        store = DatabaseFingerprintStore()
+        self.assert_(store.unchanged('record', 'crime', '1', 'aaa'))
+        self.failIf(store.unchanged('record', 'crime', '1', 'ccc'))
+        self.assertEqual(store.get('record', 'fire', '1'), None)
+        store.remember('record', 'crime', '1', 'ccc')
+        self.assertEqual(ScraperFingerprint.objects.get(kind='record').digest, 'ccc')
+        self.assertEqual(ScraperFingerprint.objects.count(), 2)
+
+
+class TestHostThrottle(django.test.TestCase):
+
+    def test_wait(self):
+        import time
+        from ebdata.retrieval.retrievers import HostThrottle
+        throttle = HostThrottle(0.2)
+        start = time.time()
+        throttle.wait('http://example.com/a')
+        throttle.wait('http://example.org/a')
+        self.assert_(time.time() - start < 0.1)
+        throttle.wait('http://example.com/b')
+        self.assert_(time.time() - start >= 0.2)
+
+
+class TestPooledRetriever(django.test.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.server = _StandInServer()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _make_retriever(self, **kwargs):
+        from ebdata.retrieval import PooledRetriever
+        return PooledRetriever(cache=self.cache_dir, backoff=0.01, **kwargs)
+
+    def test_conditional_get(self):
+        retriever = self._make_retriever()
+        url = self.server.url + '/etag'
+        self.assertEqual(retriever.fetch_data(url), 'etag content')
+        self.assertEqual(retriever.not_modified, False)
+        # A new retriever, eg. on the next run, remembers the ETag.
+        retriever = self._make_retriever()
+        content, headers = retriever.fetch_data_and_headers(url)
+        self.assertEqual(content, 'etag content')
+        self.assertEqual(headers['status'], '200')
+        self.assertEqual(retriever.not_modified, True)
+        self.assertEqual(self.server.requests[-1][1].get('if-none-match'), '"v1"')
+        stats = retriever.stats[self.server.url[len('http://'):]]
+        self.assertEqual((stats.requests, stats.not_modified), (1, 1))
+
+    def test_gzip(self):
+        retriever = self._make_retriever()
+        self.assertEqual(retriever.get_html(self.server.url + '/gzip'), 'gzip content')
+        self.assert_('gzip' in self.server.requests[-1][1]['accept-encoding'])
+
+    def test_retries(self):
+        retriever = self._make_retriever()
+        self.assertEqual(retriever.fetch_data(self.server.url + '/flaky'), 'finally')
+        stats = retriever.stats.values()[0]
+        self.assertEqual((stats.requests, stats.retries), (3, 2))
+
+    def test_retries__give_up(self):
+        retriever = self._make_retriever(max_attempts=2)
+        content, headers = retriever.fetch_data_and_headers(self.server.url + '/flaky')
+        self.assertEqual(headers['status'], '503')
+        self.assertEqual(retriever.stats.values()[0].requests, 2)
 
+    def test_not_found(self):
+        from ebdata.retrieval import PageNotFoundError
+        retriever = self._make_retriever()
+        self.assertRaises(PageNotFoundError, retriever.fetch_data, self.server.url + '/nope')
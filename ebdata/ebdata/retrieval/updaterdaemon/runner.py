@@ -65,7 +65,10 @@ class UpdaterDaemon(EveryMinuteDaemon):
     """
     A (deprecated) daemon for running OpenBlock scrapers based on a config file.
 
-    We now recommend just using cron or your preferred scheduling tool instead.
+    We now recommend just using cron or your preferred scheduling tool
+    instead, or ebdata.retrieval.updaterdaemon.scheduler.SchedulerDaemon,
+    which reads the same config files but limits concurrency, prevents
+    overlapping runs, kills runs that time out, and records run history.
     """
 
     def __init__(self, *args, **kwargs):
@@ -154,5 +157,7 @@ class UpdaterDaemon(EveryMinuteDaemon):
                     os.waitpid(pid, 0)
 
 if __name__ == "__main__":
-    daemon = UpdaterDaemon('/tmp/updaterdaemon.pid')
+    # The scheduler replaces UpdaterDaemon, and takes the same options.
+    from ebdata.retrieval.updaterdaemon.scheduler import SchedulerDaemon
+    daemon = SchedulerDaemon('/tmp/updaterdaemon.pid')
     daemon.run_from_command_line(sys.argv[1:])
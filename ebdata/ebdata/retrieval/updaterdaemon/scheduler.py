@@ -0,0 +1,533 @@
+#   Copyright 2011 OpenPlans, and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A scheduler for scrapers and other periodic tasks.
+
+Like UpdaterDaemon, it runs each task in its own process, but it
+keeps track of them: no more than max_concurrent tasks run at once,
+a task doesn't start again while its last run is still going (lock
+files make sure of that, even across schedulers), runs that take too
+long are killed, and each run is recorded as an
+ebpub.db.models.TaskRun.
+
+Usage::
+
+  python scheduler.py --config=/path/to/config.py start
+
+The config file is like the one for UpdaterDaemon (see config.py),
+but TASKS can also contain Task instances, with cron schedules and
+timeouts, and MAX_CONCURRENT sets the global limit.  The scheduler
+itself needs DJANGO_SETTINGS_MODULE set to record run history.
+"""
+
+from ebdata.utils.daemon import Daemon
+import datetime
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+logger = logging.getLogger('eb.retrieval.scheduler')
+
+
+class CronSchedule(object):
+    """
+    Matches datetimes against a crontab-style expression of five
+    fields: minute, hour, day of month, month, and day of week (0 or 7
+    is Sunday).  Each field can be '*', a number, a range like '1-5',
+    or a list of those, optionally with a step like '*/15'.
+
+    Instances are callable, so they can be used in place of the
+    callbacks in updaterdaemon.config.
+
+      >>> weekdays = CronSchedule('30 6 * * 1-5')
+      >>> weekdays(datetime.datetime(2011, 11, 4, 6, 30))
+      True
+      >>> weekdays(datetime.datetime(2011, 11, 5, 6, 30))
+      False
+    """
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression %r doesn't have 5 fields" % expression)
+        (self.minutes, self.hours, self.days, self.months, self.weekdays) = [
+            _parse_cron_field(field, low, high)
+            for field, (low, high) in zip(fields, self.FIELD_RANGES)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def __call__(self, dt):
+        if not (dt.minute in self.minutes and dt.hour in self.hours
+                and dt.month in self.months):
+            return False
+        day_matches = dt.day in self.days
+        weekday_matches = dt.isoweekday() % 7 in self.weekdays
+        # As in cron, if both day fields are restricted, either one
+        # can match.
+        if self._any_day:
+            return weekday_matches
+        if self._any_weekday:
+            return day_matches
+        return day_matches or weekday_matches
+
+    def __repr__(self):
+        return 'CronSchedule(%r)' % self.expression
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(n) for n in part.split('-', 1)]
+        else:
+            start = end = int(part)
+            if step != 1:
+                # "5/15" means every 15, starting at 5.
+                end = high
+        if step < 1 or not (low <= start <= end <= high):
+            raise ValueError("Bad cron field %r" % field)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Task(object):
+    """
+    A function to run on a schedule, in its own process.
+
+    ``schedule`` is a cron expression, or a callable that takes a
+    datetime and returns True if the task should start then.  The
+    function is called with ``kwargs``, after updating os.environ
+    with ``env``.
+
+    Runs that take longer than ``timeout`` seconds are killed, along
+    with any processes they started.  No more than ``max_concurrent``
+    runs of the task happen at once; by default that's one, so a run
+    that's due while the last one is still going is skipped.
+
+    If the function returns a number, or a tuple starting with one
+    (like (num_added, num_changed, num_skipped)), it's recorded as
+    the number of items added.
+    """
+
+    def __init__(self, func, schedule, kwargs=None, env=None, name=None,
+                 timeout=None, max_concurrent=1):
+        if isinstance(schedule, basestring):
+            schedule = CronSchedule(schedule)
+        self.func = func
+        self.schedule = schedule
+        self.kwargs = kwargs or {}
+        self.env = env or {}
+        if name is None:
+            name = '%s.%s' % (func.__module__, func.__name__)
+            if self.kwargs:
+                name += '(%s)' % ', '.join(['%s=%r' % item for item in sorted(self.kwargs.items())])
+        self.name = name[:255]
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+
+    def is_due(self, timestamp):
+        return bool(self.schedule(timestamp))
+
+    def __repr__(self):
+        return '<Task %s>' % self.name
+
+
+def tasks_from_config(config):
+    """
+    Returns a list of Tasks from a config module's TASKS, which may
+    contain Task instances or UpdaterDaemon-style tuples of
+    (time_callback, function, kwargs, env).
+    """
+    tasks = []
+    for task in config.TASKS:
+        if not isinstance(task, Task):
+            check, func, kwargs, env = task
+            task = Task(func, check, kwargs, env)
+        tasks.append(task)
+    return tasks
+
+
+class _Run(object):
+    """
+    A running task.
+    """
+    def __init__(self, task, pid, result_fd):
+        self.task = task
+        self.pid = pid
+        self.result_fd = result_fd
+        self.started = datetime.datetime.now()
+        self.start_time = time.time()
+        self.killed_at = None
+        self.timed_out = False
+        self.record = None
+
+
+class Scheduler(object):
+    """
+    Starts Tasks when they're due, as long as fewer than
+    ``max_concurrent`` are running, and keeps track of them.
+
+    Call tick() once a minute, and reap() often (every second or so).
+    Tasks that are due while max_concurrent tasks are running wait
+    until one finishes.  Tasks that time out get SIGTERM, and
+    ``kill_grace`` seconds later, SIGKILL.
+
+    Lock files, one per allowed concurrent run of each task, go in
+    ``lock_dir``.  If ``record_history`` is true, each run is saved
+    as an ebpub.db.models.TaskRun.
+    """
+
+    def __init__(self, tasks=(), max_concurrent=4, lock_dir=None,
+                 kill_grace=30, record_history=True):
+        self.tasks = list(tasks)
+        self.max_concurrent = max_concurrent
+        if lock_dir is None:
+            lock_dir = os.path.join(tempfile.gettempdir(), 'ebdata-scheduler-locks')
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+        self.lock_dir = lock_dir
+        self.kill_grace = kill_grace
+        self.record_history = record_history
+        # Tasks that are due, waiting for a free slot.
+        self.pending = []
+        # {pid: _Run}
+        self.running = {}
+
+    def tick(self, timestamp):
+        """
+        Queues the tasks that are due at ``timestamp``, and starts as
+        many of them as we can.
+        """
+        for task in self.tasks:
+            if task.name in [t.name for t in self.pending]:
+                continue
+            try:
+                due = task.is_due(timestamp)
+            except Exception:
+                logger.exception("Checking whether %s is due failed" % task.name)
+                continue
+            if due:
+                self.pending.append(task)
+        self.start_pending()
+
+    def start_pending(self):
+        still_pending = []
+        for task in self.pending:
+            if len(self.running) >= self.max_concurrent:
+                still_pending.append(task)
+                continue
+            self.start(task)
+        if still_pending:
+            logger.info("%d tasks running, %d waiting: %s"
+                        % (len(self.running), len(still_pending),
+                           ', '.join([t.name for t in still_pending])))
+        self.pending = still_pending
+
+    def start(self, task):
+        """
+        Starts a run of the task in a child process, unless it's
+        already running as many times as it's allowed to.  Returns the
+        child's pid, or None.
+        """
+        lock = self._lock(task)
+        if lock is None:
+            logger.warning("%s is still running, skipping this run" % task.name)
+            return None
+
+        # The child mustn't share our database connection.
+        _close_db_connection()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _run_child(task, write_fd)
+        # The child holds the lock until it (and anything it started)
+        # exits.
+        lock.close()
+        os.close(write_fd)
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            # The child already did it, or has already exited.
+            pass
+        flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        run = self.running[pid] = _Run(task, pid, read_fd)
+        logger.info("Started %s, pid %d" % (task.name, pid))
+        if self.record_history:
+            from ebpub.db.models import TaskRun
+            try:
+                run.record = TaskRun.objects.create(task=task.name, started=run.started, pid=pid)
+            except Exception:
+                logger.exception("Couldn't record the start of %s" % task.name)
+        return pid
+
+    def reap(self):
+        """
+        Records the runs that have finished, kills the ones that have
+        timed out, and starts pending tasks if there's room.
+        """
+        for pid, run in self.running.items():
+            try:
+                finished_pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                finished_pid, status = pid, None
+            if finished_pid == 0:
+                self._check_timeout(run)
+                continue
+            del self.running[pid]
+            self._finish(run, status)
+        if self.pending:
+            self.start_pending()
+
+    def _check_timeout(self, run):
+        timeout = run.task.timeout
+        if timeout is None:
+            return
+        now = time.time()
+        if run.killed_at is None:
+            if now - run.start_time > timeout:
+                logger.error("%s (pid %d) ran for more than %s seconds, killing it"
+                             % (run.task.name, run.pid, timeout))
+                run.timed_out = True
+                run.killed_at = now
+                _kill(run.pid, signal.SIGTERM)
+        elif now - run.killed_at > self.kill_grace:
+            _kill(run.pid, signal.SIGKILL)
+            # Don't keep killing it.
+            run.killed_at = float('inf')
+
+    def _finish(self, run, status):
+        if status is None:
+            exit_status = None
+        elif os.WIFSIGNALED(status):
+            exit_status = -os.WTERMSIG(status)
+        else:
+            exit_status = os.WEXITSTATUS(status)
+        try:
+            result = os.read(run.result_fd, 64)
+        except OSError:
+            result = ''
+        os.close(run.result_fd)
+        num_added = None
+        if result:
+            num_added = int(result)
+        finished = datetime.datetime.now()
+        logger.info("%s (pid %d) finished in %s with exit status %s"
+                    % (run.task.name, run.pid, finished - run.started, exit_status))
+        if run.record is not None:
+            run.record.finished = finished
+            run.record.exit_status = exit_status
+            run.record.timed_out = run.timed_out
+            run.record.num_added = num_added
+            try:
+                run.record.save()
+            except Exception:
+                logger.exception("Couldn't record the end of %s" % run.task.name)
+
+    def _lock(self, task):
+        """
+        Returns an open file holding a lock on one of the task's
+        max_concurrent lock files, or None if they're all locked.
+        """
+        name = re.sub(r'[^\w.-]+', '_', task.name)[:100]
+        name += '-' + hashlib.md5(task.name).hexdigest()[:8]
+        for slot in range(task.max_concurrent):
+            path = os.path.join(self.lock_dir, '%s.%d.lock' % (name, slot))
+            lock = open(path, 'a')
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                lock.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            return lock
+        return None
+
+
+def _close_db_connection():
+    try:
+        from django.db import connection
+    except ImportError:
+        # No settings, so no connection.
+        return
+    connection.close()
+
+def _kill(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+
+def _run_child(task, result_fd):
+    """
+    Runs the task, in a forked child process, and exits.
+    """
+    status = 1
+    try:
+        # Get our own process group, so a timeout kills anything we
+        # start too.
+        os.setpgid(0, 0)
+        os.environ.update(task.env)
+        sys.stdout.write('%s\t%s\t%s\n' % (datetime.datetime.now(), task.name, os.getpid()))
+        sys.stdout.flush()
+        result = task.func(**task.kwargs)
+        if isinstance(result, (tuple, list)) and result:
+            result = result[0]
+        if isinstance(result, (int, long)) and not isinstance(result, bool):
+            os.write(result_fd, str(result))
+        status = 0
+    except SystemExit, e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+    except Exception:
+        traceback_string = ''.join(traceback.format_exception(*sys.exc_info()))
+        sys.stderr.write("ERROR AT %s\n" % datetime.datetime.now())
+        sys.stderr.write(traceback_string)
+        sys.stderr.write("\n========================================\n")
+        try:
+            from django.core.mail import mail_admins
+            mail_admins(task.name.replace('\n', ' '), traceback_string)
+        except Exception, e:
+            sys.stderr.write("Got error mailing admins: %s\n" % e)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Don't call sys.exit(), because we're in a child process.
+        os._exit(status)
+
+
+def _next_minute(dt):
+    return (dt + datetime.timedelta(minutes=1)).replace(second=0, microsecond=0)
+
+
+class SchedulerDaemon(Daemon):
+    """
+    A daemon that runs the tasks in a config file with a Scheduler.
+    The config is reloaded every minute.
+    """
+
+    poll_interval = 1
+
+    def __init__(self, *args, **kwargs):
+        super(SchedulerDaemon, self).__init__(*args, **kwargs)
+        self.parser.add_option("-c", "--config",
+                               help="path to configuration file (python).",
+                               action="store", default=None)
+        self.parser.add_option("--error-log",
+                               help="path to error log.",
+                               action="store", default="/tmp/updaterdaemon.err")
+        self.parser.add_option("--log-file",
+                               help="path to log file.",
+                               action="store", default="/tmp/updaterdaemon.log")
+        self.parser.add_option("--max-concurrent", type="int",
+                               help="maximum number of tasks to run at once; "
+                               "overrides MAX_CONCURRENT in the config file.",
+                               action="store", default=None)
+        self.parser.add_option("--lock-dir",
+                               help="directory for task lock files.",
+                               action="store", default=None)
+        self.parser.add_option("--no-history",
+                               help="don't record runs in the database.",
+                               action="store_false", dest="record_history",
+                               default=True)
+
+    def parse_args(self, argv):
+        """Given sys.argv, parses the command-line arguments.
+        """
+        super(SchedulerDaemon, self).parse_args(argv)
+
+        self.stdout = self.options.log_file
+        self.stderr = self.options.error_log
+
+        config = self.options.config
+        if config is None:
+            config = os.path.join(os.path.dirname(__file__), 'config.py')
+        config = os.path.normpath(os.path.abspath(config))
+        configdir, configfile = os.path.split(config)
+        configfile, ext = os.path.splitext(configfile)
+        if configdir not in sys.path:
+            sys.path.insert(0, configdir)
+        self.config = __import__(configfile)
+
+        max_concurrent = self.options.max_concurrent
+        if max_concurrent is None:
+            max_concurrent = getattr(self.config, 'MAX_CONCURRENT', 4)
+        self.scheduler = Scheduler(tasks_from_config(self.config),
+                                   max_concurrent=max_concurrent,
+                                   lock_dir=self.options.lock_dir,
+                                   record_history=self.options.record_history)
+
+    def run(self):
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                            format='%(asctime)s %(levelname)s %(message)s')
+        # As in EveryMinuteDaemon, don't handle the current minute, so
+        # a restart doesn't run its tasks twice.
+        next_minute = _next_minute(datetime.datetime.now())
+        while 1:
+            self.scheduler.reap()
+            now = datetime.datetime.now()
+            if now >= next_minute:
+                self.reload_config()
+                self.scheduler.tick(next_minute)
+                next_minute = _next_minute(now)
+            time.sleep(self.poll_interval)
+
+    def reload_config(self):
+        """
+        Reloads the config, to take into account any changes that
+        might have been made.
+        """
+        try:
+            reload(self.config)
+            self.scheduler.tasks = tasks_from_config(self.config)
+            if self.options.max_concurrent is None:
+                self.scheduler.max_concurrent = getattr(self.config, 'MAX_CONCURRENT', 4)
+        except Exception:
+            logger.exception("Reloading config failed, keeping the old tasks")
+
+
+if __name__ == "__main__":
+    daemon = SchedulerDaemon('/tmp/updaterdaemon.pid')
+    daemon.run_from_command_line(sys.argv[1:])
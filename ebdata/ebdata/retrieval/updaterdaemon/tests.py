@@ -0,0 +1,137 @@
+#   Copyright 2012 OpenPlans, and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import django.test
+import shutil
+import sys
+import tempfile
+import time
+
+# Tasks for the scheduler to run.  They're module-level functions so
+# their names are predictable.
+
+def _add_three():
+    return (3, 0, 0)
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+def _exit(status):
+    sys.exit(status)
+
+
+class TestCronSchedule(django.test.TestCase):
+
+    def test_schedule(self):
+        from ebdata.retrieval.updaterdaemon.scheduler import CronSchedule
+        # A Friday.
+        dt = datetime.datetime(2011, 11, 4, 6, 30)
+        self.assert_(CronSchedule('* * * * *')(dt))
+        self.assert_(CronSchedule('*/15 6 * * *')(dt))
+        self.failIf(CronSchedule('*/20 6 * * *')(dt))
+        self.assert_(CronSchedule('0,30 5-7 * 11 1-5')(dt))
+        self.failIf(CronSchedule('30 6 * * 0,6')(dt))
+        self.assert_(CronSchedule('30 6 * * 7')(dt + datetime.timedelta(days=2)))
+        # Either day field can match, if both are restricted.
+        self.assert_(CronSchedule('30 6 1 * 5')(dt))
+        self.assert_(CronSchedule('30 6 4 * 0')(dt))
+        self.failIf(CronSchedule('30 6 1 * 0')(dt))
+
+    def test_bad_schedule(self):
+        from ebdata.retrieval.updaterdaemon.scheduler import CronSchedule
+        self.assertRaises(ValueError, CronSchedule, '* * * *')
+        self.assertRaises(ValueError, CronSchedule, '60 * * * *')
+        self.assertRaises(ValueError, CronSchedule, '*/0 * * * *')
+        self.assertRaises(ValueError, CronSchedule, 'x * * * *')
+
+
+class TestScheduler(django.test.TransactionTestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def _make_scheduler(self, *tasks, **kwargs):
+        from ebdata.retrieval.updaterdaemon.scheduler import Scheduler
+        return Scheduler(tasks, lock_dir=self.lock_dir, kill_grace=1, **kwargs)
+
+    def _wait(self, scheduler):
+        for i in range(100):
+            scheduler.reap()
+            if not (scheduler.running or scheduler.pending):
+                return
+            time.sleep(0.1)
+        self.fail("Tasks still running: %r" % scheduler.running.values())
+
+    def test_run_history(self):
+        from ebdata.retrieval.updaterdaemon.scheduler import Task
+        from ebpub.db.models import TaskRun
+        scheduler = self._make_scheduler(Task(_add_three, '* * * * *'),
+                                         Task(_exit, '0 * * * *', {'status': 3}))
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 0))
+        self._wait(scheduler)
+        runs = dict([(run.task, run) for run in TaskRun.objects.all()])
+        self.assertEqual(len(runs), 2)
+        run = runs['ebdata.retrieval.updaterdaemon.tests._add_three']
+        self.assertEqual((run.exit_status, run.num_added, run.timed_out), (0, 3, False))
+        self.assert_(run.total_time() is not None)
+        run = runs['ebdata.retrieval.updaterdaemon.tests._exit(status=3)']
+        self.assertEqual((run.exit_status, run.num_added), (3, None))
+
+    def test_no_overlap(self):
+        from ebdata.retrieval.updaterdaemon.scheduler import Task
+        task = Task(_sleep, '* * * * *', {'seconds': 1})
+        scheduler = self._make_scheduler(task, record_history=False)
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 0))
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 1))
+        self.assertEqual(len(scheduler.running), 1)
+        self.assertEqual(scheduler.pending, [])
+        # Not even another scheduler can start it.
+        other = self._make_scheduler(task, record_history=False)
+        self.assertEqual(other.start(task), None)
+        self._wait(scheduler)
+        task.max_concurrent = 2
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 2))
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 3))
+        self.assertEqual(len(scheduler.running), 2)
+        self._wait(scheduler)
+
+    def test_max_concurrent(self):
+        from ebdata.retrieval.updaterdaemon.scheduler import Task
+        tasks = [Task(_sleep, '* * * * *', {'seconds': 0.5}, name=name)
+                 for name in ('a', 'b', 'c')]
+        scheduler = self._make_scheduler(max_concurrent=2, record_history=False, *tasks)
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 0))
+        self.assertEqual(len(scheduler.running), 2)
+        self.assertEqual([task.name for task in scheduler.pending], ['c'])
+        self._wait(scheduler)
+
+    def test_timeout(self):
+        from ebdata.retrieval.updaterdaemon.scheduler import Task
+        from ebpub.db.models import TaskRun
+        task = Task(_sleep, '* * * * *', {'seconds': 30}, timeout=0.2)
+        scheduler = self._make_scheduler(task)
+        start = time.time()
+        scheduler.tick(datetime.datetime(2011, 11, 4, 6, 0))
+        self._wait(scheduler)
+        self.assert_(time.time() - start < 5)
+        run = TaskRun.objects.get()
+        self.assertEqual((run.exit_status, run.timed_out), (-15, True))
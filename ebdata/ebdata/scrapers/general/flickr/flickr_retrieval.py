@@ -40,6 +40,7 @@ from ebdata.retrieval.scrapers.list_detail import StopScraping, SkipRecord
 from ebdata.retrieval.scrapers.newsitem_list_detail import NewsItemListDetailScraper
 from ebpub.db.models import NewsItem
 from ebpub.geocoder.reverse import reverse_geocode, ReverseGeocodeError
+from ebpub.geocoder.reverse import NEARBY_DISTANCE
 from ebpub.utils.dates import parse_date
 from ebpub.utils.geodjango import get_default_bounds
 import datetime
@@ -152,7 +153,8 @@ class FlickrScraper(NewsItemListDetailScraper):
         # those are probably not specific enough; reverse-geocode
         # instead.
         try:
-            block, distance = reverse_geocode(cleaned['location'])
+            block, distance = reverse_geocode(cleaned['location'],
+                                              max_distance=NEARBY_DISTANCE)
             cleaned['location_name'] = block.pretty_name
         except ReverseGeocodeError:
             raise SkipRecord("Could not geocode location %s, %s" % (x, y))
@@ -22,7 +22,7 @@
 from django.contrib.gis.geos import Point
 from ebpub.utils.geodjango import get_default_bounds
 from ebpub.db.models import Schema, SchemaField, NewsItem, Lookup
-from ebpub.geocoder.reverse import reverse_geocode
+from ebpub.geocoder.reverse import reverse_geocode, NEARBY_DISTANCE
 from httplib2 import Http
 from lxml import etree
 import datetime
@@ -196,7 +196,7 @@ class GeoReportV2Scraper(object):
         # try to reverse geocde this point
         if not ni.location_name:
             try:
-                block, distance = reverse_geocode(ni.location)
+                block, distance = reverse_geocode(ni.location, max_distance=NEARBY_DISTANCE)
                 ni.location_name = block.pretty_name
             except:
                 log.debug("Failed to reverse geocode item %s" % service_request_id)
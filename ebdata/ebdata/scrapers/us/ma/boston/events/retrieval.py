@@ -116,7 +116,8 @@ class EventsCalendarScraper(object):
                     # Fall back to reverse-geocoding.
                     from ebpub.geocoder import reverse
                     try:
-                        block, distance = reverse.reverse_geocode(item.location)
+                        block, distance = reverse.reverse_geocode(
+                            item.location, max_distance=reverse.NEARBY_DISTANCE)
                         logger.info(" Reverse-geocoded point to %r" % block.pretty_name)
                         item.location_name = block.pretty_name
                     except reverse.ReverseGeocodeError:
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark for the place date charts: compares counting NewsItems
+live (``NewsItemQuerySet.date_counts()``) against
+:py:func:`ebpub.db.views.get_date_counts`, which answers from the
+aggregate tables.
+
+Creates a throwaway schema with lots of synthetic NewsItems (5
+million by default) spread over existing Locations and a range of
+days, updates its aggregates, times both ways of counting for random
+Locations and date spans, then deletes the schema again (unless
+``--keep`` is given).
+
+Don't run this on a production database! Creating the items takes
+a while, as does deleting them.
+"""
+
+from django.db import connection, transaction
+from ebpub.db import constants
+from ebpub.db.bin.update_aggregates import update_aggregates
+from ebpub.db.models import Schema, Location, NewsItem, NewsItemLocation
+from ebpub.db.models import AggregateAll, AggregateDay, AggregateLocation
+from ebpub.db.models import AggregateLocationDay, AggregateFieldLookup, AggregateChange
+from ebpub.db.schemafilters import FilterChain
+from ebpub.db.views import get_date_counts
+from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
+import datetime
+import logging
+import random
+import time
+
+logger = logging.getLogger('ebpub.db.bin.benchmark_date_charts')
+
+SCHEMA_SLUG = 'date-chart-benchmark'
+
+
+def create_items(num_items, num_days, location_ids):
+    """
+    Creates a benchmark Schema with ``num_items`` NewsItems, spread
+    evenly over the ``num_days`` days up to today and randomly over
+    the given Locations, and updates its aggregates.  Returns the Schema.
+    """
+    today = datetime.date.today()
+    schema = Schema.objects.create(
+        name='benchmark item', plural_name='benchmark items',
+        indefinite_article='a', slug=SCHEMA_SLUG,
+        min_date=today - datetime.timedelta(days=num_days),
+        last_updated=today, date_name='Date', date_name_plural='Dates',
+        is_public=True)
+    cursor = connection.cursor()
+    logger.info('Creating %d NewsItems over %d days...' % (num_items, num_days))
+    start = time.time()
+    cursor.execute("""
+        INSERT INTO db_newsitem (schema_id, title, description, url, pub_date,
+                                 item_date, last_modification, location_name)
+        SELECT %s, 'benchmark item ' || i, '', '', now(),
+               current_date - (i %% %s), now(), ''
+        FROM generate_series(1, %s) AS i""",
+                   (schema.id, num_days, num_items))
+    # No geometries, so no NewsItemLocations from the triggers; add
+    # them ourselves.
+    cursor.execute("""
+        INSERT INTO db_newsitemlocation (news_item_id, location_id)
+        SELECT ni.id, (%s::int[])[1 + (random() * %s)::int %% %s]
+        FROM db_newsitem ni WHERE ni.schema_id = %s""",
+                   (location_ids, len(location_ids), len(location_ids), schema.id))
+    transaction.commit_unless_managed()
+    cursor.execute("ANALYZE db_newsitem")
+    cursor.execute("ANALYZE db_newsitemlocation")
+    logger.info('... took %.1f seconds' % (time.time() - start))
+
+    logger.info('Updating aggregates...')
+    start = time.time()
+    update_aggregates(schema.id)
+    logger.info('... took %.1f seconds' % (time.time() - start))
+    return schema
+
+
+def delete_items(schema):
+    """
+    Deletes the benchmark Schema and everything in it.  Uses SQL,
+    since the ORM would load all the NewsItems first.
+    """
+    logger.info('Deleting the benchmark schema...')
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE news_item_id IN (SELECT id FROM db_newsitem WHERE schema_id = %%s)"
+                   % NewsItemLocation._meta.db_table, (schema.id,))
+    cursor.execute("DELETE FROM %s WHERE schema_id = %%s" % NewsItem._meta.db_table, (schema.id,))
+    for model in (AggregateAll, AggregateDay, AggregateLocation, AggregateLocationDay,
+                  AggregateFieldLookup, AggregateChange):
+        cursor.execute("DELETE FROM %s WHERE schema_id = %%s" % model._meta.db_table, (schema.id,))
+    transaction.commit_unless_managed()
+    schema.delete()
+    transaction.commit_unless_managed()
+
+
+def _time(func, repeat):
+    # Returns the result of func() and a list of timings in seconds.
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return result, timings
+
+def _report(label, timings):
+    timings = sorted(timings)
+    logger.info('%-12s min %8.1f ms   median %8.1f ms   max %8.1f ms' % (
+            label, timings[0] * 1000, timings[len(timings) / 2] * 1000, timings[-1] * 1000))
+
+
+def benchmark(schema, num_days, location_ids, repeat=10, samples=10):
+    """
+    Times the live and aggregate date counts for ``samples`` random
+    Locations and date spans, ``repeat`` times each.  Returns a tuple
+    of (live timings, aggregate timings), and raises AssertionError if
+    they don't give the same counts.
+    """
+    live_timings, agg_timings = [], []
+    date_span = constants.DAYS_SHORT_AGGREGATE_TIMEDELTA
+    for i in range(samples):
+        location = Location.objects.get(id=random.choice(location_ids))
+        end_date = datetime.date.today() - datetime.timedelta(days=random.randrange(num_days))
+        start_date = end_date - date_span
+        filters = FilterChain(schema=schema)
+        filters.add('location', location)
+        filters.add('date', start_date, end_date)
+
+        def live():
+            return {schema.id: filters.apply().date_counts()}
+        def aggregated():
+            return get_date_counts(filters, start_date, end_date)
+
+        live_counts, timings = _time(live, repeat)
+        live_timings.extend(timings)
+        agg_counts, timings = _time(aggregated, repeat)
+        agg_timings.extend(timings)
+        live_counts = dict([(k, v) for (k, v) in live_counts.items() if v])
+        assert live_counts == agg_counts, 'Counts differ for %s from %s to %s: %r != %r' % (
+            location, start_date, end_date, live_counts, agg_counts)
+    return live_timings, agg_timings
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='''usage: %prog [options]
+
+Benchmarks live versus aggregate date counts on synthetic NewsItems.
+''')
+    optparser.add_option('-n', '--items', type='int', default=5000000,
+                         help='Number of NewsItems to create. Default 5000000.')
+    optparser.add_option('--days', type='int', default=3 * 365,
+                         help='Number of days to spread the items over. Default 1095.')
+    optparser.add_option('--locations', type='int', default=100,
+                         help='Maximum number of existing Locations to spread the items over. Default 100.')
+    optparser.add_option('-r', '--repeat', type='int', default=10,
+                         help='Times to repeat each query. Default 10.')
+    optparser.add_option('-s', '--samples', type='int', default=10,
+                         help='Number of random Locations and date spans to try. Default 10.')
+    optparser.add_option('-k', '--keep', action='store_true',
+                         help="Don't delete the items afterward; later runs will reuse them.")
+    add_verbosity_options(optparser)
+    opts, args = optparser.parse_args(argv)
+    setup_logging_from_opts(opts, logger)
+
+    location_ids = list(Location.objects.values_list('id', flat=True)[:opts.locations])
+    if not location_ids:
+        optparser.error('There are no Locations; import some first.')
+    try:
+        schema = Schema.objects.get(slug=SCHEMA_SLUG)
+        logger.info('Reusing existing items of schema %s' % SCHEMA_SLUG)
+    except Schema.DoesNotExist:
+        schema = create_items(opts.items, opts.days, location_ids)
+    try:
+        live_timings, agg_timings = benchmark(schema, opts.days, location_ids,
+                                              repeat=opts.repeat, samples=opts.samples)
+        _report('Live:', live_timings)
+        _report('Aggregates:', agg_timings)
+    finally:
+        if not opts.keep:
+            delete_items(schema)
+
+if __name__ == "__main__":
+    main()
@@ -22,12 +22,34 @@ attempts to geocode them based on their ``location_name``.
 
 Optionally provide a list of ``Schema.slug`` values to only geocode
 items of that schema.
+
+For big backlogs, see :py:func:`geocode_all` and the
+``geocode_newsitems`` management command, which work in parallel and
+can be resumed.
 """
 
 
+from django.db import connection, models, transaction
+from django.utils import simplejson
 from ebpub.db.models import NewsItem
 from ebpub.geocoder import SmartGeocoder, GeocodingException, AmbiguousResult, InvalidBlockButValidStreet
 from ebpub.geocoder.parser.parsing import ParsingError
+from ebpub.geocoder.cache import get_cache_stats
+import itertools
+import logging
+import os
+import time
+import traceback
+
+logger = logging.getLogger('ebpub.db.bin.geocode_newsitems')
+
+# How many NewsItems to geocode at once.
+BATCH_SIZE = 500
+
+# How many ids geocode_all() gives each worker at a time.
+CHUNK_SIZE = 5000
+
+COUNT_NAMES = ('geocoded', 'not_found', 'ambiguous', 'parse_error', 'invalid_block')
 
 def geocode(*schemas):
     """
@@ -36,9 +58,9 @@ def geocode(*schemas):
     If ``schemas`` are provided, only geocode NewsItems with that particular
     schema slug(s).
     """
-    geocoder = SmartGeocoder()
+    geocoder = SmartGeocoder(use_block_index=True)
     qs = NewsItem.objects.filter(location__isnull=True).order_by('-id')
-    if schemas is not None:
+    if schemas:
         print "Geocoding %s..." % ', '.join(schemas)
         qs = qs.filter(schema__slug__in=schemas)
     else:
@@ -50,30 +72,34 @@ def geocode(*schemas):
     parsing_error_count = 0
     invalid_block_count = 0
 
-    for ni in qs.iterator():
-        loc_name = ni.location_name
-        try:
-            add = geocoder.geocode(loc_name)
-        except InvalidBlockButValidStreet:
-            print '      invalid block but valid street: %s' % loc_name
-            invalid_block_count += 1
-        except AmbiguousResult:
-            print '      ambiguous: %s' % loc_name
-            ambiguous_count += 1
-        except GeocodingException:
-            print '      not found: %s' % loc_name
-            not_found_count += 1
-        except ParsingError:
-            print '      parse error: %s' % loc_name
-            parsing_error_count += 1
-        except:
-            raise
-        else:
-            ni.location = add['point']
-            ni.save()
-            print '%s (%s)' % (loc_name, ni.item_url())
-            geocoded_count += 1
-    else:
+    items = qs.iterator()
+    while True:
+        # Geocode a batch at a time; much faster than one by one.
+        batch = list(itertools.islice(items, BATCH_SIZE))
+        if not batch:
+            break
+        results = geocoder.geocode_many([ni.location_name for ni in batch])
+        for ni, add in zip(batch, results):
+            loc_name = ni.location_name
+            if isinstance(add, InvalidBlockButValidStreet):
+                print '      invalid block but valid street: %s' % loc_name
+                invalid_block_count += 1
+            elif isinstance(add, AmbiguousResult):
+                print '      ambiguous: %s' % loc_name
+                ambiguous_count += 1
+            elif isinstance(add, GeocodingException):
+                print '      not found: %s' % loc_name
+                not_found_count += 1
+            elif isinstance(add, ParsingError):
+                print '      parse error: %s' % loc_name
+                parsing_error_count += 1
+            else:
+                ni.location = add['point']
+                ni.save()
+                print '%s (%s)' % (loc_name, ni.item_url())
+                geocoded_count += 1
+    if not (geocoded_count or not_found_count or ambiguous_count
+            or parsing_error_count or invalid_block_count):
         print "No NewsItems with null locations found"
 
     print "------------------------------------------------------------------"
@@ -82,6 +108,208 @@ def geocode(*schemas):
     print "Ambiguous:      %s" % ambiguous_count
     print "Parse errors:   %s" % parsing_error_count
     print "Invalid blocks: %s" % invalid_block_count
+    stats = get_cache_stats()
+    print "Cache hits:     %s (%s in memory, %s shared, %s database; %s failures)" % (
+        stats['local_hits'] + stats['shared_hits'] + stats['db_hits'],
+        stats['local_hits'], stats['shared_hits'], stats['db_hits'], stats['failure_hits'])
+    print "Cache misses:   %s" % stats['misses']
+
+def _outcome(result):
+    # Which of COUNT_NAMES a geocode_many() result counts as.
+    if isinstance(result, InvalidBlockButValidStreet):
+        return 'invalid_block'
+    elif isinstance(result, AmbiguousResult):
+        return 'ambiguous'
+    elif isinstance(result, GeocodingException):
+        return 'not_found'
+    elif isinstance(result, ParsingError):
+        return 'parse_error'
+    return 'geocoded'
+
+
+def _update_locations(cursor, points):
+    """
+    Sets the locations of many NewsItems with one UPDATE.  ``points``
+    is a list of (id, Point) pairs.
+
+    The location_updater trigger still runs for each row, but within
+    the one statement, rather than one round trip and transaction per
+    NewsItem.
+    """
+    srid = NewsItem._meta.get_field('location').srid
+    values = []
+    params = []
+    for item_id, point in points:
+        values.append('(%s, ST_SetSRID(ST_GeomFromText(%s), %s))')
+        params.extend([item_id, point.wkt, point.srid or srid])
+    cursor.execute("""
+        UPDATE db_newsitem SET location = v.location, last_modification = now()
+        FROM (VALUES %s) AS v(id, location)
+        WHERE db_newsitem.id = v.id AND db_newsitem.location IS NULL"""
+                   % ', '.join(values), params)
+    return cursor.rowcount
+
+
+def geocode_chunk(args):
+    """
+    Geocodes the NewsItems with null locations, and ids from ``start``
+    up to (but not including) ``end``, and saves their locations.
+
+    Takes a single tuple of (start, end, schema slugs, dry_run) so it
+    can be used with multiprocessing.Pool.
+
+    Returns a tuple of (start, counts, error), where counts is a
+    dictionary keyed by COUNT_NAMES, and error is a formatted
+    traceback or None.
+    """
+    start, end, schemas, dry_run = args
+    counts = dict.fromkeys(COUNT_NAMES, 0)
+    try:
+        qs = NewsItem.objects.filter(location__isnull=True, id__gte=start, id__lt=end)
+        if schemas:
+            qs = qs.filter(schema__slug__in=schemas)
+        items = list(qs.values_list('id', 'location_name'))
+        # Each distinct location is only geocoded once per batch anyway,
+        # and writing every result to the GeocoderCache table would
+        # cost a query per item.
+        geocoder = SmartGeocoder(use_cache=False, use_block_index=True)
+        points = []
+        for i in range(0, len(items), BATCH_SIZE):
+            batch = items[i:i + BATCH_SIZE]
+            results = geocoder.geocode_many([name for (item_id, name) in batch])
+            for (item_id, name), result in zip(batch, results):
+                outcome = _outcome(result)
+                counts[outcome] += 1
+                if outcome == 'geocoded':
+                    points.append((item_id, result['point']))
+                else:
+                    logger.debug('%s: %r' % (outcome, name))
+        if points and not dry_run:
+            cursor = connection.cursor()
+            for i in range(0, len(points), BATCH_SIZE):
+                _update_locations(cursor, points[i:i + BATCH_SIZE])
+            transaction.commit_unless_managed()
+    except Exception:
+        transaction.rollback_unless_managed()
+        return (start, counts, traceback.format_exc())
+    return (start, counts, None)
+
+
+def _load_checkpoint(filename, schemas, chunk_size):
+    # Returns the saved progress if it's for the same job, else None.
+    if not (filename and os.path.exists(filename)):
+        return None
+    try:
+        state = simplejson.load(open(filename))
+    except ValueError:
+        logger.warn("Ignoring unreadable checkpoint file %s" % filename)
+        return None
+    if state.get('schemas') != sorted(schemas) or state.get('chunk_size') != chunk_size:
+        logger.warn("Ignoring checkpoint file %s, which is for a different job" % filename)
+        return None
+    return state
+
+
+def _save_checkpoint(filename, state):
+    # Write and rename, so an interruption can't leave half a file.
+    tmpname = filename + '.tmp'
+    out = open(tmpname, 'w')
+    simplejson.dump(state, out)
+    out.close()
+    os.rename(tmpname, filename)
+
+
+def geocode_all(schemas=(), jobs=1, chunk_size=CHUNK_SIZE, checkpoint=None,
+                restart=False, dry_run=False):
+    """
+    Geocodes all NewsItems with null locations (of the given schema
+    slugs, if any), in chunks of ``chunk_size`` ids, ``jobs`` chunks
+    at a time, each in its own process.
+
+    If ``checkpoint`` is a filename, progress is saved there after
+    each chunk; if it's interrupted, running it again with the same
+    arguments carries on where it left off.  ``restart`` ignores any
+    saved progress.
+
+    Returns a summary dictionary with the total of each of
+    COUNT_NAMES, plus 'chunks', 'failed_chunks' (a list of the first
+    ids of chunks that raised errors), and 'seconds'.
+    """
+    schemas = list(schemas or [])
+    started = time.time()
+    state = None
+    if checkpoint and not restart:
+        state = _load_checkpoint(checkpoint, schemas, chunk_size)
+    if state is None:
+        qs = NewsItem.objects.filter(location__isnull=True)
+        if schemas:
+            qs = qs.filter(schema__slug__in=schemas)
+        # Ids are fixed now, so items added while we work wait for
+        # the next run.
+        id_range = qs.aggregate(min_id=models.Min('id'), max_id=models.Max('id'))
+        state = {'schemas': sorted(schemas), 'chunk_size': chunk_size,
+                 'min_id': id_range['min_id'], 'max_id': id_range['max_id'],
+                 'done': [], 'counts': dict.fromkeys(COUNT_NAMES, 0),
+                 'seconds': 0.0}
+    else:
+        logger.info('Resuming; %d chunks already done' % len(state['done']))
+
+    tasks = []
+    if state['min_id'] is not None:
+        done = set(state['done'])
+        for start in range(state['min_id'], state['max_id'] + 1, chunk_size):
+            if start not in done:
+                tasks.append((start, start + chunk_size, schemas, dry_run))
+    logger.info('%d chunks of up to %d NewsItems to geocode' % (len(tasks), chunk_size))
+
+    # Load the block index now, so forked workers share it rather than
+    # each loading their own.
+    from ebpub.streets.blockindex import get_block_index
+    get_block_index()
+    if jobs > 1:
+        import multiprocessing
+        # The forked workers must not share our database connection,
+        # so close it; each process will open its own as needed.
+        connection.close()
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(geocode_chunk, tasks)
+    else:
+        pool = None
+        results = itertools.imap(geocode_chunk, tasks)
+
+    failed = []
+    seconds = state['seconds']
+    try:
+        for start, counts, error in results:
+            if error is not None:
+                # Nothing was saved, so it'll be tried again next time.
+                logger.error('Geocoding ids %d to %d failed:\n%s'
+                             % (start, start + chunk_size - 1, error))
+                failed.append(start)
+                continue
+            for name in COUNT_NAMES:
+                state['counts'][name] += counts[name]
+            state['done'].append(start)
+            state['seconds'] = seconds + time.time() - started
+            logger.info('Geocoded ids %d to %d: %s' % (
+                    start, start + chunk_size - 1,
+                    ', '.join(['%d %s' % (counts[name], name) for name in COUNT_NAMES])))
+            if checkpoint and not dry_run:
+                _save_checkpoint(checkpoint, state)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    summary = dict(state['counts'])
+    summary['chunks'] = len(state['done'])
+    summary['failed_chunks'] = failed
+    summary['seconds'] = round(seconds + time.time() - started, 1)
+    if checkpoint and not failed and not dry_run and os.path.exists(checkpoint):
+        # All done; next time, start afresh.
+        os.unlink(checkpoint)
+    return summary
+
 
 def main():
     import sys
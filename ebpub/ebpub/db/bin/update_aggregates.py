@@ -21,110 +21,223 @@
 Script to populate :ref:`aggregates`.
 Typically run without arguments.  The ``--reset`` option will delete
 all aggregates first.
+
+With ``--incremental``, only the days that have changed since the last
+run are recounted.  Database triggers record every NewsItem insert,
+delete, and change of ``schema`` or ``item_date``, and every
+NewsItemLocation change, in the
+:py:class:`AggregateChange <ebpub.db.models.AggregateChange>` log;
+the incremental update consumes that log.  This is much faster on
+large schemas, and is safe to run frequently from cron.  A full update
+(without ``--incremental``) also clears the log, so it's a good idea
+to still run one occasionally, eg. nightly.
+
+With ``--jobs N``, up to N schemas are updated in parallel, biggest
+first.  Each schema is locked while it's being updated, so overlapping
+cron runs skip it rather than doing the same work twice.
+
+The ``--check`` option recounts everything without changing anything,
+and reports any aggregate rows that don't match the actual data.
 """
 
 from django.db import connection, transaction
 from ebpub.db import constants
-from ebpub.db.models import Schema, SchemaField, NewsItem, AggregateAll, AggregateDay, AggregateLocationDay, AggregateLocation, AggregateFieldLookup
+from ebpub.db.models import Schema, SchemaField, NewsItem, AggregateAll, AggregateDay, AggregateLocationDay, AggregateLocation, AggregateFieldLookup, AggregateChange, NewsItemLookup
 from ebpub.utils.dates import today
 from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
+from cStringIO import StringIO
+import itertools
 import logging
+import time
+import traceback
 
 logger = logging.getLogger('ebpub.db.bin.update_aggregates')
 
-def smart_update(cursor, new_values, table_name, field_names, comparable_fields,
-                 where, pk_name='id', dry_run=False):
-    # new_values is a list of dictionaries, each with a value for each field in field_names.
+STAGING_TABLE = 'smart_update_staging'
 
-    # Run a query to determine the current values in the DB.
-    where = where.items()
-    cursor.execute("""
-        SELECT %s, %s
-        FROM %s
-        WHERE %s""" % (pk_name, ','.join(field_names), table_name,
-            ' AND '.join(['%s=%%s' % k for k, v in where])), tuple([v for k, v in where]))
-    old_values = dict([(tuple(row[1:len(comparable_fields)+1]), dict(zip((pk_name,)+field_names, row))) for row in cursor.fetchall()])
+def _copy_value(value):
+    # Formats one value for COPY's default text format.
+    if value is None:
+        return r'\N'
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    elif isinstance(value, bool):
+        value = value and 't' or 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    value = str(value)
+    for char, escaped in (('\\', '\\\\'), ('\t', r'\t'), ('\n', r'\n'), ('\r', r'\r')):
+        value = value.replace(char, escaped)
+    return value
+
+def _stage_values(cursor, new_values, table_name, field_names):
+    # Loads new_values into a temporary table with the same column
+    # types as the given fields of table_name, using a single COPY.
+    cursor.execute("CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s LIMIT 0"
+                   % (STAGING_TABLE, ', '.join(field_names), table_name))
+    buf = StringIO()
     for new_value in new_values:
-        key = tuple([new_value[i] for i in comparable_fields])
-        try:
-            old_value = old_values.pop(key)
-        except KeyError:
-            logger.debug(
-                "INSERT INTO %s (%s) VALUES (%s)" % (table_name, ', '.join(field_names + tuple([i[0] for i in where])), ', '.join([str(new_value[i]) for i in field_names] + [str(i[1]) for i in where])))
-            if not dry_run:
-                cursor.execute("INSERT INTO %s (%s) VALUES (%s)" % \
-                    (table_name, ', '.join(field_names + tuple([i[0] for i in where])), ','.join(['%s' for _ in tuple(field_names) + tuple(where)])),
-                    tuple([new_value[i] for i in field_names] + [i[1] for i in where]))
-        else:
-            for k, v in new_value.items():
-                if old_value[k] != v:
-                    logger.debug(
-                        "UPDATE %s SET %s WHERE %s=%s" % (table_name, ', '.join(['%s=%s' % (k, v) for k, v in new_value.items()]), pk_name, old_value[pk_name]))
-                    if not dry_run:
-                        new_value_tuple = new_value.items()
-                        cursor.execute("UPDATE %s SET %s WHERE %s=%%s" % \
-                            (table_name, ', '.join(['%s=%%s' % k for k, v in new_value_tuple]), pk_name),
-                            tuple([v for k, v in new_value_tuple] + [old_value[pk_name]]))
-                    break
-    for old_value in old_values.values():
-        logger.debug("DELETE FROM %s WHERE %s = %s" % (table_name, pk_name, old_value[pk_name]))
-        if not dry_run:
-            cursor.execute("DELETE FROM %s WHERE %s = %%s" % (table_name, pk_name), (old_value[pk_name],))
-
-def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
+        buf.write('\t'.join([_copy_value(new_value[f]) for f in field_names]))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_from(buf, STAGING_TABLE, columns=field_names)
+    cursor.execute("ANALYZE %s" % STAGING_TABLE)
+
+def smart_update(cursor, new_values, table_name, field_names, comparable_fields,
+                 where, pk_name='id', dry_run=False):
     """
-    Updates all Aggregate* tables for the given schema_id/slug,
-    deleting/updating the existing records if necessary.
+    Makes the rows of ``table_name`` that match ``where`` look like
+    ``new_values``, inserting, updating and deleting rows as needed.
 
-    If dry_run is True, then the records won't be updated -- only the SQL
-    will be output.
+    ``new_values`` is a list of dictionaries, each with a value for
+    each field in ``field_names``.  Rows are matched up by the
+    ``comparable_fields``.
 
-    If reset is True, then all aggregates for this schema will be deleted before
-    updating.
+    ``where`` is a dictionary of column names to values.  Inserted
+    rows get those values too.  A value may instead be a list or
+    tuple, meaning the column must be IN that list; such columns
+    must also be in ``field_names``.
+
+    This is set-based: the new values are loaded into a temporary
+    table with COPY, and reconciled with one UPDATE, one DELETE and
+    one INSERT, regardless of the number of rows.
+
+    Returns a tuple of (number inserted, number updated, number deleted).
+    In dry_run mode, nothing is changed, but the numbers are still
+    what *would* have been changed.
     """
-    logger.info('... %s' % schema_id_or_slug)
-    if not str(schema_id_or_slug).isdigit():
-        schema_id = Schema.objects.get(slug=schema_id_or_slug).id
+    # pk_name is no longer needed, but kept for backward compatibility.
+    fixed = [(k, v) for k, v in where.items() if not isinstance(v, (list, tuple))]
+    scoped = [(k, tuple(v)) for k, v in where.items() if isinstance(v, (list, tuple))]
+    for k, v in scoped:
+        if k not in field_names:
+            raise ValueError('%r has a list value in where, so it must be in field_names' % k)
+    target_where = ' AND '.join(['t.%s = %%s' % k for k, v in fixed] +
+                                ['t.%s IN %%s' % k for k, v in scoped]) or 'TRUE'
+    target_params = [v for k, v in fixed] + [v for k, v in scoped]
+    key_match = ' AND '.join(['t.%s = s.%s' % (k, k) for k in comparable_fields]) or 'TRUE'
+    other_fields = [f for f in field_names if f not in comparable_fields]
+    changed = ' OR '.join(['t.%s IS DISTINCT FROM s.%s' % (f, f) for f in other_fields])
+
+    _stage_values(cursor, new_values, table_name, field_names)
+
+    # Existing rows whose values changed.
+    if changed:
+        update_sql = "%s t SET %s FROM %s s WHERE %s AND %s AND (%s)" % (
+            table_name, ', '.join(['%s = s.%s' % (f, f) for f in other_fields]),
+            STAGING_TABLE, target_where, key_match, changed)
+        if dry_run:
+            cursor.execute("SELECT COUNT(*) FROM %s t, %s s WHERE %s AND %s AND (%s)" % (
+                    table_name, STAGING_TABLE, target_where, key_match, changed),
+                           target_params)
+            num_updated = cursor.fetchone()[0]
+        else:
+            cursor.execute("UPDATE " + update_sql, target_params)
+            num_updated = cursor.rowcount
     else:
-        schema_id = schema_id_or_slug
-    cursor = connection.cursor()
+        num_updated = 0
 
-    if reset and not dry_run:
-        for aggmodel in (AggregateAll, AggregateDay, AggregateLocation,
-                         AggregateLocationDay, AggregateFieldLookup):
-            logger.info('... deleting all %s for schema %s' % (aggmodel.__name__, schema_id_or_slug))
-            aggmodel.objects.filter(schema__id=schema_id).delete()
+    # Existing rows that have no new value.
+    delete_sql = "%s t WHERE %s AND NOT EXISTS (SELECT 1 FROM %s s WHERE %s)" % (
+        table_name, target_where, STAGING_TABLE, key_match)
+    if dry_run:
+        cursor.execute("SELECT COUNT(*) FROM " + delete_sql, target_params)
+        num_deleted = cursor.fetchone()[0]
+    else:
+        cursor.execute("DELETE FROM " + delete_sql, target_params)
+        num_deleted = cursor.rowcount
 
-    # AggregateAll
-    cursor.execute("SELECT COUNT(*) FROM db_newsitem WHERE schema_id = %s", (schema_id,))
-    new_values = [{'total': row[0]} for row in cursor.fetchall()]
-    smart_update(cursor, new_values, AggregateAll._meta.db_table, ('total',),
-                 (), {'schema_id': schema_id}, dry_run=dry_run)
+    # New values that have no existing row.
+    insert_from = "%s s WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE %s AND %s)" % (
+        STAGING_TABLE, table_name, target_where, key_match)
+    if dry_run:
+        cursor.execute("SELECT COUNT(*) FROM " + insert_from, target_params)
+        num_inserted = cursor.fetchone()[0]
+    else:
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+                table_name,
+                ', '.join(list(field_names) + [k for k, v in fixed]),
+                ', '.join(['s.%s' % f for f in field_names] + ['%s' for k, v in fixed]),
+                insert_from),
+                       [v for k, v in fixed] + target_params)
+        num_inserted = cursor.rowcount
 
-    # AggregateDay
+    cursor.execute("DROP TABLE %s" % STAGING_TABLE)
+    logger.debug('%s%s: %d inserted, %d updated, %d deleted' % (
+            dry_run and 'Dry run: ' or '', table_name, num_inserted, num_updated, num_deleted))
+    return (num_inserted, num_updated, num_deleted)
+
+
+def _add_counts(stats, model, counts):
+    # Accumulate smart_update() results per aggregate model name.
+    old = stats.get(model.__name__, (0, 0, 0))
+    stats[model.__name__] = tuple([a + b for a, b in zip(old, counts)])
+
+
+def _log_stats(stats):
+    for name, (inserted, updated, deleted) in sorted(stats.items()):
+        logger.info('...... %s: %d inserted, %d updated, %d deleted'
+                    % (name, inserted, updated, deleted))
+
+
+def _get_schema_id(schema_id_or_slug):
+    if not str(schema_id_or_slug).isdigit():
+        return Schema.objects.get(slug=schema_id_or_slug).id
+    return int(schema_id_or_slug)
+
+
+def _latest_change_id(cursor, schema_id):
+    cursor.execute("SELECT MAX(id) FROM %s WHERE schema_id = %%s" % AggregateChange._meta.db_table,
+                   (schema_id,))
+    return cursor.fetchone()[0]
+
+
+def _clear_changes(cursor, schema_id, max_change_id):
+    # Only delete the log rows we've already accounted for; anything
+    # logged while we were working will be picked up next time.
+    if max_change_id is None:
+        return
+    cursor.execute("DELETE FROM %s WHERE schema_id = %%s AND id <= %%s" % AggregateChange._meta.db_table,
+                   (schema_id, max_change_id))
+
+
+def _update_days(cursor, schema_id, dates, stats, dry_run=False):
+    # Recounts AggregateDay and AggregateLocationDay for the given days.
+    dates = tuple(dates)
+    if not dates:
+        return
     cursor.execute("""
         SELECT item_date, COUNT(*)
         FROM db_newsitem
-        WHERE schema_id = %s
-        GROUP BY 1""", (schema_id,))
+        WHERE schema_id = %s AND item_date IN %s
+        GROUP BY 1""", (schema_id, dates))
     new_values = [{'date_part': row[0], 'total': row[1]} for row in cursor.fetchall()]
-    smart_update(cursor, new_values, AggregateDay._meta.db_table, ('date_part', 'total'),
-                 ('date_part',), {'schema_id': schema_id}, dry_run=dry_run,
-                 )
+    _add_counts(stats, AggregateDay,
+                smart_update(cursor, new_values, AggregateDay._meta.db_table, ('date_part', 'total'),
+                             ('date_part',), {'schema_id': schema_id, 'date_part': dates},
+                             dry_run=dry_run))
 
-    # AggregateLocationDay
     cursor.execute("""
         SELECT nl.location_id, ni.item_date, loc.location_type_id, COUNT(*)
         FROM db_newsitemlocation nl, db_newsitem ni, db_location loc
         WHERE nl.news_item_id = ni.id
             AND ni.schema_id = %s
+            AND ni.item_date IN %s
             AND nl.location_id = loc.id
-        GROUP BY 1, 2, 3""", (schema_id,))
+        GROUP BY 1, 2, 3""", (schema_id, dates))
     new_values = [{'location_id': row[0], 'date_part': row[1], 'location_type_id': row[2], 'total': row[3]} for row in cursor.fetchall()]
-    smart_update(cursor, new_values, AggregateLocationDay._meta.db_table, ('location_id', 'date_part', 'location_type_id', 'total'),
-                 ('location_id', 'date_part', 'location_type_id'),
-                 {'schema_id': schema_id}, dry_run=dry_run,
-                 )
+    _add_counts(stats, AggregateLocationDay,
+                smart_update(cursor, new_values, AggregateLocationDay._meta.db_table,
+                             ('location_id', 'date_part', 'location_type_id', 'total'),
+                             ('location_id', 'date_part', 'location_type_id'),
+                             {'schema_id': schema_id, 'date_part': dates},
+                             dry_run=dry_run))
+
+
+def _update_recent_totals(cursor, schema_id, stats, dry_run=False):
+    # Updates AggregateLocation and AggregateFieldLookup, which only
+    # cover the most recent days, so they're cheap enough to always
+    # recompute.
 
     # AggregateLocation
     # This query is a bit clever -- we just sum up the totals created in a
@@ -152,11 +265,12 @@ def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
             GROUP BY 1, 2""" % AggregateLocationDay._meta.db_table,
                 (schema_id, start_date, end_date))
         new_values = [{'location_id': row[0], 'location_type_id': row[1], 'total': row[2]} for row in cursor.fetchall()]
-        smart_update(cursor, new_values, AggregateLocation._meta.db_table,
-                     ('location_id', 'location_type_id', 'total'),
-                     ('location_id', 'location_type_id'), {'schema_id': schema_id},
-                     dry_run=dry_run,
-                     )
+        _add_counts(stats, AggregateLocation,
+                    smart_update(cursor, new_values, AggregateLocation._meta.db_table,
+                                 ('location_id', 'location_type_id', 'total'),
+                                 ('location_id', 'location_type_id'), {'schema_id': schema_id},
+                                 dry_run=dry_run,
+                                 ))
 
     for sf in SchemaField.objects.filter(schema__id=schema_id, is_filter=True, is_lookup=True):
         try:
@@ -168,23 +282,26 @@ def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
 
         if sf.is_many_to_many_lookup():
             # AggregateFieldLookup
+            # Many-to-many values are normalized in NewsItemLookup.
+            # The outer join keeps zero counts for unused Lookups.
             cursor.execute("""
-                SELECT id, (
-                    SELECT COUNT(*) FROM db_attribute a, db_newsitem ni
-                    WHERE a.news_item_id = ni.id
-                        AND a.schema_id = %%s
+                SELECT l.id, COUNT(ni.id)
+                FROM db_lookup l
+                LEFT OUTER JOIN %s nl
+                    ON nl.lookup_id = l.id AND nl.schema_field_id = %%s
+                LEFT OUTER JOIN db_newsitem ni
+                    ON ni.id = nl.news_item_id
                         AND ni.schema_id = %%s
-                        AND a.%s ~ ('[[:<:]]' || db_lookup.id || '[[:>:]]')
                         AND ni.item_date BETWEEN %%s AND %%s
-                )
-                FROM db_lookup
-                WHERE schema_field_id = %%s""" % sf.real_name, (schema_id, schema_id, start_date, end_date, sf.id))
+                WHERE l.schema_field_id = %%s
+                GROUP BY 1""" % NewsItemLookup._meta.db_table, (sf.id, schema_id, start_date, end_date, sf.id))
             new_values = [{'lookup_id': row[0], 'total': row[1]} for row in cursor.fetchall()]
-            smart_update(cursor, new_values, AggregateFieldLookup._meta.db_table,
-                         ('lookup_id', 'total'), ('lookup_id',),
-                         {'schema_id': schema_id, 'schema_field_id': sf.id},
-                         dry_run=dry_run,
-                         )
+            _add_counts(stats, AggregateFieldLookup,
+                        smart_update(cursor, new_values, AggregateFieldLookup._meta.db_table,
+                                     ('lookup_id', 'total'), ('lookup_id',),
+                                     {'schema_id': schema_id, 'schema_field_id': sf.id},
+                                     dry_run=dry_run,
+                                     ))
         else:
             # AggregateFieldLookup
             cursor.execute("""
@@ -197,22 +314,272 @@ def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
                     AND ni.item_date BETWEEN %%s AND %%s
                 GROUP BY 1""" % (sf.real_name, sf.real_name), (schema_id, schema_id, start_date, end_date))
             new_values = [{'lookup_id': row[0], 'total': row[1]} for row in cursor.fetchall()]
-            smart_update(cursor, new_values, AggregateFieldLookup._meta.db_table,
-                         ('lookup_id', 'total'), ('lookup_id',),
-                         {'schema_id': schema_id, 'schema_field_id': sf.id},
-                         dry_run=dry_run)
+            _add_counts(stats, AggregateFieldLookup,
+                        smart_update(cursor, new_values, AggregateFieldLookup._meta.db_table,
+                                     ('lookup_id', 'total'), ('lookup_id',),
+                                     {'schema_id': schema_id, 'schema_field_id': sf.id},
+                                     dry_run=dry_run))
+
+
+def update_aggregates(schema_id_or_slug, dry_run=False, reset=False):
+    """
+    Updates all Aggregate* tables for the given schema_id/slug,
+    deleting/updating the existing records if necessary.
+
+    If dry_run is True, then nothing is written (and reset is
+    ignored), but the returned numbers are still those that would
+    have been inserted, updated and deleted.
+
+    If reset is True, then all aggregates for this schema will be deleted before
+    updating.
+
+    Returns a dictionary mapping aggregate model names to
+    (number inserted, number updated, number deleted) tuples.
+    """
+    logger.info('... %s' % schema_id_or_slug)
+    schema_id = _get_schema_id(schema_id_or_slug)
+    cursor = connection.cursor()
+    stats = {}
 
+    # Everything logged up to now will be accounted for by the full update.
+    max_change_id = _latest_change_id(cursor, schema_id)
+
+    if reset and not dry_run:
+        for aggmodel in (AggregateAll, AggregateDay, AggregateLocation,
+                         AggregateLocationDay, AggregateFieldLookup):
+            logger.info('... deleting all %s for schema %s' % (aggmodel.__name__, schema_id_or_slug))
+            aggmodel.objects.filter(schema__id=schema_id).delete()
+
+    # AggregateAll
+    cursor.execute("SELECT COUNT(*) FROM db_newsitem WHERE schema_id = %s", (schema_id,))
+    new_values = [{'total': row[0]} for row in cursor.fetchall()]
+    _add_counts(stats, AggregateAll,
+                smart_update(cursor, new_values, AggregateAll._meta.db_table, ('total',),
+                             (), {'schema_id': schema_id}, dry_run=dry_run))
+
+    # AggregateDay
+    cursor.execute("""
+        SELECT item_date, COUNT(*)
+        FROM db_newsitem
+        WHERE schema_id = %s
+        GROUP BY 1""", (schema_id,))
+    new_values = [{'date_part': row[0], 'total': row[1]} for row in cursor.fetchall()]
+    _add_counts(stats, AggregateDay,
+                smart_update(cursor, new_values, AggregateDay._meta.db_table, ('date_part', 'total'),
+                             ('date_part',), {'schema_id': schema_id}, dry_run=dry_run,
+                             ))
+
+    # AggregateLocationDay
+    cursor.execute("""
+        SELECT nl.location_id, ni.item_date, loc.location_type_id, COUNT(*)
+        FROM db_newsitemlocation nl, db_newsitem ni, db_location loc
+        WHERE nl.news_item_id = ni.id
+            AND ni.schema_id = %s
+            AND nl.location_id = loc.id
+        GROUP BY 1, 2, 3""", (schema_id,))
+    new_values = [{'location_id': row[0], 'date_part': row[1], 'location_type_id': row[2], 'total': row[3]} for row in cursor.fetchall()]
+    _add_counts(stats, AggregateLocationDay,
+                smart_update(cursor, new_values, AggregateLocationDay._meta.db_table, ('location_id', 'date_part', 'location_type_id', 'total'),
+                             ('location_id', 'date_part', 'location_type_id'),
+                             {'schema_id': schema_id}, dry_run=dry_run,
+                             ))
+
+    # AggregateLocation and AggregateFieldLookup
+    _update_recent_totals(cursor, schema_id, stats, dry_run=dry_run)
+
+    if not dry_run:
+        _clear_changes(cursor, schema_id, max_change_id)
+    transaction.commit_unless_managed()
+    _log_stats(stats)
+    return stats
+
+
+def update_aggregates_incremental(schema_id_or_slug, dry_run=False):
+    """
+    Like :py:func:`update_aggregates`, but only recounts the days
+    listed in the :py:class:`AggregateChange <ebpub.db.models.AggregateChange>`
+    log for this schema, then removes those log entries.
+
+    This assumes the aggregates were correct as of the last full
+    update; if in doubt, run :py:func:`check_aggregates` or do a full
+    update.
+
+    Returns a dictionary like that of :py:func:`update_aggregates`.
+    """
+    logger.info('... %s (incremental)' % schema_id_or_slug)
+    schema_id = _get_schema_id(schema_id_or_slug)
+    cursor = connection.cursor()
+    stats = {}
+
+    max_change_id = _latest_change_id(cursor, schema_id)
+    if max_change_id is not None:
+        cursor.execute("""
+            SELECT DISTINCT date_part FROM %s
+            WHERE schema_id = %%s AND id <= %%s
+            ORDER BY 1""" % AggregateChange._meta.db_table,
+                       (schema_id, max_change_id))
+        changed_dates = [row[0] for row in cursor.fetchall()]
+    else:
+        changed_dates = []
+    logger.debug('... %d changed days' % len(changed_dates))
+
+    # AggregateDay and AggregateLocationDay
+    _update_days(cursor, schema_id, changed_dates, stats, dry_run=dry_run)
+
+    # AggregateAll
+    # AggregateDay covers every NewsItem, so summing it is much cheaper
+    # than counting db_newsitem.
+    cursor.execute("SELECT COALESCE(SUM(total), 0) FROM %s WHERE schema_id = %%s" % \
+        AggregateDay._meta.db_table, (schema_id,))
+    new_values = [{'total': row[0]} for row in cursor.fetchall()]
+    _add_counts(stats, AggregateAll,
+                smart_update(cursor, new_values, AggregateAll._meta.db_table, ('total',),
+                             (), {'schema_id': schema_id}, dry_run=dry_run))
+
+    # AggregateLocation and AggregateFieldLookup
+    _update_recent_totals(cursor, schema_id, stats, dry_run=dry_run)
+
+    if not dry_run:
+        _clear_changes(cursor, schema_id, max_change_id)
     transaction.commit_unless_managed()
+    _log_stats(stats)
+    return stats
 
-def update_all_aggregates(dry_run=False, reset=False):
+
+def check_aggregates(schema_id_or_slug):
+    """
+    Compares the stored aggregates for the given schema_id/slug
+    against a full recount, without changing anything.
+
+    Returns a dictionary of aggregate model names to
+    (number missing, number wrong, number extra) tuples, only
+    including models that have discrepancies.  An empty dictionary
+    means the aggregates are consistent.  Run with verbose logging to
+    see the individual rows.
+    """
+    stats = update_aggregates(schema_id_or_slug, dry_run=True)
+    problems = dict([(name, counts) for (name, counts) in stats.items() if sum(counts)])
+    for name, (missing, wrong, extra) in sorted(problems.items()):
+        logger.warn('%s for schema %s: %d missing, %d wrong, %d extra rows'
+                    % (name, schema_id_or_slug, missing, wrong, extra))
+    return problems
+
+
+# Arbitrary first key for pg_try_advisory_lock(), so our locks don't
+# collide with anybody else's; the second key is the schema id.
+LOCK_NAMESPACE = 8147
+
+def _lock_schema(cursor, schema_id):
+    # Session-level lock, so it survives the commits done while updating.
+    cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (LOCK_NAMESPACE, schema_id))
+    return cursor.fetchone()[0]
+
+def _unlock_schema(cursor, schema_id):
+    cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (LOCK_NAMESPACE, schema_id))
+
+
+def _update_schema(args):
+    """
+    Updates aggregates for one schema, holding a lock so that no other
+    update_aggregates process can work on the same schema at the same
+    time.
+
+    Takes a single tuple of (schema_id, plural_name, dry_run, reset,
+    incremental) so it can be used with multiprocessing.Pool.
+
+    Returns a tuple of (plural_name, seconds elapsed, stats, error),
+    where stats is None if the schema was locked by another process,
+    and error is a formatted traceback or None.
+    """
+    schema_id, plural_name, dry_run, reset, incremental = args
+    start = time.time()
+    cursor = connection.cursor()
+    if not _lock_schema(cursor, schema_id):
+        logger.warn('%s aggregates are already being updated by another process; skipping'
+                    % plural_name)
+        return (plural_name, time.time() - start, None, None)
+    try:
+        try:
+            if dry_run:
+                logger.info('Dry run: Updating %s aggregates' % plural_name)
+            elif reset:
+                logger.info('Resetting all %s aggregates' % plural_name)
+            else:
+                logger.info('Updating %s aggregates' % plural_name)
+            if incremental and not reset:
+                stats = update_aggregates_incremental(schema_id, dry_run=dry_run)
+            else:
+                stats = update_aggregates(schema_id, dry_run=dry_run, reset=reset)
+        except Exception:
+            transaction.rollback_unless_managed()
+            return (plural_name, time.time() - start, None, traceback.format_exc())
+    finally:
+        _unlock_schema(cursor, schema_id)
+    return (plural_name, time.time() - start, stats, None)
+
+
+def _report_result(result):
+    # Logs the outcome of _update_schema(); returns False on error.
+    plural_name, elapsed, stats, error = result
+    if error is not None:
+        logger.error('Updating %s aggregates failed after %.1f seconds:\n%s'
+                     % (plural_name, elapsed, error))
+        return False
+    if stats is not None:
+        changed = sum([sum(counts) for counts in stats.values()])
+        logger.info('Updated %s aggregates in %.1f seconds; %d rows changed'
+                    % (plural_name, elapsed, changed))
+    return True
+
+
+def update_all_aggregates(dry_run=False, reset=False, incremental=False, jobs=1):
+    """
+    Updates aggregates for every schema, biggest schemas first.
+
+    If ``jobs`` is more than 1, that many schemas are updated in
+    parallel, each in its own process with its own database connection.
+
+    Returns True if all schemas were updated without errors.
+    """
+    # Schemas with the most NewsItems take longest, so start them first.
+    # We go by the last known total rather than counting them all again.
+    sizes = dict(AggregateAll.objects.values_list('schema_id', 'total'))
+    schemas = sorted(Schema.objects.values_list('id', 'plural_name'),
+                     key=lambda schema: sizes.get(schema[0], 0),
+                     reverse=True)
+    tasks = [(schema_id, name, dry_run, reset, incremental) for (schema_id, name) in schemas]
+
+    if jobs > 1:
+        import multiprocessing
+        # The forked workers must not share our database connection,
+        # so close it; each process will open its own as needed.
+        connection.close()
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(_update_schema, tasks)
+    else:
+        pool = None
+        results = itertools.imap(_update_schema, tasks)
+
+    ok = True
+    try:
+        for result in results:
+            ok = _report_result(result) and ok
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return ok
+
+def check_all_aggregates():
+    """
+    Runs :py:func:`check_aggregates` on every schema.
+    Returns True if all aggregates are consistent.
+    """
+    ok = True
     for schema in Schema.objects.all():
-        if dry_run:
-            logger.info('Dry run: Updating %s aggregates' % schema.plural_name)
-        elif reset:
-            logger.info('Resetting all %s aggregates' % schema.plural_name)
-        else:
-            logger.info('Updating %s aggregates' % schema.plural_name)
-        update_aggregates(schema.id, dry_run=dry_run, reset=reset)
+        if check_aggregates(schema.id):
+            ok = False
+    return ok
 
 def main(argv=None):
     import sys
@@ -226,6 +593,15 @@ Updates aggregate statistics for the given schema (default: all schemas).
     optparser.add_option('-r', '--reset', action='store_true',
                          help='Delete all aggregates before updating.')
 
+    optparser.add_option('-i', '--incremental', action='store_true',
+                         help='Only recount days that changed since the last update.')
+
+    optparser.add_option('-j', '--jobs', type='int', default=1,
+                         help='Number of schemas to update in parallel. Default 1.')
+
+    optparser.add_option('-c', '--check', action='store_true',
+                         help='Compare aggregates against a full recount and report differences; change nothing.')
+
     add_verbosity_options(optparser)
 
     optparser.add_option('-d', '--dry-run', action='store_true',
@@ -233,13 +609,30 @@ Updates aggregate statistics for the given schema (default: all schemas).
 
     opts, args = optparser.parse_args(argv)
 
+    if opts.reset and opts.incremental:
+        optparser.error("--reset and --incremental don't make sense together.")
 
     setup_logging_from_opts(opts, logger)
 
+    if opts.check:
+        if args:
+            ok = not check_aggregates(*args)
+        else:
+            ok = check_all_aggregates()
+        if not ok:
+            sys.exit(1)
+        return
+    # Note we don't return anything, since setuptools' console script
+    # wrapper would treat it as an exit status.
     if args:
-        return update_aggregates(*args, reset=opts.reset, dry_run=opts.dry_run)
+        schema = Schema.objects.get(id=_get_schema_id(args[0]))
+        ok = _report_result(_update_schema((schema.id, schema.plural_name, opts.dry_run,
+                                            opts.reset, opts.incremental)))
     else:
-        return update_all_aggregates(reset=opts.reset, dry_run=opts.dry_run)
+        ok = update_all_aggregates(reset=opts.reset, dry_run=opts.dry_run,
+                                   incremental=opts.incremental, jobs=opts.jobs)
+    if not ok:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -51,3 +51,8 @@ BLOCK_URL_REGEX = r'(\d{1,6})-(\d{1,6})([nsew]{1,2})?(?:-([nsew]{0,2}))?'
 
 # How long the Schema managers should cache allowed_schema_ids()
 ALLOWED_IDS_CACHE_TIME = 60 * 10
+
+# How often (in seconds) each process checks whether another process
+# has changed a Schema or SchemaField, and so empties its cache of
+# SchemaField info.
+SCHEMA_FIELD_CACHE_CHECK_INTERVAL = 10
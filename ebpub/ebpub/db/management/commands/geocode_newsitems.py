@@ -0,0 +1,72 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from ebpub.db.bin.geocode_newsitems import geocode_all, CHUNK_SIZE
+from optparse import make_option
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger('ebpub.db.bin.geocode_newsitems')
+
+DEFAULT_CHECKPOINT = os.path.join(tempfile.gettempdir(), 'openblock_geocode_newsitems.json')
+
+
+class Command(BaseCommand):
+    help = ('Geocode all NewsItems with no location, optionally only those of the '
+            'given schema slugs, in parallel. If interrupted, run it again with the '
+            'same arguments to resume.')
+    args = '[schema_slug ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-j', '--jobs', type='int', default=1,
+                    help='Number of worker processes. Default 1.'),
+        make_option('--chunk-size', type='int', default=CHUNK_SIZE,
+                    help='Number of NewsItem ids per chunk of work. Default %d.' % CHUNK_SIZE),
+        make_option('--checkpoint', default=DEFAULT_CHECKPOINT,
+                    help='File to save progress in. Default %s.' % DEFAULT_CHECKPOINT),
+        make_option('--restart', action='store_true', default=False,
+                    help='Ignore any saved progress and start from the beginning.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Geocode, but don't save any locations or progress."),
+        make_option('--summary',
+                    help='Also write the JSON summary to this file.'),
+        )
+
+    def handle(self, *schemas, **options):
+        if options['jobs'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--jobs and --chunk-size must be at least 1.')
+        verbosity = int(options.get('verbosity', 1))
+        logging.basicConfig()
+        logger.setLevel({0: logging.WARN, 1: logging.INFO}.get(verbosity, logging.DEBUG))
+        summary = geocode_all(schemas, jobs=options['jobs'],
+                              chunk_size=options['chunk_size'],
+                              checkpoint=options['checkpoint'],
+                              restart=options['restart'],
+                              dry_run=options['dry_run'])
+        output = simplejson.dumps(summary, indent=2, sort_keys=True)
+        if options['summary']:
+            out = open(options['summary'], 'w')
+            out.write(output + '\n')
+            out.close()
+        self.stdout.write(output + '\n')
+        if summary['failed_chunks']:
+            raise CommandError('%d chunks failed; run again to retry them.'
+                               % len(summary['failed_chunks']))
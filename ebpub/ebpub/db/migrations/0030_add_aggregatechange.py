@@ -0,0 +1,309 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding model 'AggregateChange'
+        db.create_table('db_aggregatechange', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('schema_id', self.gf('django.db.models.fields.IntegerField')(db_index=True)),
+            ('date_part', self.gf('django.db.models.fields.DateField')()),
+            ('changed', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+        ))
+        db.send_create_signal('db', ['AggregateChange'])
+
+        # Triggers that log which (schema, item_date) buckets need their
+        # aggregates recounted. See ebpub.db.bin.update_aggregates.
+        db.execute("""
+        CREATE OR REPLACE FUNCTION log_newsitem_aggregate_change() RETURNS TRIGGER AS $newsitem_agg_logger$
+            BEGIN
+                IF (TG_OP = 'INSERT') THEN
+                    INSERT INTO db_aggregatechange (schema_id, date_part, changed)
+                    VALUES (NEW.schema_id, NEW.item_date, now()); --
+                ELSIF (TG_OP = 'UPDATE') THEN
+                    IF (NEW.schema_id IS DISTINCT FROM OLD.schema_id
+                        OR NEW.item_date IS DISTINCT FROM OLD.item_date) THEN
+                        INSERT INTO db_aggregatechange (schema_id, date_part, changed)
+                        VALUES (OLD.schema_id, OLD.item_date, now()); --
+                        INSERT INTO db_aggregatechange (schema_id, date_part, changed)
+                        VALUES (NEW.schema_id, NEW.item_date, now()); --
+                    END IF; --
+                ELSIF (TG_OP = 'DELETE') THEN
+                    INSERT INTO db_aggregatechange (schema_id, date_part, changed)
+                    VALUES (OLD.schema_id, OLD.item_date, now()); --
+                    RETURN OLD; --
+                END IF; --
+                RETURN NEW; --
+            END; --
+        $newsitem_agg_logger$ LANGUAGE plpgsql; --
+        """)
+        db.execute("""
+        CREATE TRIGGER newsitem_agg_logger
+        AFTER INSERT OR UPDATE OR DELETE ON db_newsitem
+            FOR EACH ROW EXECUTE PROCEDURE log_newsitem_aggregate_change(); --
+        """)
+        db.execute("""
+        CREATE OR REPLACE FUNCTION log_newsitemlocation_aggregate_change() RETURNS TRIGGER AS $newsitemlocation_agg_logger$
+            BEGIN
+                -- The NewsItem row may already be gone if this is part of
+                -- a NewsItem delete; that's fine, the NewsItem trigger
+                -- logs the change in that case.
+                IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE') THEN
+                    INSERT INTO db_aggregatechange (schema_id, date_part, changed)
+                    SELECT schema_id, item_date, now() FROM db_newsitem WHERE id = NEW.news_item_id; --
+                END IF; --
+                IF (TG_OP = 'DELETE' OR TG_OP = 'UPDATE') THEN
+                    INSERT INTO db_aggregatechange (schema_id, date_part, changed)
+                    SELECT schema_id, item_date, now() FROM db_newsitem WHERE id = OLD.news_item_id; --
+                    RETURN OLD; --
+                END IF; --
+                RETURN NEW; --
+            END; --
+        $newsitemlocation_agg_logger$ LANGUAGE plpgsql; --
+        """)
+        db.execute("""
+        CREATE TRIGGER newsitemlocation_agg_logger
+        AFTER INSERT OR UPDATE OR DELETE ON db_newsitemlocation
+            FOR EACH ROW EXECUTE PROCEDURE log_newsitemlocation_aggregate_change(); --
+        """)
+
+
+    def backwards(self, orm):
+
+        db.execute("DROP TRIGGER newsitemlocation_agg_logger ON db_newsitemlocation;")
+        db.execute("DROP FUNCTION log_newsitemlocation_aggregate_change();")
+        db.execute("DROP TRIGGER newsitem_agg_logger ON db_newsitem;")
+        db.execute("DROP FUNCTION log_newsitem_aggregate_change();")
+
+        # Deleting model 'AggregateChange'
+        db.delete_table('db_aggregatechange')
+
+
+    models = {
+        'db.aggregateall': {
+            'Meta': {'object_name': 'AggregateAll'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'total': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'db.aggregatechange': {
+            'Meta': {'object_name': 'AggregateChange'},
+            'changed': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'date_part': ('django.db.models.fields.DateField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'schema_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        'db.aggregateday': {
+            'Meta': {'object_name': 'AggregateDay'},
+            'date_part': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'total': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'db.aggregatefieldlookup': {
+            'Meta': {'object_name': 'AggregateFieldLookup'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lookup': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Lookup']"}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'schema_field': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.SchemaField']"}),
+            'total': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'db.aggregatelocation': {
+            'Meta': {'object_name': 'AggregateLocation'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Location']"}),
+            'location_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.LocationType']"}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'total': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'db.aggregatelocationday': {
+            'Meta': {'object_name': 'AggregateLocationDay'},
+            'date_part': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Location']"}),
+            'location_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.LocationType']"}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'total': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'db.attribute': {
+            'Meta': {'object_name': 'Attribute'},
+            'bool01': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'bool02': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'bool03': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'bool04': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'bool05': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'date01': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'date02': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'date03': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'date04': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'date05': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'datetime01': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'datetime02': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'datetime03': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'datetime04': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'int01': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'int02': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'int03': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'int04': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'int05': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'int06': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'int07': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'news_item': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['db.NewsItem']", 'unique': 'True', 'primary_key': 'True'}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'text01': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'text02': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'time01': ('django.db.models.fields.TimeField', [], {'null': 'True', 'blank': 'True'}),
+            'time02': ('django.db.models.fields.TimeField', [], {'null': 'True', 'blank': 'True'}),
+            'varchar01': ('django.db.models.fields.CharField', [], {'max_length': '4096', 'null': 'True', 'blank': 'True'}),
+            'varchar02': ('django.db.models.fields.CharField', [], {'max_length': '4096', 'null': 'True', 'blank': 'True'}),
+            'varchar03': ('django.db.models.fields.CharField', [], {'max_length': '4096', 'null': 'True', 'blank': 'True'}),
+            'varchar04': ('django.db.models.fields.CharField', [], {'max_length': '4096', 'null': 'True', 'blank': 'True'}),
+            'varchar05': ('django.db.models.fields.CharField', [], {'max_length': '4096', 'null': 'True', 'blank': 'True'})
+        },
+        'db.dataupdate': {
+            'Meta': {'object_name': 'DataUpdate'},
+            'got_error': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'num_added': ('django.db.models.fields.IntegerField', [], {}),
+            'num_changed': ('django.db.models.fields.IntegerField', [], {}),
+            'num_deleted': ('django.db.models.fields.IntegerField', [], {}),
+            'num_skipped': ('django.db.models.fields.IntegerField', [], {}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'update_finish': ('django.db.models.fields.DateTimeField', [], {}),
+            'update_start': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        'db.location': {
+            'Meta': {'ordering': "('slug',)", 'unique_together': "(('slug', 'location_type'),)", 'object_name': 'Location'},
+            'area': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'null': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'display_order': ('django.db.models.fields.SmallIntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_mod_date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'null': 'True', 'blank': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.GeometryField', [], {'null': 'True'}),
+            'location_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.LocationType']"}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'normalized_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'population': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '32', 'db_index': 'True'}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'db.locationsynonym': {
+            'Meta': {'object_name': 'LocationSynonym'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Location']"}),
+            'normalized_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'pretty_name': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'db.locationtype': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'LocationType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_browsable': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_significant': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'plural_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'scope': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '32', 'db_index': 'True'})
+        },
+        'db.lookup': {
+            'Meta': {'ordering': "('slug',)", 'unique_together': "(('slug', 'schema_field'), ('code', 'schema_field'), ('name', 'schema_field'))", 'object_name': 'Lookup'},
+            'code': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'featured': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'schema_field': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.SchemaField']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '32', 'db_index': 'True'})
+        },
+        'db.newsitem': {
+            'Meta': {'ordering': "('title',)", 'object_name': 'NewsItem'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'item_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today', 'db_index': 'True', 'blank': 'True'}),
+            'last_modification': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.GeometryField', [], {'null': 'True', 'blank': 'True'}),
+            'location_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'location_object': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': "orm['db.Location']"}),
+            'location_set': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['db.Location']", 'null': 'True', 'through': "orm['db.NewsItemLocation']", 'blank': 'True'}),
+            'pub_date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True', 'blank': 'True'}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'url': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        },
+        'db.newsitemimage': {
+            'Meta': {'unique_together': "(('news_item', 'image'),)", 'object_name': 'NewsItemImage'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.files.ImageField', [], {'max_length': '256'}),
+            'news_item': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.NewsItem']"})
+        },
+        'db.newsitemlocation': {
+            'Meta': {'unique_together': "(('news_item', 'location'),)", 'object_name': 'NewsItemLocation'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Location']"}),
+            'news_item': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.NewsItem']"})
+        },
+        'db.schema': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'Schema'},
+            'allow_charting': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'allow_comments': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'allow_flagging': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'can_collapse': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'date_name': ('django.db.models.fields.CharField', [], {'default': "'Date'", 'max_length': '32'}),
+            'date_name_plural': ('django.db.models.fields.CharField', [], {'default': "'Dates'", 'max_length': '32'}),
+            'edit_window': ('django.db.models.fields.FloatField', [], {'default': '0.0', 'blank': 'True'}),
+            'has_newsitem_detail': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'importance': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'indefinite_article': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'is_event': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'is_special_report': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_updated': ('django.db.models.fields.DateField', [], {}),
+            'map_color': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'map_icon_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'min_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date(1970, 1, 1)'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'number_in_overview': ('django.db.models.fields.SmallIntegerField', [], {'default': '5'}),
+            'plural_name': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'short_description': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'short_source': ('django.db.models.fields.CharField', [], {'default': "'One-line description of where this information came from.'", 'max_length': '128', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '32', 'db_index': 'True'}),
+            'source': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'summary': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'update_frequency': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'uses_attributes_in_list': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'db.schemafield': {
+            'Meta': {'ordering': "('pretty_name',)", 'unique_together': "(('schema', 'real_name'), ('schema', 'name'))", 'object_name': 'SchemaField'},
+            'display': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'display_order': ('django.db.models.fields.SmallIntegerField', [], {'default': '10'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_charted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_filter': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_lookup': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_searchable': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.SlugField', [], {'max_length': '32', 'db_index': 'True'}),
+            'pretty_name': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'pretty_name_plural': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'real_name': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"})
+        },
+        'db.searchspecialcase': {
+            'Meta': {'object_name': 'SearchSpecialCase'},
+            'body': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'query': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'redirect_to': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['db']
@@ -273,6 +273,10 @@ You'll want to do this on a regular basis, depending on how often you update
 your data. **Some parts of the site (such as charts) will not be visible** until
 you populate the aggregates.
 
+On large sites, use ``update_aggregates --incremental`` for frequent
+updates; it only recounts days that have changed since the last run,
+as recorded in the :py:class:`AggregateChange` log.
+
 .. _future_events:
 
 Event-like News Types
@@ -369,6 +373,11 @@ the value to a string of comma-separated integers of the Lookup IDs:
 
     newsitem.attributes['property_type'] = '1,2,3'
 
+Behind the scenes, each of those ids is also stored as a
+:py:class:`NewsItemLookup` row, so that searching by many-to-many
+lookups can use indexes.  This happens automatically when you
+save via ``newsitem.attributes``.
+
 
 .. _featured_lookups:
 
@@ -430,7 +439,9 @@ from .fields import OpenblockImageField
 
 import datetime
 import logging
+import os
 import re
+import time
 
 logger = logging.getLogger('ebpub.db.models')
 
@@ -453,6 +464,101 @@ def get_valid_real_names():
             yield name
 
 
+# In-process cache of SchemaField information, keyed by schema id; see
+# schema_field_info().  It's emptied whenever a Schema or SchemaField
+# is saved or deleted.  Other processes find out about that via a
+# version number kept in the shared Django cache, which each process
+# checks at most every SCHEMA_FIELD_CACHE_CHECK_INTERVAL seconds.
+_schema_field_cache = {}
+_schema_field_cache_state = {'version': None, 'checked': 0}
+_schema_field_cache_version_key = 'schema_field_info_version'
+_schema_field_cache_version_time = 60 * 60 * 24 * 30
+
+
+def _new_schema_field_cache_version():
+    return '%f-%d' % (time.time(), os.getpid())
+
+
+def _check_schema_field_cache_version():
+    now = time.time()
+    state = _schema_field_cache_state
+    if now - state['checked'] < constants.SCHEMA_FIELD_CACHE_CHECK_INTERVAL:
+        return
+    state['checked'] = now
+    version = cache.get(_schema_field_cache_version_key)
+    if version is None:
+        # First process to get here (or the key expired); anybody
+        # who lost the race will pick up the winner's version.
+        cache.add(_schema_field_cache_version_key, _new_schema_field_cache_version(),
+                  _schema_field_cache_version_time)
+        version = cache.get(_schema_field_cache_version_key)
+    if version != state['version']:
+        _schema_field_cache.clear()
+        state['version'] = version
+
+
+def clear_schema_field_cache(sender=None, **kwargs):
+    """
+    Empties the cache used by :py:func:`schema_field_info`, in this
+    process and (via the Django cache) in all others.
+
+    This is done automatically whenever a Schema or SchemaField is
+    saved or deleted via the ORM.  Call it yourself if you change
+    SchemaFields some other way, eg. with raw SQL.
+    """
+    _schema_field_cache.clear()
+    version = _new_schema_field_cache_version()
+    cache.set(_schema_field_cache_version_key, version, _schema_field_cache_version_time)
+    _schema_field_cache_state['version'] = version
+    _schema_field_cache_state['checked'] = time.time()
+
+
+def schema_field_info(schema_id_list):
+    """
+    Given a list of schema IDs, returns a dictionary mapping each
+    schema_id to a dictionary of information about that schema's
+    SchemaFields, like::
+
+        {1: {'mapping': {u'crime_type': 'varchar01', u'crime_date': 'date01'},
+             'fields': {u'crime_type': {'id': 3, 'real_name': 'varchar01',
+                                        'is_lookup': True, 'datatype': 'varchar'},
+                        u'crime_date': {'id': 4, 'real_name': 'date01',
+                                        'is_lookup': False, 'datatype': 'date'}},
+             'm2m': {'varchar01': 3},
+             'schemafields': [<SchemaField ...>, <SchemaField ...>],
+             },
+        }
+
+    'mapping' is the name->real_name dictionary also returned by
+    :py:func:`field_mapping`; 'm2m' maps the real_name of each
+    many-to-many lookup field to its SchemaField id; and
+    'schemafields' is the list of SchemaField instances, ordered by
+    display_order.
+
+    Results are cached in-process, so this only hits the database
+    for schemas it hasn't seen since the last change to any Schema or
+    SchemaField.  Treat the return value as read-only.
+    """
+    _check_schema_field_cache_version()
+    schema_id_list = set(schema_id_list)
+    missing = [schema_id for schema_id in schema_id_list if schema_id not in _schema_field_cache]
+    if missing:
+        loaded = dict([(schema_id, {'mapping': {}, 'fields': {}, 'm2m': {}, 'schemafields': []})
+                       for schema_id in missing])
+        sfs = SchemaField.objects.filter(schema__id__in=missing).select_related('schema')
+        for sf in sfs.order_by('display_order'):
+            info = loaded[sf.schema_id]
+            info['mapping'][sf.name] = sf.real_name
+            info['fields'][sf.name] = {'id': sf.id, 'real_name': sf.real_name,
+                                       'is_lookup': sf.is_lookup, 'datatype': sf.datatype}
+            if sf.is_many_to_many_lookup():
+                info['m2m'][sf.real_name] = sf.id
+            info['schemafields'].append(sf)
+        _schema_field_cache.update(loaded)
+    return dict([(schema_id, _schema_field_cache[schema_id]) for schema_id in schema_id_list
+                 if schema_id in _schema_field_cache])
+
+
 def field_mapping(schema_id_list):
     """
     Given a list of schema IDs, returns a dictionary of dictionaries, mapping
@@ -462,13 +568,164 @@ def field_mapping(schema_id_list):
         {1: {u'crime_type': 'varchar01', u'crime_date', 'date01'},
          2: {u'permit_number': 'int01', 'to_date': 'date01'},
         }
+
+    Schemas with no SchemaFields are omitted.
     """
     result = {}
-    for sf in SchemaField.objects.filter(schema__id__in=(schema_id_list)).values('schema', 'name', 'real_name'):
-        result.setdefault(sf['schema'], {})[sf['name']] = sf['real_name']
+    for schema_id, info in schema_field_info(schema_id_list).items():
+        if info['mapping']:
+            result[schema_id] = dict(info['mapping'])
     return result
 
 
+def _field_info(schema_id):
+    # Returns a tuple of (mapping, m2m_fields) for one schema, where
+    # mapping is a name->real_name dictionary like those returned by
+    # field_mapping(), and m2m_fields maps the real_name of each
+    # many-to-many lookup field to its SchemaField id.  Cached; see
+    # schema_field_info().
+    info = schema_field_info([schema_id])[schema_id]
+    return info['mapping'], info['m2m']
+
+
+def parse_lookup_ids(value):
+    """
+    Given the value of a many-to-many lookup attribute -- a string of
+    comma-separated Lookup ids, eg. '1,2,3' -- returns a list of ints,
+    in the same order, without duplicates.  Anything that isn't an id
+    is ignored.
+    """
+    if not value:
+        return []
+    ids = []
+    for part in unicode(value).split(','):
+        part = part.strip()
+        if part.isdigit() and int(part) not in ids:
+            ids.append(int(part))
+    return ids
+
+
+def sync_newsitem_lookups(news_item_id, real_values, m2m_fields):
+    """
+    Updates the :py:class:`NewsItemLookup` rows for one NewsItem.
+
+    ``real_values`` is a dictionary of {real_name: value} for Attribute
+    columns that have just been saved; ``m2m_fields`` maps the
+    real_name of each many-to-many lookup field of the NewsItem's
+    schema to its SchemaField id (see ``_field_info()``).
+    Columns that aren't many-to-many lookups are ignored.
+
+    You don't normally need to call this; it's done automatically
+    when saving via ``newsitem.attributes``.
+    """
+    table = NewsItemLookup._meta.db_table
+    cursor = connection.cursor()
+    for real_name, sf_id in m2m_fields.items():
+        if real_name not in real_values:
+            continue
+        cursor.execute("DELETE FROM %s WHERE news_item_id = %%s AND schema_field_id = %%s" % table,
+                       (news_item_id, sf_id))
+        ids = parse_lookup_ids(real_values[real_name])
+        if not ids:
+            continue
+        # Skip ids that aren't Lookups for this field; the foreign key
+        # constraint would only complain at commit time.
+        cursor.execute("SELECT id FROM %s WHERE schema_field_id = %%s AND id IN %%s" % Lookup._meta.db_table,
+                       (sf_id, tuple(ids)))
+        existing = set([row[0] for row in cursor.fetchall()])
+        ids = [i for i in ids if i in existing]
+        if not ids:
+            continue
+        # Insert in the original order, so ordering by NewsItemLookup.id
+        # preserves it.
+        params = []
+        for lookup_id in ids:
+            params.extend([news_item_id, sf_id, lookup_id])
+        cursor.execute("INSERT INTO %s (news_item_id, schema_field_id, lookup_id) VALUES %s"
+                       % (table, ', '.join(['(%s, %s, %s)'] * len(ids))), params)
+
+
+def _insert_newsitems(newsitems):
+    # Inserts unsaved NewsItems with a single multi-row INSERT, and
+    # sets their ids.  Like Model.save(), but without signals.
+    fields = [f for f in NewsItem._meta.local_fields if not isinstance(f, models.AutoField)]
+    rows, params = [], []
+    for ni in newsitems:
+        placeholders = []
+        for f in fields:
+            value = f.get_db_prep_save(f.pre_save(ni, True), connection=connection)
+            if hasattr(f, 'get_placeholder'):
+                placeholders.append(f.get_placeholder(value, connection))
+            else:
+                placeholders.append('%s')
+            params.append(value)
+        rows.append('(%s)' % ', '.join(placeholders))
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO %s (%s) VALUES %s RETURNING id"
+                   % (NewsItem._meta.db_table, ', '.join([f.column for f in fields]),
+                      ', '.join(rows)), params)
+    # PostgreSQL returns the ids in VALUES order.
+    for ni, row in zip(newsitems, cursor.fetchall()):
+        ni.id = row[0]
+        ni._state.adding = False
+        ni._state.db = connection.alias
+
+
+def _insert_attributes(items):
+    # Given a list of (saved NewsItem, attributes dict) pairs, inserts
+    # their Attribute rows with one multi-row INSERT per Schema, and
+    # their NewsItemLookup rows with one more.
+    by_schema = {}
+    for ni, values in items:
+        if values is not None:
+            by_schema.setdefault(ni.schema_id, []).append((ni, values))
+    if not by_schema:
+        return
+    cursor = connection.cursor()
+    lookup_rows = []
+    for schema_id, schema_items in by_schema.items():
+        mapping, m2m_fields = _field_info(schema_id)
+        if not mapping:
+            if [values for ni, values in schema_items if values]:
+                logger.warn("Can't save non-empty attributes dict with an empty schema")
+            continue
+        mapping = mapping.items()
+        db_fields = [Attribute._meta.get_field(real_name) for name, real_name in mapping]
+        params = []
+        for ni, values in schema_items:
+            params.extend([ni.id, schema_id])
+            params.extend([f.get_db_prep_save(values.get(name, None), connection=connection)
+                           for f, (name, real_name) in zip(db_fields, mapping)])
+        cursor.execute("INSERT INTO %s (news_item_id, schema_id, %s) VALUES %s"
+                       % (Attribute._meta.db_table, ','.join([v for k, v in mapping]),
+                          ', '.join(['(%s)' % ','.join(['%s'] * (len(mapping) + 2))] * len(schema_items))),
+                       params)
+        for name, real_name in mapping:
+            if real_name not in m2m_fields:
+                continue
+            sf_id = m2m_fields[real_name]
+            ni_ids = [(ni.id, parse_lookup_ids(values.get(name, None))) for ni, values in schema_items]
+            all_ids = set()
+            for ni_id, ids in ni_ids:
+                all_ids.update(ids)
+            if not all_ids:
+                continue
+            # Skip ids that aren't Lookups for this field, as
+            # sync_newsitem_lookups() does.
+            cursor.execute("SELECT id FROM %s WHERE schema_field_id = %%s AND id IN %%s" % Lookup._meta.db_table,
+                           (sf_id, tuple(all_ids)))
+            existing = set([row[0] for row in cursor.fetchall()])
+            for ni_id, ids in ni_ids:
+                lookup_rows.extend([(ni_id, sf_id, i) for i in ids if i in existing])
+    if lookup_rows:
+        params = []
+        for row in lookup_rows:
+            params.extend(row)
+        cursor.execute("INSERT INTO %s (news_item_id, schema_field_id, lookup_id) VALUES %s"
+                       % (NewsItemLookup._meta.db_table, ', '.join(['(%s, %s, %s)'] * len(lookup_rows))),
+                       params)
+
+
 class SchemaQuerySet(models.query.GeoQuerySet):
 
     def update(self, *args, **kwargs):
@@ -967,8 +1224,9 @@ class AttributesDescriptor(object):
         if instance is None:
             raise AttributeError("%s must be accessed via instance" % self.__class__.__name__)
         if not hasattr(instance, '_attributes_cache'):
-            select_dict = field_mapping([instance.schema_id]).get(instance.schema_id, {})
-            instance._attributes_cache = AttributeDict(instance.id, instance.schema_id, select_dict)
+            select_dict, m2m_fields = _field_info(instance.schema_id)
+            instance._attributes_cache = AttributeDict(instance.id, instance.schema_id, select_dict,
+                                                       m2m_fields)
         return instance._attributes_cache
 
     def __set__(self, instance, value):
@@ -976,7 +1234,8 @@ class AttributesDescriptor(object):
             raise AttributeError("%s must be accessed via instance" % self.__class__.__name__)
         if not isinstance(value, dict):
             raise ValueError('Only a dictionary is allowed')
-        mapping = field_mapping([instance.schema_id]).get(instance.schema_id, {}).items()
+        mapping, m2m_fields = _field_info(instance.schema_id)
+        mapping = mapping.items()
         if not mapping:
             if value:
                 logger.warn("Can't save non-empty attributes dict with an empty schema")
@@ -996,6 +1255,9 @@ class AttributesDescriptor(object):
                 INSERT INTO %s (news_item_id, schema_id, %s)
                 VALUES (%%s, %%s, %s)""" % (Attribute._meta.db_table, ','.join([v for k, v in mapping]), ','.join(['%s' for k in mapping])),
                 [instance.id, instance.schema_id] + values)
+        if m2m_fields:
+            sync_newsitem_lookups(instance.id, dict(zip([v for k, v in mapping], values)),
+                                  m2m_fields)
         transaction.commit_unless_managed()
 
 
@@ -1009,11 +1271,12 @@ class AttributeDict(dict):
     # You normally don't instantiate this directly.
     # Just use news_item.attributes like a normal dictionary.
 
-    def __init__(self, news_item_id, schema_id, mapping):
+    def __init__(self, news_item_id, schema_id, mapping, m2m_fields=None):
         dict.__init__(self)
         self.news_item_id = news_item_id
         self.schema_id = schema_id
         self.mapping = mapping # name -> real_name dictionary
+        self.m2m_fields = m2m_fields # real_name -> SchemaField id, for many-to-many lookups
         self.cached = False
 
     def __do_query(self):
@@ -1048,23 +1311,39 @@ class AttributeDict(dict):
         return dict.__getitem__(self, name)
 
     def __setitem__(self, name, value):
+        self.set_many({name: value})
+
+    def set_many(self, values):
+        # Saves several attributes at once, in a single UPDATE (or
+        # INSERT), rather than one statement per key.
         # TODO: refactor, code overlaps largely with AttributesDescriptor.__set__
+        if not values:
+            return
+        real_values = dict([(self.mapping[name], value) for name, value in values.items()])
+        columns = real_values.keys()
+        params = [real_values[c] for c in columns]
         cursor = connection.cursor()
-        real_name = self.mapping[name]
         cursor.execute("""
             UPDATE %s
-            SET %s = %%s
+            SET %s
             WHERE news_item_id = %%s
-            """ % (Attribute._meta.db_table, real_name), [value, self.news_item_id])
+            """ % (Attribute._meta.db_table, ','.join(['%s=%%s' % c for c in columns])),
+                params + [self.news_item_id])
         # If no records were updated, that means the DB doesn't yet have a
         # row in the attributes table for this news item. Do an INSERT.
         if cursor.rowcount < 1:
             cursor.execute("""
                 INSERT INTO %s (news_item_id, schema_id, %s)
-                VALUES (%%s, %%s, %%s)""" % (Attribute._meta.db_table, real_name),
-                [self.news_item_id, self.schema_id, value])
+                VALUES (%%s, %%s, %s)""" % (Attribute._meta.db_table, ','.join(columns),
+                                            ','.join(['%s' for c in columns])),
+                [self.news_item_id, self.schema_id] + params)
+        if self.m2m_fields is None:
+            self.m2m_fields = _field_info(self.schema_id)[1]
+        if set(columns).intersection(self.m2m_fields):
+            sync_newsitem_lookups(self.news_item_id, real_values, self.m2m_fields)
         transaction.commit_unless_managed()
-        dict.__setitem__(self, name, value)
+        for name, value in values.items():
+            dict.__setitem__(self, name, value)
 
 
 class NewsItemQuerySet(models.query.GeoQuerySet):
@@ -1108,7 +1387,7 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
         Does not support comparisons other than simple equality testing.
         """
 
-        clone = self.prepare_attribute_qs()
+        clone = self._clone()
         real_name = str(schema_field.real_name)
         if isinstance(att_value, models.query.QuerySet):
             att_value = list(att_value)
@@ -1135,15 +1414,16 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
             for value in att_value:
                 if not str(value).isdigit():
                     raise ValueError('Only integer strings allowed for att_value in many-to-many SchemaFields; got %r' % value)
-            # We have to use a regular expression search to look for
-            # all rows with the given att_value *somewhere* in the
-            # column. The [[:<:]] thing is a word boundary, and the
-            # (?:) groups the possible values to distinguish them from
-            # the word boundary part of the regex.
-            pattern = '[[:<:]](?:%s)[[:>:]]' % '|'.join([str(val) for val in att_value])
-            clone = clone.extra(where=("db_attribute.%s ~ '%s'" % (real_name, pattern),))
-
-        elif None in att_value:
+            # Many-to-many values are normalized into NewsItemLookup,
+            # so this is an indexed semi-join; no need for db_attribute.
+            clone = clone.extra(
+                where=("db_newsitem.id IN (SELECT news_item_id FROM %s WHERE schema_field_id = %%s AND lookup_id IN (%s))"
+                       % (NewsItemLookup._meta.db_table, ','.join(['%s' for val in att_value])),),
+                params=tuple([schema_field.id] + [int(val) for val in att_value]))
+            return clone
+
+        clone = clone.prepare_attribute_qs()
+        if None in att_value:
             if att_value != [None]:
                 raise ValueError('by_attribute() att_value list cannot have more than one element if it includes None')
             clone = clone.extra(where=("db_attribute.%s IS NULL" % real_name,))
@@ -1170,45 +1450,23 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
         """
         real_name = "db_attribute." + str(schema_field.real_name)
         if schema_field.is_many_to_many_lookup():
-            # First prepare a subquery to get a *single* count of
-            # attribute rows that match each relevant m2m lookup
-            # value.  It's very important to get a single row here or
-            # else we get a DataBaseError with "more than one row
-            # returned by a subquery used as an expression". (Bug #146)
-            clone = self.prepare_attribute_qs()
-            clone = clone.filter(schema__id=schema_field.schema_id)
-            # This is a regex search for the lookup id.
-            clone = clone.extra(where=[real_name + " ~ ('[[:<:]]' || db_lookup.id || '[[:>:]]')"])
-            # We want to count the current queryset and get a single
-            # row for injecting into the subsequent Lookup query, but
-            # we don't want Django's aggregation support to
-            # automatically group by fields that aren't relevant and
-            # would cause multiple rows as a result. So we call
-            # `values()' on a field that we're already filtering by,
-            # in this case, schema, as essentially a harmless identify
-            # function.
-            # See http://docs.djangoproject.com/en/dev/topics/db/aggregation/#values
-            clone = clone.values('schema')
-
-            # Fix #146: Having any `ORDER BY foo` in this subquery causes
-            # Django to also add a `GROUP BY foo`, which potentially
-            # returns multiple rows. So, remove the ordering.
-            clone = clone.order_by()
-            clone = clone.annotate(count=Count('schema'))
-            # Unusual: We don't run the clone query, we just stuff its SQL
-            # into our Lookup qs.
-            qs = Lookup.objects.filter(schema_field__id=schema_field.id)
-            qs = qs.extra(select={'lookup_id': 'id', 'item_count': clone.values('count').query})
+            # Count the NewsItemLookup rows for the NewsItems in this
+            # QuerySet, grouped by Lookup.
+            # Removing the ordering keeps the subquery simple.
+            items = self.order_by().values('id')
+            qs = NewsItemLookup.objects.filter(schema_field__id=schema_field.id,
+                                               news_item__in=items)
+            qs = qs.values('lookup').annotate(item_count=Count('id')).order_by('-item_count')
+            ids_and_counts = [(v['lookup'], v['item_count']) for v in qs]
         else:
             # Counts of attribute rows matching each relevant Lookup.
-            # Much easier when is_many_to_many_lookup == False :-)
             qs = self.prepare_attribute_qs().extra(select={'lookup_id': real_name})
             qs.query.group_by = [real_name]
             qs = qs.values('lookup_id').annotate(item_count=Count('id'))
+            qs = qs.values('lookup_id', 'item_count').order_by('-item_count')
+            ids_and_counts = [(v['lookup_id'], v['item_count']) for v in qs
+                              if v['item_count']]
 
-        qs = qs.values('lookup_id', 'item_count').order_by('-item_count')
-        ids_and_counts = [(v['lookup_id'], v['item_count']) for v in qs
-                          if v['item_count']]
         ids_and_counts = ids_and_counts[:count]
         lookup_objs = Lookup.objects.in_bulk([i[0] for i in ids_and_counts])
         return [{'lookup': lookup_objs[i[0]], 'count': i[1]} for i in ids_and_counts
@@ -1279,6 +1537,35 @@ class NewsItemManager(models.GeoManager):
         """
         return self.get_query_set().by_request(request)
 
+    @transaction.commit_on_success
+    def bulk_create_with_attributes(self, items, batch_size=500):
+        """
+        Saves many new NewsItems and their attributes in one
+        transaction, using multi-row INSERT statements -- a handful of
+        queries per ``batch_size`` items, rather than several per item.
+
+        ``items`` is a list of ``(newsitem, attributes)`` pairs, where
+        ``newsitem`` is an unsaved NewsItem or a dictionary of keyword
+        arguments for creating one, and ``attributes`` is a dictionary
+        like you'd assign to ``newsitem.attributes`` (or None, to not
+        create an Attribute row at all).
+
+        Returns the list of NewsItems, with their ids set.
+
+        Note that unlike ``save()``, this doesn't send the ``pre_save``
+        or ``post_save`` signals.
+        """
+        pairs = []
+        for ni, attributes in items:
+            if isinstance(ni, dict):
+                ni = self.model(**ni)
+            pairs.append((ni, attributes))
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            _insert_newsitems([ni for ni, attributes in batch])
+            _insert_attributes(batch)
+        return [ni for ni, attributes in pairs]
+
 
 class NewsItem(models.Model):
     """
@@ -1381,7 +1668,7 @@ class NewsItem(models.Model):
         Return a list of AttributeForTemplate objects for this NewsItem. The
         objects are ordered by SchemaField.display_order.
         """
-        fields = SchemaField.objects.filter(schema__id=self.schema_id).select_related().order_by('display_order')
+        fields = schema_field_info([self.schema_id])[self.schema_id]['schemafields']
         if not fields:
             return []
         if not self.attributes:
@@ -1408,15 +1695,19 @@ class AttributeForTemplate(object):
                 self.values = [self.raw_value]
             elif (isinstance(self.raw_value, list) and self.raw_value
                   and isinstance(self.raw_value[0], Lookup)):
-                self.values = self.raw_values
-            elif self.raw_value is None or self.raw_value == '':
+                self.values = self.raw_value
+            elif self.raw_value is None or self.raw_value == '' or self.raw_value == []:
+                # No values, possibly preloaded as an empty list.
                 self.values = []
             elif self.sf.is_many_to_many_lookup():
-                try:
-                    id_values = map(int, self.raw_value.split(','))
-                except ValueError:
-                    self.values = []
+                news_item_id = getattr(attribute_row, 'news_item_id', None)
+                if news_item_id is not None:
+                    self.values = [nil.lookup for nil in NewsItemLookup.objects.filter(
+                            news_item__id=news_item_id, schema_field__id=self.sf.id
+                            ).select_related('lookup').order_by('id')]
                 else:
+                    # Not a real AttributeDict, so decode the ids ourselves.
+                    id_values = parse_lookup_ids(self.raw_value)
                     lookups = Lookup.objects.in_bulk(id_values)
                     self.values = [lookups[i] for i in id_values if i in lookups]
             else:
@@ -1628,24 +1919,15 @@ class LookupManager(models.Manager):
         template tag.
 
         """
-        # This uses several queries, not very efficient...
-        sf = SchemaField.objects.get(schema__id=newsitem.schema_id, name=attribute_key)
-        # Yet another manual decode of the comma-separated value,
-        # refs #265
-        if sf.is_many_to_many_lookup():
-            try:
-                value = newsitem.attributes.get(attribute_key, None)
-                if not value:
-                    ni_lookup_ids = []
-                else:
-                    ni_lookup_ids = [int(i) for i in value.split(',')]
-            except (KeyError, AttributeError):
-                # This item may be lacking an Attributes row entirely?
-                # Or the value may be None.
-                # Not sure when/how that happens, but it'll get fixed
-                # on any write to item.attributes, so don't worry
-                # about it here.
-                ni_lookup_ids = []
+        fields = schema_field_info([newsitem.schema_id])[newsitem.schema_id]['fields']
+        if attribute_key not in fields:
+            raise SchemaField.DoesNotExist('SchemaField matching query does not exist.')
+        sf = fields[attribute_key]
+        if sf['is_lookup'] and sf['datatype'] != 'int':
+            # No need to decode the comma-separated value, refs #265
+            return self.filter(featured=True,
+                               newsitemlookup__news_item__id=newsitem.id,
+                               newsitemlookup__schema_field__id=sf['id'])
         else:
             ni_lookup_ids = [newsitem.attributes[attribute_key]]
         featured = self.filter(featured=True, id__in=ni_lookup_ids)
@@ -1725,6 +2007,34 @@ class NewsItemLocation(models.Model):
         return u'%s - %s' % (self.news_item, self.location)
 
 
+class NewsItemLookup(models.Model):
+    """
+    Normalized storage of :ref:`many-to-many lookups <lookups>`: one row
+    per (:py:class:`NewsItem`, :py:class:`SchemaField`, :py:class:`Lookup`).
+
+    The comma-separated ids in the Attribute column remain the
+    canonical value, but can't be searched efficiently; this table
+    can be joined against with indexes, and is used by
+    :py:meth:`NewsItemQuerySet.by_attribute`,
+    :py:meth:`NewsItemQuerySet.top_lookups`, and the aggregates.
+
+    Normally you don't have to worry about creating these: they are
+    updated automatically whenever attributes are saved via
+    ``newsitem.attributes``, or by saving an :py:class:`Attribute`.
+    Rows are ordered (by id) the same way as the ids in the Attribute
+    column.
+    """
+    news_item = models.ForeignKey(NewsItem)
+    schema_field = models.ForeignKey(SchemaField)
+    lookup = models.ForeignKey(Lookup)
+
+    class Meta:
+        unique_together = (('news_item', 'schema_field', 'lookup'),)
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.news_item, self.lookup)
+
+
 #############################################################################
 # Aggregates.
 
@@ -1773,6 +2083,28 @@ class AggregateFieldLookup(AggregateBaseClass):
     lookup = models.ForeignKey(Lookup)
 
 
+class AggregateChange(models.Model):
+    """
+    Log of (schema, item_date) buckets whose aggregates may be out of date.
+
+    Rows are inserted by database triggers whenever a NewsItem is
+    inserted, deleted, or has its schema or item_date changed, and
+    whenever a NewsItemLocation is added or removed.  They are consumed
+    (and deleted) by ``update_aggregates --incremental``, which only
+    recounts the affected days.
+
+    ``schema_id`` is deliberately not a foreign key, so that deleting a
+    Schema (and, in cascade, its NewsItems) doesn't trip over log rows
+    inserted by the triggers during that same deletion.
+    """
+    schema_id = models.IntegerField(db_index=True)
+    date_part = models.DateField()
+    changed = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return u'schema %s on %s' % (self.schema_id, self.date_part)
+
+
 class SearchSpecialCase(models.Model):
     """
     Used as a fallback for location searches that don't match
@@ -1818,6 +2150,63 @@ class DataUpdate(models.Model):
     def total_time(self):
         return self.update_finish - self.update_start
 
+
+class ScraperFingerprint(models.Model):
+    """
+    A hash of content that a scraper has already processed, so that
+    it can skip content that hasn't changed since.  See
+    ebdata.retrieval.fingerprints.
+
+    ``kind`` is 'page' for list pages, keyed by the scraper name and
+    the page URL, or 'record' for scraped records, keyed by the schema
+    slug and a unique key for the record.
+
+    Delete rows to make scrapers process the content again.
+    """
+    KIND_CHOICES = (('page', 'List page'), ('record', 'Record'))
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    scope = models.CharField(
+        max_length=255,
+        help_text="Scraper name for list pages, schema slug for records.")
+    key = models.TextField(
+        help_text="Page URL for list pages, unique record key for records.")
+    digest = models.CharField(max_length=40, help_text="SHA-1 of the content.")
+    last_changed = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta(object):
+        unique_together = (('kind', 'scope', 'key'),)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.kind, self.scope, self.key)
+
+
+class TaskRun(models.Model):
+    """
+    One run of a scheduled task, eg. a scraper, by
+    ebdata.retrieval.updaterdaemon.scheduler.
+    """
+    task = models.CharField(max_length=255, db_index=True)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(
+        null=True, blank=True, help_text="Empty if the task is still running.")
+    pid = models.IntegerField(null=True, blank=True)
+    exit_status = models.IntegerField(
+        null=True, blank=True,
+        help_text="0 on success. Negative if the task was killed by a signal.")
+    timed_out = models.BooleanField(default=False)
+    num_added = models.IntegerField(
+        null=True, blank=True,
+        help_text="Number of items added, if the task returned it.")
+
+    def __unicode__(self):
+        return u'%s started on %s' % (self.task, self.started)
+
+    def total_time(self):
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+
 def get_city_locations():
     """
     If we have configured multiple_cities, find all Locations
@@ -1868,3 +2257,53 @@ def clear_allowed_schema_ids_cache(sender, **kwargs):
 post_update.connect(clear_allowed_schema_ids_cache, sender=Schema)
 post_save.connect(clear_allowed_schema_ids_cache, sender=Schema)
 post_delete.connect(clear_allowed_schema_ids_cache, sender=Schema)
+
+post_update.connect(clear_schema_field_cache, sender=Schema)
+post_save.connect(clear_schema_field_cache, sender=Schema)
+post_delete.connect(clear_schema_field_cache, sender=Schema)
+post_save.connect(clear_schema_field_cache, sender=SchemaField)
+post_delete.connect(clear_schema_field_cache, sender=SchemaField)
+
+
+def sync_lookups_on_attribute_save(sender, instance, **kwargs):
+    # Keep NewsItemLookup up to date for Attributes saved via the ORM,
+    # eg. in the admin UI or when loading fixtures.
+    mapping, m2m_fields = _field_info(instance.schema_id)
+    if m2m_fields:
+        real_values = dict([(real_name, getattr(instance, real_name))
+                            for real_name in m2m_fields])
+        sync_newsitem_lookups(instance.news_item_id, real_values, m2m_fields)
+
+post_save.connect(sync_lookups_on_attribute_save, sender=Attribute)
+
+
+def sync_lookups_on_fixture_load(sender, instance, raw=False, **kwargs):
+    # Fixtures may contain Attributes before the Lookups they refer to,
+    # in which case sync_lookups_on_attribute_save() couldn't link them.
+    # This does, for raw (ie. fixture) saves only; the regex scan is
+    # too slow for normal use.
+    if not raw:
+        return
+    cursor = connection.cursor()
+    cursor.execute("SELECT schema_id, real_name, is_lookup FROM %s WHERE id = %%s"
+                   % SchemaField._meta.db_table, (instance.schema_field_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    schema_id, real_name, is_lookup = row
+    if not is_lookup or real_name.startswith('int'):
+        return
+    table = NewsItemLookup._meta.db_table
+    cursor.execute("""
+        INSERT INTO %s (news_item_id, schema_field_id, lookup_id)
+        SELECT a.news_item_id, %%s, %%s
+        FROM %s a
+        WHERE a.schema_id = %%s
+            AND a.%s ~ ('[[:<:]]' || %%s || '[[:>:]]')
+            AND NOT EXISTS (SELECT 1 FROM %s nl WHERE nl.news_item_id = a.news_item_id
+                            AND nl.schema_field_id = %%s AND nl.lookup_id = %%s)
+        """ % (table, Attribute._meta.db_table, real_name, table),
+                   (instance.schema_field_id, instance.id, schema_id, str(instance.id),
+                    instance.schema_field_id, instance.id))
+
+post_save.connect(sync_lookups_on_fixture_load, sender=Lookup)
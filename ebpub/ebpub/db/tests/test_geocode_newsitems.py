@@ -0,0 +1,92 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Unit tests for db.bin.geocode_newsitems.
+"""
+
+from ebpub.utils.django_testcase_backports import TestCase
+from ebpub.db.models import NewsItem
+from django.utils import simplejson
+import mock
+import os
+import tempfile
+
+
+class TestGeocodeAll(TestCase):
+
+    fixtures = ('crimes.json', 'wabash.yaml')
+
+    def setUp(self):
+        NewsItem.objects.filter(id=1).update(location=None, location_name='200 S Wabash Ave')
+        NewsItem.objects.filter(id=2).update(location=None, location_name='100 Nowhere St')
+        fd, self.checkpoint = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.unlink(self.checkpoint)
+        self.patcher = mock.patch('ebpub.streets.models.get_metro')
+        mock_get_metro = self.patcher.start()
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+
+    def tearDown(self):
+        self.patcher.stop()
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+
+    def _geocode_all(self, **kwargs):
+        from ebpub.db.bin.geocode_newsitems import geocode_all
+        return geocode_all(checkpoint=self.checkpoint, **kwargs)
+
+    def test_geocode_all(self):
+        summary = self._geocode_all(chunk_size=1)
+        self.assertEqual(summary['geocoded'], 1)
+        self.assertEqual(summary['not_found'], 1)
+        self.assertEqual(summary['chunks'], 2)
+        self.assertEqual(summary['failed_chunks'], [])
+        self.assertNotEqual(NewsItem.objects.get(id=1).location, None)
+        self.assertEqual(NewsItem.objects.get(id=2).location, None)
+        # Finished, so there's nothing to resume.
+        self.failIf(os.path.exists(self.checkpoint))
+
+    def test_dry_run(self):
+        summary = self._geocode_all(dry_run=True)
+        self.assertEqual(summary['geocoded'], 1)
+        self.assertEqual(NewsItem.objects.get(id=1).location, None)
+
+    def test_resume(self):
+        # Pretend we were interrupted after doing the first chunk.
+        state = {'schemas': [], 'chunk_size': 1, 'min_id': 1, 'max_id': 2,
+                 'done': [1], 'counts': {'geocoded': 1, 'not_found': 0, 'ambiguous': 0,
+                                         'parse_error': 0, 'invalid_block': 0},
+                 'seconds': 1.0}
+        simplejson.dump(state, open(self.checkpoint, 'w'))
+        summary = self._geocode_all(chunk_size=1)
+        self.assertEqual(summary['chunks'], 2)
+        self.assertEqual(summary['geocoded'], 1)
+        self.assertEqual(summary['not_found'], 1)
+        # Item 1 was skipped.
+        self.assertEqual(NewsItem.objects.get(id=1).location, None)
+
+    def test_failed_chunk(self):
+        with mock.patch('ebpub.db.bin.geocode_newsitems._update_locations') as mock_update:
+            mock_update.side_effect = RuntimeError('oops')
+            summary = self._geocode_all(chunk_size=1)
+        self.assertEqual(summary['failed_chunks'], [1])
+        self.assertEqual(summary['geocoded'], 0)
+        # Progress is kept so the failed chunk can be retried.
+        self.assert_(os.path.exists(self.checkpoint))
@@ -276,3 +276,149 @@ class DatabaseExtensionsTestCase(TestCase):
         self.assertEqual(qs.count(), 1)
         qs = by_attribute(sf, ['999'], is_lookup=True)
         self.assertEqual(qs.count(), 0)
+
+    def test_newsitemlookups_loaded_from_fixture(self):
+        from ebpub.db.models import NewsItemLookup
+        nils = NewsItemLookup.objects.filter(news_item__id=1).order_by('id')
+        self.assertEqual([nil.lookup.slug for nil in nils], [u'tag-1', u'tag-2', u'tag-3'])
+
+    def test_set_m2m_attribute__updates_newsitemlookups(self):
+        from ebpub.db.models import NewsItemLookup
+        ni = NewsItem.objects.get(id=1)
+        # Ids that aren't Lookups for this field are ignored.
+        ni.attributes['tag'] = '73,71,12345'
+        nils = NewsItemLookup.objects.filter(news_item__id=1).order_by('id')
+        self.assertEqual([nil.lookup_id for nil in nils], [73, 71])
+        ni.attributes = dict(ni.attributes, tag='72')
+        nils = NewsItemLookup.objects.filter(news_item__id=1).order_by('id')
+        self.assertEqual([nil.lookup_id for nil in nils], [72])
+        ni.attributes['tag'] = None
+        self.assertEqual(NewsItemLookup.objects.filter(news_item__id=1).count(), 0)
+
+    def test_set_attribute__newsitemlookups_untouched(self):
+        from ebpub.db.models import NewsItemLookup
+        ni = NewsItem.objects.get(id=1)
+        ni.attributes['case_number'] = u'Hello'
+        self.assertEqual(NewsItemLookup.objects.filter(news_item__id=1).count(), 3)
+
+    def test_attribute_for_template__preloaded_empty_m2m(self):
+        from ebpub.db.models import AttributeForTemplate, SchemaField
+        sf = SchemaField.objects.select_related('schema').get(name='tag')
+        # As populate_attributes() leaves an item without tags.
+        with self.assertNumQueries(0):
+            self.assertEqual(AttributeForTemplate(sf, {'tag': []}).values, [])
+
+    def test_save_attribute__updates_newsitemlookups(self):
+        from ebpub.db.models import NewsItemLookup
+        att = Attribute.objects.get(news_item__id=3)
+        att.varchar04 = '72,73'
+        att.save()
+        nils = NewsItemLookup.objects.filter(news_item__id=3).order_by('id')
+        self.assertEqual([nil.lookup_id for nil in nils], [72, 73])
+
+    def test_bulk_create_with_attributes(self):
+        from django.db import connection
+        from ebpub.db.models import NewsItemLookup, Schema
+        schema = Schema.objects.get(id=1)
+        items = [({'schema': schema, 'title': u'Bulk %d' % i, 'location_name': u'Here',
+                   'item_date': datetime.date(2012, 1, i + 1)},
+                  {'case_number': u'bulk %d' % i, 'tag': '73,71,12345'})
+                 for i in range(5)]
+        items.append((NewsItem(schema=schema, title=u'Bulk no attributes',
+                               location_name=u'There'), None))
+        connection.queries = []
+        with self.settings(DEBUG=True):
+            newsitems = NewsItem.objects.bulk_create_with_attributes(items)
+            # SchemaFields, NewsItems, Attributes, Lookup check,
+            # NewsItemLookups.
+            self.assertEqual(len(connection.queries), 5)
+        connection.queries = []
+        self.assertEqual(len(newsitems), 6)
+        ni = NewsItem.objects.get(id=newsitems[2].id)
+        self.assertEqual(ni.title, u'Bulk 2')
+        self.assertEqual(ni.item_date, datetime.date(2012, 1, 3))
+        self.assertEqual(ni.attributes['case_number'], u'bulk 2')
+        self.assertEqual(ni.attributes['tag'], u'73,71,12345')
+        self.assertEqual(ni.attributes['crime_date'], None)
+        nils = NewsItemLookup.objects.filter(news_item__id=ni.id).order_by('id')
+        self.assertEqual([nil.lookup_id for nil in nils], [73, 71])
+        self.assertEqual(Attribute.objects.filter(news_item__id=newsitems[5].id).count(), 0)
+
+    def test_set_many_attributes(self):
+        from django.db import connection
+        ni = NewsItem.objects.get(id=1)
+        connection.queries = []
+        with self.settings(DEBUG=True):
+            ni.attributes.set_many({'case_number': u'Hello', 'crime_time': None})
+            # Field info, UPDATE.
+            self.assertEqual(len(connection.queries), 2)
+        connection.queries = []
+        ni = NewsItem.objects.get(id=1)
+        self.assertEqual(ni.attributes['case_number'], u'Hello')
+        self.assertEqual(ni.attributes['crime_date'], datetime.date(2006, 9, 19))
+
+    def test_parse_lookup_ids(self):
+        from ebpub.db.models import parse_lookup_ids
+        self.assertEqual(parse_lookup_ids(None), [])
+        self.assertEqual(parse_lookup_ids(''), [])
+        self.assertEqual(parse_lookup_ids('3,1, 2,,x,1'), [3, 1, 2])
+
+
+class SchemaFieldCacheTestCase(TestCase):
+
+    fixtures = ('crimes.json',)
+
+    def setUp(self):
+        from ebpub.db.models import clear_schema_field_cache
+        clear_schema_field_cache()
+
+    def test_field_mapping__cached(self):
+        from django.db import connection
+        from ebpub.db.models import field_mapping
+        connection.queries = []
+        with self.settings(DEBUG=True):
+            mapping = field_mapping([1])
+            self.assertEqual(mapping[1]['case_number'], 'varchar01')
+            self.assertEqual(len(connection.queries), 1)
+            self.assertEqual(field_mapping([1]), mapping)
+            self.assertEqual(len(connection.queries), 1)
+        connection.queries = []
+
+    def test_schema_field_info(self):
+        from ebpub.db.models import schema_field_info
+        info = schema_field_info([1, 12345])
+        self.assertEqual(info.keys(), [1])
+        self.assertEqual(info[1]['fields']['tag'],
+                         {'id': 13, 'real_name': 'varchar04', 'is_lookup': True,
+                          'datatype': 'varchar'})
+        self.assertEqual(info[1]['m2m'], {'varchar04': 13})
+        orders = [sf.display_order for sf in info[1]['schemafields']]
+        self.assertEqual(orders, sorted(orders))
+
+    def test_invalidated_on_save(self):
+        from ebpub.db.models import SchemaField, field_mapping
+        self.assertEqual(field_mapping([1])[1]['case_number'], 'varchar01')
+        sf = SchemaField.objects.get(schema__id=1, name='case_number')
+        sf.name = 'case_no'
+        sf.save()
+        self.assertEqual(field_mapping([1])[1].get('case_number'), None)
+        self.assertEqual(field_mapping([1])[1]['case_no'], 'varchar01')
+        sf.delete()
+        self.assertEqual(field_mapping([1])[1].get('case_no'), None)
+
+    def test_invalidated_by_other_process(self):
+        from django.core.cache import cache
+        from django.db import connection
+        from ebpub.db import models
+        models.field_mapping([1])
+        # Simulate another process changing a SchemaField.
+        cache.set(models._schema_field_cache_version_key, 'another process')
+        connection.queries = []
+        with self.settings(DEBUG=True):
+            models.field_mapping([1])
+            # Not checked again until the interval has passed.
+            self.assertEqual(len(connection.queries), 0)
+            models._schema_field_cache_state['checked'] = 0
+            models.field_mapping([1])
+            self.assertEqual(len(connection.queries), 1)
+        connection.queries = []
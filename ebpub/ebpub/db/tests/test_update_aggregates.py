@@ -0,0 +1,137 @@
+#   Copyright 2011 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Unit tests for db.bin.update_aggregates.
+"""
+
+from ebpub.utils.django_testcase_backports import TestCase
+from ebpub.db.models import NewsItem, AggregateAll, AggregateDay, AggregateChange
+import datetime
+import mock
+
+
+class TestUpdateAggregates(TestCase):
+
+    fixtures = ('crimes.json',)
+
+    def _update(self, **kwargs):
+        from ebpub.db.bin.update_aggregates import update_aggregates
+        return update_aggregates(1, **kwargs)
+
+    def _update_incremental(self, **kwargs):
+        from ebpub.db.bin.update_aggregates import update_aggregates_incremental
+        return update_aggregates_incremental(1, **kwargs)
+
+    def test_full_update(self):
+        stats = self._update()
+        self.assertEqual(AggregateAll.objects.get(schema__id=1).total, 3)
+        self.assertEqual(AggregateDay.objects.get(schema__id=1, date_part=datetime.date(2006, 11, 8)).total, 2)
+        self.assertEqual(stats['AggregateAll'], (1, 0, 0))
+        self.assertEqual(stats['AggregateDay'], (2, 0, 0))
+        # A second run changes nothing.
+        stats = self._update()
+        self.assertEqual(sum([sum(counts) for counts in stats.values()]), 0)
+
+    def test_full_update_clears_change_log(self):
+        self.assert_(AggregateChange.objects.filter(schema_id=1).count())
+        self._update()
+        self.assertEqual(AggregateChange.objects.filter(schema_id=1).count(), 0)
+
+    def test_dry_run(self):
+        stats = self._update(dry_run=True)
+        self.assertEqual(stats['AggregateAll'], (1, 0, 0))
+        self.assertEqual(AggregateAll.objects.filter(schema__id=1).count(), 0)
+
+    def test_changes_are_logged(self):
+        self._update()
+        ni = NewsItem.objects.get(id=1)
+        ni.item_date = datetime.date(2006, 9, 27)
+        ni.save()
+        dates = sorted(AggregateChange.objects.filter(schema_id=1).values_list('date_part', flat=True))
+        self.assertEqual(dates, [datetime.date(2006, 9, 26), datetime.date(2006, 9, 27)])
+        # Saving without changing the date doesn't log anything.
+        AggregateChange.objects.all().delete()
+        ni.title = 'new title'
+        ni.save()
+        self.assertEqual(AggregateChange.objects.count(), 0)
+
+    def test_incremental_update(self):
+        from ebpub.db.bin.update_aggregates import check_aggregates
+        self._update()
+        NewsItem.objects.get(id=2).delete()
+        ni = NewsItem.objects.get(id=1)
+        ni.item_date = datetime.date(2006, 11, 8)
+        ni.save()
+        self.assertNotEqual(check_aggregates(1), {})
+        stats = self._update_incremental()
+        self.assertEqual(AggregateAll.objects.get(schema__id=1).total, 2)
+        self.assertEqual(AggregateDay.objects.filter(schema__id=1, date_part=datetime.date(2006, 9, 26)).count(), 0)
+        self.assertEqual(AggregateDay.objects.get(schema__id=1, date_part=datetime.date(2006, 11, 8)).total, 2)
+        self.assertEqual(stats['AggregateDay'], (0, 0, 1))
+        self.assertEqual(check_aggregates(1), {})
+        self.assertEqual(AggregateChange.objects.filter(schema_id=1).count(), 0)
+
+    def test_incremental_update__nothing_changed(self):
+        self._update()
+        stats = self._update_incremental()
+        self.assertEqual(sum([sum(counts) for counts in stats.values()]), 0)
+
+    def test_smart_update__scoped_where(self):
+        from django.db import connection
+        from ebpub.db.bin.update_aggregates import smart_update
+        self._update()
+        cursor = connection.cursor()
+        # Only rows for the listed days are considered; other days are
+        # left alone even though they're not in new_values.
+        nov_8 = datetime.date(2006, 11, 8)
+        counts = smart_update(cursor, [{'date_part': nov_8, 'total': 5}],
+                              AggregateDay._meta.db_table, ('date_part', 'total'),
+                              ('date_part',), {'schema_id': 1, 'date_part': [nov_8]})
+        self.assertEqual(counts, (0, 1, 0))
+        self.assertEqual(AggregateDay.objects.get(schema__id=1, date_part=nov_8).total, 5)
+        self.assertEqual(AggregateDay.objects.filter(schema__id=1).count(), 2)
+
+    def test_copy_value(self):
+        from ebpub.db.bin.update_aggregates import _copy_value
+        self.assertEqual(_copy_value(None), r'\N')
+        self.assertEqual(_copy_value(datetime.date(2006, 11, 8)), '2006-11-08')
+        self.assertEqual(_copy_value(True), 't')
+        self.assertEqual(_copy_value(12), '12')
+        self.assertEqual(_copy_value(u'a\tb\\c\n'), r'a\tb\\c\n')
+
+    def test_update_all_aggregates(self):
+        from ebpub.db.bin.update_aggregates import update_all_aggregates
+        self.assertEqual(update_all_aggregates(), True)
+        self.assertEqual(AggregateAll.objects.get(schema__id=1).total, 3)
+
+    @mock.patch('ebpub.db.bin.update_aggregates._lock_schema')
+    def test_update_schema__locked(self, mock_lock):
+        from ebpub.db.bin.update_aggregates import _update_schema
+        mock_lock.return_value = False
+        name, elapsed, stats, error = _update_schema((1, u'Crimes', False, False, False))
+        self.assertEqual((stats, error), (None, None))
+        self.assertEqual(AggregateAll.objects.filter(schema__id=1).count(), 0)
+
+    @mock.patch('ebpub.db.bin.update_aggregates.update_aggregates')
+    def test_update_schema__error(self, mock_update):
+        from ebpub.db.bin.update_aggregates import _update_schema
+        mock_update.side_effect = ValueError('oops')
+        name, elapsed, stats, error = _update_schema((1, u'Crimes', False, False, False))
+        self.assertEqual(stats, None)
+        self.assert_('ValueError: oops' in error)
@@ -176,6 +176,7 @@ class TestAjaxViews(BaseTestCase):
         mock_chain().make_url.return_value = 'foo'
         mock_chain().schema.url.return_value = 'bar'
         mock_chain().apply.return_value = models.NewsItem.objects.all()
+        mock_chain().items.return_value = []
         url = urlresolvers.reverse('ajax-place-date-chart') + '?s=1&pid=b:1000.8'
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
@@ -213,6 +214,47 @@ class TestAjaxViews(BaseTestCase):
         self.assertEqual(len(items['features']), 3)
 
 
+class TestDateCounts(BaseTestCase):
+    fixtures = ('crimes.json',)
+
+    start_date = datetime.date(2006, 9, 1)
+    end_date = datetime.date(2006, 11, 30)
+    expected = {1: {datetime.date(2006, 9, 26): 1, datetime.date(2006, 11, 8): 2}}
+
+    def _get_date_counts(self, **kwargs):
+        from ebpub.db.schemafilters import FilterChain
+        from ebpub.db.views import get_date_counts
+        filters = FilterChain(schema=models.Schema.objects.get(slug='crime'))
+        for key, values in kwargs.items():
+            filters.add(key, *values)
+        return get_date_counts(filters, self.start_date, self.end_date)
+
+    def test_get_date_counts__no_aggregates(self):
+        self.assertEqual(self._get_date_counts(), self.expected)
+
+    def test_get_date_counts__from_aggregates(self):
+        from ebpub.db.bin.update_aggregates import update_aggregates
+        update_aggregates('crime')
+        self.assertEqual(self._get_date_counts(), self.expected)
+        # Prove it's really using the aggregates.
+        models.AggregateDay.objects.filter(date_part=datetime.date(2006, 11, 8)).update(total=99)
+        self.assertEqual(self._get_date_counts()[1][datetime.date(2006, 11, 8)], 99)
+        self.assertEqual(self._get_date_counts(date=[datetime.date(2006, 11, 1), datetime.date(2006, 11, 30)]),
+                         {1: {datetime.date(2006, 11, 8): 99}})
+        # ... but not for any other filters.
+        self.assertEqual(self._get_date_counts(pubdate=[self.start_date, self.end_date]),
+                         self.expected)
+
+    def test_get_date_counts__stale_aggregates(self):
+        from ebpub.db.bin.update_aggregates import update_aggregates
+        update_aggregates('crime')
+        models.AggregateDay.objects.all().update(total=99)
+        # Days with changes since the last update are counted live.
+        models.AggregateChange.objects.create(schema_id=1, date_part=datetime.date(2006, 11, 8))
+        self.assertEqual(self._get_date_counts(),
+                         {1: {datetime.date(2006, 9, 26): 99, datetime.date(2006, 11, 8): 2}})
+
+
 class TestSchemaFilterView(BaseTestCase):
 
     fixtures = ('test-schemafilter-views.json',)
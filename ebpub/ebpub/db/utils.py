@@ -21,7 +21,7 @@ from django.http import Http404
 from django.shortcuts import get_object_or_404
 from ebpub.db.models import AttributeDict
 from ebpub.db.models import Location
-from ebpub.db.models import field_mapping
+from ebpub.db.models import schema_field_info
 from ebpub.streets.models import Block
 from ebpub.streets.models import City
 from ebpub.metros.allmetros import get_metro
@@ -55,36 +55,68 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
 
     Note that the list is edited in place; there is no return value.
     """
-    from ebpub.db.models import Attribute, Lookup, SchemaField
+    schema_list = [s for s in schema_list if s.uses_attributes_in_list]
+    populate_attributes(newsitem_list, schema_list, get_lookups)
+
+
+def populate_attributes(newsitem_list, schema_list, get_lookups=True):
+    """
+    Like :py:func:`populate_attributes_if_needed`, but for all
+    NewsItems whose schemas are in ``schema_list``, regardless of
+    their ``uses_attributes_in_list``.  Useful when you know you'll be
+    displaying all the attributes, eg. in API responses.
+
+    NewsItems that have no attributes get an empty
+    ni.attributes, so accessing it won't hit the database either.
+    """
+    from ebpub.db.models import Attribute, Lookup, NewsItemLookup
     # To accomplish this, we determine which NewsItems in ni_list require
     # attribute prepopulation, and run a single DB query that loads all of the
     # attributes. Another way to do this would be to load all of the attributes
     # when loading the NewsItems in the first place (via a JOIN), but we want
     # to avoid joining such large tables.
 
-    preload_schema_ids = set([s.id for s in schema_list if s.uses_attributes_in_list])
+    preload_schema_ids = set([s.id for s in schema_list])
     if not preload_schema_ids:
         return
     preloaded_nis = [ni for ni in newsitem_list if ni.schema_id in preload_schema_ids]
     if not preloaded_nis:
         return
     # fmap is a mapping like:
-    # {schema_id: {'fields': [(name, real_name)], 'lookups': [real_name1, real_name2]}}
+    # {schema_id: {'fields': [(name, real_name)], 'lookups': [real_name1, real_name2],
+    #              'm2m': {real_name2: schema_field_id},
+    #              'mapping': {name: real_name}}}
     fmap = {}
     attribute_columns_to_select = set(['news_item'])
 
-    for sf in SchemaField.objects.filter(schema__id__in=[s.id for s in schema_list]).values('schema', 'name', 'real_name', 'is_lookup'):
-        fmap.setdefault(sf['schema'], {'fields': [], 'lookups': []})['fields'].append((sf['name'], sf['real_name']))
-        if sf['is_lookup']:
-            fmap[sf['schema']]['lookups'].append(sf['real_name'])
-        attribute_columns_to_select.add(str(sf['real_name']))
+    for schema_id, info in schema_field_info([s.id for s in schema_list]).items():
+        if not info['schemafields']:
+            continue
+        fmap[schema_id] = {'fields': [], 'lookups': [], 'm2m': info['m2m'],
+                           'mapping': info['mapping']}
+        for sf in info['schemafields']:
+            fmap[schema_id]['fields'].append((sf.name, sf.real_name))
+            if sf.is_lookup:
+                fmap[schema_id]['lookups'].append(sf.real_name)
+            attribute_columns_to_select.add(str(sf.real_name))
 
     att_dict = dict([(i['news_item'], i) for i in Attribute.objects.filter(news_item__id__in=[ni.id for ni in preloaded_nis]).values(*list(attribute_columns_to_select))])
 
     if not fmap:
         return
 
-    # Determine which Lookup objects need to be retrieved.
+    # Many-to-many lookups come from NewsItemLookup, in one query.
+    m2m_sf_ids = set()
+    for schema_fields in fmap.values():
+        m2m_sf_ids.update(schema_fields['m2m'].values())
+    m2m_lookups = {}
+    if m2m_sf_ids:
+        nils = NewsItemLookup.objects.filter(news_item__id__in=[ni.id for ni in preloaded_nis],
+                                             schema_field__id__in=list(m2m_sf_ids))
+        for nil in nils.select_related('lookup').order_by('id'):
+            m2m_lookups.setdefault((nil.news_item_id, nil.schema_field_id), []).append(nil.lookup)
+
+    # Determine which other Lookup objects need to be retrieved.
     lookup_ids = set()
     for ni in preloaded_nis:
         # Fix for #38: not all Schemas have SchemaFields, can be 100% vanilla.
@@ -98,11 +130,9 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
                 # then you might get some NewsItems that don't have a
                 # corresponding att_dict result.
                 continue
-            value = att_dict[ni.id][real_name]
-            if ',' in str(value):
-                lookup_ids.update(value.split(','))
-            else:
-                lookup_ids.add(value)
+            if real_name in fmap[ni.schema_id]['m2m']:
+                continue
+            lookup_ids.add(att_dict[ni.id][real_name])
 
     # Retrieve only the Lookups that are referenced in preloaded_nis.
     lookup_ids = [i for i in lookup_ids if i]
@@ -116,10 +146,14 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
         # Fix for #38: Schemas may not have any SchemaFields, and thus
         # the ni will have no attributes, and the schema won't be in
         # fmap, and that's OK.
-        if not ni.id in att_dict:
-            continue
         if not ni.schema_id in fmap:
             continue
+        if not ni.id in att_dict:
+            # No Attribute row (see above); there's nothing to load.
+            ni._attributes_cache = AttributeDict(ni.id, ni.schema_id, fmap[ni.schema_id]['mapping'],
+                                                 fmap[ni.schema_id]['m2m'])
+            ni._attributes_cache.cached = True
+            continue
 
         att = att_dict[ni.id]
         att_values = {}
@@ -129,13 +163,14 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
                 if value is None:
                     value = u''
                     continue
-                if real_name.startswith('int'):
+                if real_name in fmap[ni.schema_id]['m2m']:
+                    sf_id = fmap[ni.schema_id]['m2m'][real_name]
+                    value = m2m_lookups.get((ni.id, sf_id), [])
+                else:
                     value = lookup_objs[value]
-                else: # Many-to-many lookups are comma-separated strings.
-                    value = [lookup_objs[int(i)] for i in value.split(',') if i]
             att_values[field_name] = value
-        select_dict = field_mapping([ni.schema_id]).get(ni.schema_id, {})
-        ni._attributes_cache = AttributeDict(ni.id, ni.schema_id, select_dict)
+        ni._attributes_cache = AttributeDict(ni.id, ni.schema_id, fmap[ni.schema_id]['mapping'],
+                                             fmap[ni.schema_id]['m2m'])
         ni._attributes_cache.cached = True
         ni._attributes_cache.update(att_values)
 
@@ -144,6 +179,18 @@ def populate_schema(newsitem_list, schema):
         # TODO: This relies on undocumented Django APIs -- the "_schema_cache" name.
         ni._schema_cache = schema
 
+def populate_schemas(newsitem_list):
+    """
+    Like populate_schema(), for NewsItems of any number of Schemas,
+    which are fetched with one query.  Returns a {schema_id: Schema}
+    dictionary.
+    """
+    from ebpub.db.models import Schema
+    schemas = Schema.objects.in_bulk(list(set([ni.schema_id for ni in newsitem_list])))
+    for ni in newsitem_list:
+        populate_schema([ni], schemas[ni.schema_id])
+    return schemas
+
 
 def get_locations_near_place(place, block_radius=3):
     nearby = Location.objects.filter(location_type__is_significant=True)
@@ -20,7 +20,9 @@ from django.conf import settings
 from django.contrib.gis.shortcuts import render_to_kml
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db.models import Count
 from django.db.models import Q
+from django.db.models.query import QuerySet
 from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect, HttpResponsePermanentRedirect
@@ -34,11 +36,13 @@ from ebpub.constants import HIDE_ADS_COOKIE_NAME
 from ebpub.db import breadcrumbs
 from ebpub.db import constants
 from ebpub.db.models import AggregateDay, AggregateLocation, AggregateFieldLookup
+from ebpub.db.models import AggregateAll, AggregateChange, AggregateLocationDay
 from ebpub.db.models import NewsItem, Schema, SchemaField, LocationType, Location, SearchSpecialCase
 from ebpub.db.schemafilters import FilterError
 from ebpub.db.schemafilters import FilterChain
 from ebpub.db.schemafilters import BadAddressException
 from ebpub.db.schemafilters import BadDateException
+from ebpub.db.schemafilters import DateFilter, LocationFilter, SchemaFilter
 
 from ebpub.db.utils import populate_attributes_if_needed, populate_schema
 from ebpub.db.utils import url_to_place
@@ -77,6 +81,82 @@ def get_date_chart_agg_model(schemas, start_date, end_date, agg_model, kwargs=No
         counts.setdefault(agg.schema_id, {})[agg.date_part] = agg.total
     return get_date_chart(schemas, start_date, end_date, counts)
 
+def _get_aggregate_filters(filters):
+    # If the FilterChain only filters by things the Aggregate* tables
+    # are broken down by -- schema, Location and item_date -- returns
+    # (schema_ids, location or None, DateFilter or None).
+    # Otherwise returns None.
+    schema_ids = location = date_filter = None
+    for key, filt in filters.items():
+        # Exact types; eg. PubDateFilter is a DateFilter subclass.
+        if type(filt) is SchemaFilter:
+            schema_ids = [s.id for s in filt.schemas]
+            if filt.request:
+                allowed_schema_ids = get_schema_manager(filt.request).allowed_schema_ids()
+                schema_ids = [s_id for s_id in schema_ids if s_id in allowed_schema_ids]
+        elif type(filt) is LocationFilter and filt.location_object is not None:
+            location = filt.location_object
+        elif type(filt) is DateFilter:
+            date_filter = filt
+        else:
+            return None
+    if schema_ids is None:
+        return None
+    return schema_ids, location, date_filter
+
+def get_date_counts(filters, start_date, end_date):
+    """
+    Counts the NewsItems matching ``filters`` (a FilterChain) on each
+    day from start_date to end_date (*inclusive*).  Returns a nested
+    dictionary {schema_id: {date: count}}, as used by get_date_chart().
+
+    If the filters are only by schema, Location and/or item date,
+    this is answered from AggregateDay or AggregateLocationDay,
+    without touching the NewsItems.  Days whose aggregates may be out
+    of date (according to the AggregateChange log), and schemas whose
+    aggregates have never been computed, are still counted live.
+    Any other filters mean counting the matching NewsItems.
+    """
+    counts = {}
+    live_qs = filters.apply()
+    agg_filters = _get_aggregate_filters(filters)
+    if agg_filters is not None:
+        schema_ids, location, date_filter = agg_filters
+        if date_filter is not None:
+            start_date = max(start_date, date_filter.start_date)
+            end_date = min(end_date, date_filter.end_date)
+        if location is None:
+            agg_qs = AggregateDay.objects.all()
+        else:
+            agg_qs = AggregateLocationDay.objects.filter(location__id=location.id)
+        # update_aggregates always saves an AggregateAll, even if zero.
+        computed_ids = set(AggregateAll.objects.filter(schema__id__in=schema_ids).values_list('schema_id', flat=True))
+        stale_dates = {}
+        for schema_id, date in AggregateChange.objects.filter(
+            schema_id__in=computed_ids, date_part__range=(start_date, end_date)).values_list(
+            'schema_id', 'date_part').distinct():
+            stale_dates.setdefault(schema_id, set()).add(date)
+        for schema_id, date, total in agg_qs.filter(
+            schema__id__in=computed_ids, date_part__range=(start_date, end_date)).values_list(
+            'schema_id', 'date_part', 'total'):
+            if date not in stale_dates.get(schema_id, ()):
+                counts.setdefault(schema_id, {})[date] = total
+
+        # Whatever the aggregates can't answer.
+        live_q = [Q(schema__id__in=[s_id for s_id in schema_ids if s_id not in computed_ids])]
+        live_q += [Q(schema__id=schema_id, item_date__in=list(dates))
+                   for schema_id, dates in stale_dates.items()]
+        if len(computed_ids) == len(schema_ids) and not stale_dates:
+            return counts
+        live_qs = live_qs.filter(reduce(operator.or_, live_q))
+
+    live_qs = live_qs.filter(item_date__range=(start_date, end_date))
+    # As in NewsItemQuerySet.date_counts(), but by schema too.
+    live_qs = QuerySet.values(live_qs, 'schema', 'item_date').annotate(count=Count('id')).order_by()
+    for row in live_qs:
+        counts.setdefault(row['schema'], {})[row['item_date']] = row['count']
+    return counts
+
 def get_date_chart(schemas, start_date, end_date, counts):
     """
     Returns a list that's used to display a date chart for the given
@@ -200,8 +280,8 @@ def ajax_place_date_chart(request):
         start_date = end_date - date_span
 
     filters.add('date', start_date, end_date)
-    counts = filters.apply().date_counts()
-    date_chart = get_date_chart([schema], start_date, end_date, {schema.id: counts})[0]
+    counts = get_date_counts(filters, start_date, end_date)
+    date_chart = get_date_chart([schema], start_date, end_date, counts)[0]
     return render_to_response('db/snippets/date_chart.html', {
         'schema': schema,
         'date_chart': date_chart,
@@ -405,7 +485,9 @@ def search(request, schema_slug=''):
         elif result['type'] == 'location':
             return HttpResponseRedirect(url_prefix + getattr(result['result'], url_method)())
         elif result['type'] == 'place':
-            block, distance = geocoder.reverse.reverse_geocode(result['result'].location)
+            block = result['result'].nearest_block
+            if block is None:
+                raise geocoder.reverse.ReverseGeocodeError('No blocks near %s' % result['result'])
             return HttpResponseRedirect(url_prefix + getattr(block, url_method)())
 
         elif result['type'] == 'address':
@@ -486,7 +568,8 @@ def newsitem_detail(request, schema_slug, newsitem_id):
         if ni.location:
             # Try reverse-geocoding and see if we get a block.
             try:
-                block, distance = geocoder.reverse.reverse_geocode(ni.location)
+                block, distance = geocoder.reverse.reverse_geocode(
+                    ni.location, max_distance=geocoder.reverse.NEARBY_DISTANCE)
                 location_url = block.url()
             except geocoder.reverse.ReverseGeocodeError:
                 logger.error(
@@ -26,6 +26,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
 from ebpub.geocoder.parser.parsing import normalize, parse, ParsingError
 from ebpub.utils.text import address_to_block
+import copy
 import logging
 import re
 
@@ -127,60 +128,150 @@ class Geocoder(object):
         _do_geocode(self, location_string)
             Actually performs the geocoding. The base class implementation of
             geocode() calls this behind the scenes.
+
+    If ``use_block_index`` is True, blocks are looked up in the
+    in-memory :py:mod:`ebpub.streets.blockindex` rather than the
+    database; that's much faster when geocoding lots of addresses, but
+    the index takes a while to load at first.  Defaults to
+    ``settings.EBPUB_GEOCODER_BLOCK_INDEX``.
     """
-    def __init__(self, use_cache=True):
+    def __init__(self, use_cache=True, use_block_index=None):
         self.use_cache = use_cache
+        if use_block_index is None:
+            use_block_index = getattr(settings, 'EBPUB_GEOCODER_BLOCK_INDEX', False)
+        self.use_block_index = use_block_index
+        # A BlockIndex to use instead of the process-wide one, if any;
+        # see geocode_many().
+        self.block_index = None
+
+    def _get_block_index(self):
+        """
+        Returns the BlockIndex to look up blocks in, or None to query
+        the database.
+        """
+        if self.block_index is not None:
+            return self.block_index
+        if self.use_block_index:
+            from ebpub.streets.blockindex import get_block_index
+            return get_block_index()
+        return None
 
     def geocode(self, location):
         """
-        Geocodes the given location, handling caching behind the scenes.
+        Geocodes the given location, handling caching behind the scenes;
+        see :py:mod:`ebpub.geocoder.cache`.  Failures are cached too,
+        and raise the same exception again.
         """
         location = normalize(location)
         result, cache_hit = None, False
 
         # Get the result (an Address instance), either from the cache or by
         # calling _do_geocode().
-        # TODO: Why does this not use the normal Django caching
-        # framework?
         # Defer import to avoid cyclical imports.
-        from ebpub.geocoder.models import GeocoderCache
+        from ebpub.geocoder import cache as geocoder_cache
         if self.use_cache:
-            try:
-                cached = GeocoderCache.objects.filter(normalized_location=location)[0]
-            except IndexError:
-                pass
-            else:
-                logger.debug('GeocoderCache HIT for %r' % location)
-                result = Address.from_cache(cached)
+            result = geocoder_cache.get_result(location)
+            if result is not None:
+                logger.debug('Geocoder cache HIT for %r' % location)
                 cache_hit = True
 
         if result is None:
             try:
-                result = self._do_geocode(location)
-            except AmbiguousResult, e:
-                # If multiple results were found, check whether they have the
-                # same point. If they all have the same point, don't raise the
-                # AmbiguousResult exception -- just return the first one.
-                # 
-                # An edge case is if result['point'] is None. This could happen
-                # if the geocoder found locations, not points. In that case,
-                # just raise the AmbiguousResult.
-                result = e.choices[0]
-                if result['point'] is None:
-                    raise
-                for i in e.choices[1:]:
-                    if i['point'] != result['point']:
-                        raise
-                logger.debug('Got ambiguous results but all had same point, '
-                             'returning the first')
+                result = self._do_geocode_uncached(location)
+            except (GeocodingException, ParsingError), e:
+                if self.use_cache:
+                    logger.debug('caching failure for %r' % location)
+                    geocoder_cache.set_failure(location, e)
+                raise
         # Save the result to the cache if it wasn't in there already.
         if not cache_hit and self.use_cache:
             logger.debug('caching result for %r' % location)
-            GeocoderCache.populate(location, result)
+            geocoder_cache.set_result(location, result)
 
         logger.debug('geocoded: %r to %s' % (location, result))
         return result
 
+    def geocode_many(self, locations):
+        """
+        Geocodes a list of location strings.  Returns a list of the
+        same length and order, containing for each one either the
+        Address that geocode() would return, or the exception that it
+        would raise.
+
+        Duplicates (after normalizing) are only geocoded once; cached
+        results are fetched together; and the blocks on all the streets
+        the remaining locations might be on are loaded with one query,
+        rather than a few queries per location.
+        """
+        # Defer import to avoid cyclical imports.
+        from ebpub.geocoder import cache as geocoder_cache
+        normalized = [normalize(location) for location in locations]
+        unique = []
+        seen = set()
+        for location in normalized:
+            if location not in seen:
+                seen.add(location)
+                unique.append(location)
+
+        # {location: (True, Address) or (False, exception)}
+        entries = {}
+        if self.use_cache:
+            entries.update(geocoder_cache.get_entries(unique))
+        todo = [location for location in unique if location not in entries]
+
+        if todo:
+            old_block_index = self.block_index
+            if self._get_block_index() is None:
+                self.block_index = _batch_block_index(todo)
+            try:
+                for location in todo:
+                    try:
+                        result = self._do_geocode_uncached(location)
+                    except (GeocodingException, ParsingError), e:
+                        entries[location] = (False, e)
+                        if self.use_cache:
+                            geocoder_cache.set_failure(location, e)
+                    else:
+                        entries[location] = (True, result)
+                        if self.use_cache:
+                            geocoder_cache.set_result(location, result)
+            finally:
+                self.block_index = old_block_index
+
+        results = []
+        for location in normalized:
+            ok, value = entries[location]
+            if ok:
+                # Don't hand out the same Address twice.
+                value = copy.copy(value)
+            results.append(value)
+        return results
+
+    def _do_geocode_uncached(self, location):
+        """
+        Calls _do_geocode(), but returns the first result rather than
+        raising AmbiguousResult if all the results have the same point.
+        """
+        try:
+            return self._do_geocode(location)
+        except AmbiguousResult, e:
+            # If multiple results were found, check whether they have the
+            # same point. If they all have the same point, don't raise the
+            # AmbiguousResult exception -- just return the first one.
+            #
+            # An edge case is if result['point'] is None. This could happen
+            # if the geocoder found locations, not points. In that case,
+            # just raise the AmbiguousResult.
+            result = e.choices[0]
+            if result['point'] is None:
+                raise
+            for i in e.choices[1:]:
+                if i['point'] != result['point']:
+                    raise
+            logger.debug('Got ambiguous results but all had same point, '
+                         'returning the first')
+            return result
+
 
 class AddressGeocoder(Geocoder):
     """
@@ -209,10 +300,9 @@ class AddressGeocoder(Geocoder):
                 logger.debug('AddressGeocoder: checking for alternate spellings of %r'
                              % loc['street'])
                 try:
-                    misspelling = StreetMisspelling.objects.get(incorrect=loc['street'])
+                    loc['street'] = self._correct_spelling(loc['street'])
                     # TODO: stash away the original 'street' value for
                     # possible disambiguation later? ticket #295
-                    loc['street'] = misspelling.correct
                     logger.debug(' ... corrected to %r' % loc['street'])
                 except StreetMisspelling.DoesNotExist:
                     logger.debug(' ... no StreetMisspellings found.')
@@ -228,14 +318,7 @@ class AddressGeocoder(Geocoder):
                 # Next, try looking for the street, in case the street
                 # (without any suffix) exists but the address doesn't.
                 if not loc_results and loc['number']:
-                    kwargs = {'street': loc['street']}
-                    sided_filters = []
-                    if loc['city']:
-                        city_filter = Q(left_city=loc['city']) | Q(right_city=loc['city'])
-                        sided_filters.append(city_filter)
-                    # Defer this to avoid import cycle.
-                    from ebpub.streets.models import Block
-                    b_list = Block.objects.filter(*sided_filters, **kwargs).order_by('predir', 'from_num', 'to_num')
+                    b_list = self._street_blocks(loc['street'], loc['city'])
                     if b_list:
                         # We got some blocks with the bare street name.
                         # Might be InvalidBlockButValidStreet, but we don't
@@ -261,6 +344,49 @@ class AddressGeocoder(Geocoder):
         else:
             raise AmbiguousResult(all_results)
 
+    def _correct_spelling(self, street):
+        """
+        Returns the correct spelling of the street name, or raises
+        StreetMisspelling.DoesNotExist.
+
+        Known misspellings come from StreetMisspelling; failing that,
+        from fuzzy matching against all the street names, per
+        :py:func:`ebpub.streets.fuzzy.correct_street_name`.
+        """
+        # Defer import to avoid cyclical import.
+        from ebpub.streets.fuzzy import correct_street_name
+        from ebpub.streets.models import StreetMisspelling
+        index = self._get_block_index()
+        if index is not None:
+            correct = index.correct_spelling(street)
+        else:
+            try:
+                correct = StreetMisspelling.objects.get(incorrect=street).correct
+            except StreetMisspelling.DoesNotExist:
+                correct = None
+        if correct is None:
+            correct = correct_street_name(street)
+            if correct is None:
+                raise StreetMisspelling.DoesNotExist
+            logger.debug('Fuzzy matched street %r to %r' % (street, correct))
+        return correct
+
+    def _street_blocks(self, street, city=None):
+        """
+        Returns the Blocks on the given street (and in the given city,
+        if any), ordered by predir, from_num and to_num.
+        """
+        index = self._get_block_index()
+        if index is not None:
+            return index.street_blocks(street, city)
+        kwargs = {'street': street}
+        sided_filters = []
+        if city:
+            city_filter = Q(left_city=city) | Q(right_city=city)
+            sided_filters.append(city_filter)
+        # Defer this to avoid import cycle.
+        from ebpub.streets.models import Block
+        return Block.objects.filter(*sided_filters, **kwargs).order_by('predir', 'from_num', 'to_num')
 
     def _db_lookup(self, location):
         """
@@ -271,11 +397,16 @@ class AddressGeocoder(Geocoder):
         if not location['number']:
             return []
 
-        # Query the blocks database.
-        try:
+        # Query the blocks database, or the index.
+        index = self._get_block_index()
+        if index is not None:
+            search = index.search
+        else:
             # Defer this to avoid import cycle.
             from ebpub.streets.models import Block
-            blocks = Block.objects.search(
+            search = Block.objects.search
+        try:
+            blocks = search(
                 street=location['street'],
                 number=location['number'],
                 predir=location['pre_dir'],
@@ -410,16 +541,60 @@ class SmartGeocoder(Geocoder):
     def _do_geocode(self, location_string):
         if intersection_re.search(location_string):
             logger.debug('%r looks like an intersection' % location_string)
-            geocoder = IntersectionGeocoder()
+            geocoder = IntersectionGeocoder(use_block_index=self.use_block_index)
         elif block_re.search(location_string):
             logger.debug('%r looks like a block' % location_string)
-            geocoder = BlockGeocoder()
+            geocoder = BlockGeocoder(use_block_index=self.use_block_index)
         else:
             logger.debug('%r assumed to be an address' % location_string)
-            geocoder = AddressGeocoder()
+            geocoder = AddressGeocoder(use_block_index=self.use_block_index)
+        geocoder.block_index = self.block_index
         return geocoder._do_geocode(location_string)
 
 
+def _candidate_streets(location_string):
+    """
+    Returns a set of the street names that geocoding the (normalized)
+    location_string might look for blocks on.
+    """
+    m = block_re.search(location_string)
+    if m:
+        strings = [' '.join(m.groups())]
+    else:
+        strings = [location_string] + intersection_re.split(location_string)
+    streets = set()
+    for string in strings:
+        try:
+            locations = parse(string)
+        except ParsingError:
+            continue
+        streets.update([loc['street'] for loc in locations if loc['street']])
+    return streets
+
+
+def _batch_block_index(location_strings):
+    """
+    Returns a BlockIndex of just the blocks that might be needed to
+    geocode all the (normalized) location_strings, including those on
+    the correct spellings of any misspelled streets.
+    """
+    # Defer import to avoid cyclical import.
+    from ebpub.streets.blockindex import BlockIndex
+    from ebpub.streets.fuzzy import correct_street_name
+    from ebpub.streets.models import StreetMisspelling
+    streets = set()
+    for location_string in location_strings:
+        streets.update(_candidate_streets(location_string))
+    if streets:
+        corrections = dict(StreetMisspelling.objects.filter(
+                incorrect__in=list(streets)).values_list('incorrect', 'correct'))
+        for street in list(streets):
+            correct = corrections.get(street) or correct_street_name(street)
+            if correct:
+                streets.add(correct)
+    return BlockIndex(streets=streets)
+
+
 def full_geocode(query, search_places=True, convert_to_block=True, guess=False,
                  **disambiguation_kwargs):
     """
@@ -440,7 +615,8 @@ def full_geocode(query, search_places=True, convert_to_block=True, guess=False,
 
     * 'location' -- in which case result is a Location object.
     * 'place' -- in which case result is a Place object. (This is only
-      possible if search_places is True.)
+      possible if search_places is True.)  Each Place also gets a
+      ``nearest_block`` attribute: the nearest Block, or None.
     * 'address' -- in which case result is an Address object as returned
       by geocoder.geocode().
     * 'block' -- in which case result is an Address object based on the block.
@@ -481,7 +657,13 @@ def full_geocode(query, search_places=True, convert_to_block=True, guess=False,
     # Search the Place table, for stuff like "Sears Tower".
     if search_places:
         canonical_place = PlaceSynonym.objects.get_canonical(query)
-        places = Place.objects.filter(normalized_name=canonical_place)
+        places = list(Place.objects.filter(normalized_name=canonical_place))
+        if places:
+            # Look up all their blocks at once.
+            from ebpub.geocoder.reverse import reverse_geocode_many
+            nearest = reverse_geocode_many([place.location for place in places])
+            for place, block_and_distance in zip(places, nearest):
+                place.nearest_block = block_and_distance and block_and_distance[0]
         if len(places) == 1:
             logger.debug(u'geocoded %r to Place %s' % (query, places[0]))
             return {'type': 'place', 'result': places[0], 'ambiguous': False}
@@ -525,7 +707,8 @@ def full_geocode(query, search_places=True, convert_to_block=True, guess=False,
             block_name = address_to_block(query)
             if block_name != query:
                 try:
-                    result['result'] = BlockGeocoder()._do_geocode(block_name)
+                    result['result'] = BlockGeocoder(
+                        use_block_index=geocoder.use_block_index)._do_geocode(block_name)
                     result['result']['address'] = block_name
                     result['ambiguous'] = False
                     logger.debug('Resolved %r to block %r' % (query, block_name))
@@ -0,0 +1,250 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Caching of geocoder results, used by
+:py:meth:`ebpub.geocoder.base.Geocoder.geocode`.
+
+There are three tiers, checked in order:
+
+* A small in-process LRU cache (``EBPUB_GEOCODER_CACHE_SIZE`` entries).
+* The Django cache backend, shared by all processes.
+* The :py:class:`GeocoderCache <ebpub.geocoder.models.GeocoderCache>`
+  table; only successful results go here.
+
+Failures (eg. DoesNotExist, AmbiguousResult, ParsingError) are cached
+too, in the first two tiers, for ``EBPUB_GEOCODER_CACHE_FAILURE_TTL``
+seconds; successes for ``EBPUB_GEOCODER_CACHE_TTL`` seconds.
+
+All cached results belong to a "generation": the version of the
+streets data they were computed from (see
+:py:mod:`ebpub.streets.dataversion`).  Results from older
+generations are ignored.
+
+:py:func:`get_cache_stats` returns this process' hit and miss counts.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from ebpub.streets.dataversion import get_version, version_datetime
+import copy
+import datetime
+import logging
+import time
+
+logger = logging.getLogger('ebpub.geocoder.cache')
+
+_state = {'generation': None}
+
+_stats = {}
+
+
+def _ttl():
+    return getattr(settings, 'EBPUB_GEOCODER_CACHE_TTL', 60 * 60 * 24 * 30)
+
+
+def _failure_ttl():
+    return getattr(settings, 'EBPUB_GEOCODER_CACHE_FAILURE_TTL', 60 * 60)
+
+
+class LRUCache(object):
+    """
+    A dictionary-like cache of at most ``size`` items, with expiry.
+    When it's full, the least recently used quarter of the items is
+    discarded.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        # {key: [value, expiry time, last used]}
+        self._items = {}
+        self._clock = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        if item[1] < time.time():
+            del self._items[key]
+            return default
+        self._clock += 1
+        item[2] = self._clock
+        return item[0]
+
+    def set(self, key, value, timeout):
+        if self.size <= 0:
+            return
+        if key not in self._items and len(self._items) >= self.size:
+            by_use = sorted(self._items.items(), key=lambda (k, item): item[2])
+            for k, item in by_use[:max(1, self.size / 4)]:
+                del self._items[k]
+        self._clock += 1
+        self._items[key] = [value, time.time() + timeout, self._clock]
+
+
+_local_cache = LRUCache(getattr(settings, 'EBPUB_GEOCODER_CACHE_SIZE', 1000))
+
+
+def get_generation():
+    """
+    Returns the current cache generation, a string.
+    """
+    generation = get_version()
+    if generation != _state['generation']:
+        _local_cache.clear()
+        _state['generation'] = generation
+    return generation
+
+
+def _count(name, n=1):
+    _stats[name] = _stats.get(name, 0) + n
+
+
+def get_cache_stats():
+    """
+    Returns a dictionary of this process' geocoder cache counters:
+    ``local_hits``, ``shared_hits`` and ``db_hits`` (results found in
+    each tier), ``misses``, and ``failure_hits`` (how many of the hits
+    were cached failures).
+    """
+    stats = dict.fromkeys(['local_hits', 'shared_hits', 'db_hits', 'misses',
+                           'failure_hits'], 0)
+    stats.update(_stats)
+    return stats
+
+
+def reset_cache_stats():
+    _stats.clear()
+
+
+def _key(generation, location):
+    # Hashed, so it's always a valid memcached key.
+    return 'geocoder:%s:%s' % (generation, md5_constructor(location.encode('utf8')).hexdigest())
+
+
+def _hit(tier, entry):
+    # Counts a hit, and returns the entry for the caller.  Cache
+    # entries are (True, Address) or (False, exception).
+    _count(tier)
+    ok, value = entry
+    if not ok:
+        _count('failure_hits')
+        return entry
+    # Copy it, so callers can't change what's cached.
+    result = copy.copy(value)
+    result._cache_hit = True
+    return (True, result)
+
+
+def get_entries(locations):
+    """
+    Looks up a list of normalized location strings in the cache, with
+    at most one query of each tier.  Returns a dictionary mapping the
+    ones that were found to (True, Address) or, for cached failures,
+    (False, exception).
+    """
+    generation = get_generation()
+    keys = dict([(_key(generation, location), location) for location in locations])
+    entries = {}
+
+    for key, location in keys.items():
+        entry = _local_cache.get(key)
+        if entry is not None:
+            entries[location] = _hit('local_hits', entry)
+            del keys[key]
+
+    if keys:
+        for key, entry in cache.get_many(keys.keys()).items():
+            # The shared cache doesn't tell us how much longer it's
+            # good for, so keep it locally for the shortest TTL.
+            _local_cache.set(key, entry, _failure_ttl())
+            entries[keys.pop(key)] = _hit('shared_hits', entry)
+
+    if keys:
+        # Defer import to avoid cyclical imports.
+        from ebpub.geocoder.models import GeocoderCache
+        from ebpub.geocoder.base import Address
+        oldest = max(version_datetime(generation),
+                     datetime.datetime.now() - datetime.timedelta(seconds=_ttl()))
+        cached = GeocoderCache.objects.filter(normalized_location__in=keys.values(),
+                                              generated_at__gte=oldest)
+        cached = cached.select_related('block', 'intersection').order_by('-generated_at')
+        keys = dict([(location, key) for (key, location) in keys.items()])
+        for obj in cached:
+            key = keys.pop(obj.normalized_location, None)
+            if key is None:
+                # We already have a newer one.
+                continue
+            entry = (True, Address.from_cache(obj))
+            _local_cache.set(key, entry, _ttl())
+            cache.set(key, entry, _ttl())
+            entries[obj.normalized_location] = _hit('db_hits', entry)
+
+    _count('misses', len(set(locations)) - len(entries))
+    return entries
+
+
+def get_result(location):
+    """
+    Looks up the normalized location string in the cache.  Returns an
+    Address, or None if it's not cached.  If it's cached as a failure,
+    raises the same exception again.
+    """
+    entry = get_entries([location]).get(location)
+    if entry is None:
+        return None
+    ok, value = entry
+    if not ok:
+        raise value
+    return value
+
+
+def set_result(location, result):
+    """
+    Caches the Address ``result`` for the normalized location string,
+    in all tiers.
+    """
+    # Defer import to avoid cyclical imports.
+    from ebpub.geocoder.models import GeocoderCache
+    key = _key(get_generation(), location)
+    entry = (True, copy.copy(result))
+    _local_cache.set(key, entry, _ttl())
+    cache.set(key, entry, _ttl())
+    GeocoderCache.populate(location, result)
+
+
+def set_failure(location, exception):
+    """
+    Caches the exception raised when geocoding the normalized
+    location string, so it can be raised again.
+    """
+    key = _key(get_generation(), location)
+    entry = (False, exception)
+    _local_cache.set(key, entry, _failure_ttl())
+    try:
+        cache.set(key, entry, _failure_ttl())
+    except Exception:
+        # Probably couldn't pickle it; the local cache will do.
+        logger.debug('Could not cache %r for %r in the shared cache' % (exception, location))
@@ -43,10 +43,12 @@ class GeocoderCache(models.Model):
     @classmethod
     def populate(cls, normalized_location, address):
         """
-        Populates the cache from an Address object.
+        Populates the cache from an Address object, replacing any
+        older result for the same location.
         """
         if address['point'] is None:
             return
+        cls.objects.filter(normalized_location=normalized_location).delete()
         obj = cls()
         obj.normalized_location = normalized_location
         for field in ('address', 'city', 'state', 'zip'):
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark for :py:func:`ebpub.geocoder.parser.parsing.parse`.
+
+Parses a corpus of addresses (by default, benchmark_addresses.txt in
+this directory; or the files given as arguments, one address per
+line) with the precomputed combination tries, and with the old
+approach of trying every one of address_combinations() in turn, and
+reports parses per second for each.  Also checks that both give
+identical results.
+
+Usage::
+
+    python -m ebpub.geocoder.parser.benchmark [-r REPEAT] [corpus.txt ...]
+"""
+
+import os
+import time
+
+from ebpub.geocoder.parser import parsing
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'benchmark_addresses.txt')
+
+
+def brute_force_combinations(tokens):
+    """
+    The old way of doing parsing.matching_combinations(): try every
+    combination, matching each token against the regex for its type.
+    """
+    result = []
+    for token_types in parsing.address_combinations():
+        if len(token_types) != len(tokens):
+            continue
+        for token, token_type in zip(tokens, token_types):
+            if not parsing.TOKEN_REGEXES[token_type].match(token):
+                break
+        else:
+            result.append(tuple(token_types))
+    return result
+
+
+def parse_all(addresses):
+    results = []
+    for address in addresses:
+        try:
+            results.append(parsing.parse(address))
+        except parsing.ParsingError:
+            results.append(None)
+    return results
+
+
+def run(addresses, repeat=1, combinations=None):
+    """
+    Parses all the addresses ``repeat`` times, optionally with
+    ``combinations`` in place of parsing.matching_combinations.
+    Returns (results of the last run, parses per second).
+    """
+    original = parsing.matching_combinations
+    if combinations is not None:
+        parsing.matching_combinations = combinations
+    try:
+        start = time.time()
+        for i in range(repeat):
+            results = parse_all(addresses)
+        elapsed = time.time() - start
+    finally:
+        parsing.matching_combinations = original
+    return results, len(addresses) * repeat / elapsed
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='''usage: %prog [options] [corpus.txt ...]
+
+Benchmarks address parsing, before and after precomputing the
+token-type combinations.
+''')
+    optparser.add_option('-r', '--repeat', type='int', default=3,
+                         help='Number of times to parse the whole corpus. Default 3.')
+    opts, args = optparser.parse_args(argv)
+
+    addresses = []
+    for filename in args or [DEFAULT_CORPUS]:
+        addresses.extend([line.strip() for line in open(filename) if line.strip()])
+
+    before, before_rate = run(addresses, opts.repeat, combinations=brute_force_combinations)
+    after, after_rate = run(addresses, opts.repeat)
+    print "%d addresses, %d times each" % (len(addresses), opts.repeat)
+    print "Before: %10.1f parses/second" % before_rate
+    print "After:  %10.1f parses/second" % after_rate
+    print "Speedup: %.1fx" % (after_rate / before_rate)
+    differences = [address for (address, b, a) in zip(addresses, before, after) if b != a]
+    for address in differences:
+        print "Results differ for %r!" % address
+    if differences:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
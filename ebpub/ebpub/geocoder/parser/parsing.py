@@ -321,6 +321,52 @@ def address_combinations():
                                     for zip_times in (0, 1):
                                         yield ['number'] * number_times + ['pre_dir'] * pre_dir_times + ['prefix'] * prefix_times + ['street'] * street_times + ['suffix'] * suffix_times + ['post_dir'] * post_dir_times + ['city'] * city_times + ['state'] * state_times + ['zip'] * zip_times
 
+def _build_combination_tries():
+    # Precomputes a trie of address_combinations() for each number of
+    # tokens: {len: {token_type: {token_type: ... {None: (i, token_types)}}}},
+    # where i is the combination's position in address_combinations(),
+    # so that matches can be returned in the same order.
+    tries = {}
+    for i, token_types in enumerate(address_combinations()):
+        node = tries.setdefault(len(token_types), {})
+        for token_type in token_types:
+            node = node.setdefault(token_type, {})
+        node[None] = (i, tuple(token_types))
+    return tries
+
+_combination_tries = _build_combination_tries()
+
+def matching_combinations(tokens):
+    """
+    Returns a list of every combination of token types from
+    address_combinations() that matches the list of ``tokens``, in
+    the same order.  For example::
+
+        >>> matching_combinations(['228', 'BROADWAY'])
+        [('street', 'city'), ('street', 'street'), ('number', 'street')]
+
+    Each token is only matched against each of TOKEN_REGEXES once,
+    and combinations are only tried as far as their first
+    non-matching token.
+    """
+    token_types = [frozenset([token_type for token_type, regex in TOKEN_REGEXES.items()
+                              if regex.match(token)])
+                   for token in tokens]
+    if len(tokens) not in _combination_tries:
+        return []
+    found = []
+    stack = [(_combination_tries[len(tokens)], 0)]
+    while stack:
+        node, depth = stack.pop()
+        if depth == len(tokens):
+            found.append(node[None])
+            continue
+        for token_type, child in node.items():
+            if token_type in token_types[depth]:
+                stack.append((child, depth + 1))
+    found.sort()
+    return [combination for (i, combination) in found]
+
 
 token_split = re.compile(r"\S+").findall
 
@@ -336,46 +382,37 @@ def parse(location):
     s = strip_unit(normalize(location))
     logger.debug('parse: normalized and stripped %r to %r' % (location, s))
     tokens = token_split(s)
-    len_tokens = len(tokens)
     result_list = []
 
-    for token_types in address_combinations():
-        if len(token_types) == len_tokens:
-            try:
-                for token, token_type in izip(tokens, token_types):
-                    if not TOKEN_REGEXES[token_type].match(token):
-                        raise StopIteration() # Token regex didn't match.
-            except StopIteration:
-                continue
-
-            # If we made it this far, then all of the tokens are valid.
-            # Create the Location object.
-            result = Location()
-            for token, token_type in izip(tokens, token_types):
-                if result[token_type]:
-                    result[token_type] += ' ' + token
-                else:
-                    result[token_type] = token
-
-            if result['street'] and not result['prefix']:
-                # Special case: "I40" -> "Interstate 40"
-                fixed = interstate_street_re.sub(r'\2', result['street'])
-                if fixed != result['street']:
-                    result['street'] = fixed
-                    result['prefix'] = 'INTERSTATE'
-
-            # Standardize all values.
-            for key, value in result.items():
-                if value and key in STANDARDIZERS:
-                    if key == 'street':
-                        if result['prefix']:
-                            # Special case: "US Highway 101", not "US Highway 101st".
-                            continue
-                    result[key] = STANDARDIZERS[key](value)
-                    logger.debug('parse: standardized %r to %r' % (value, result[key]))
-
-            logger.debug('parse: %r gave possible result address %s' % (s, result))
-            result_list.append(result)
+    for token_types in matching_combinations(tokens):
+        # All of the tokens are valid.
+        # Create the Location object.
+        result = Location()
+        for token, token_type in izip(tokens, token_types):
+            if result[token_type]:
+                result[token_type] += ' ' + token
+            else:
+                result[token_type] = token
+
+        if result['street'] and not result['prefix']:
+            # Special case: "I40" -> "Interstate 40"
+            fixed = interstate_street_re.sub(r'\2', result['street'])
+            if fixed != result['street']:
+                result['street'] = fixed
+                result['prefix'] = 'INTERSTATE'
+
+        # Standardize all values.
+        for key, value in result.items():
+            if value and key in STANDARDIZERS:
+                if key == 'street':
+                    if result['prefix']:
+                        # Special case: "US Highway 101", not "US Highway 101st".
+                        continue
+                result[key] = STANDARDIZERS[key](value)
+                logger.debug('parse: standardized %r to %r' % (value, result[key]))
+
+        logger.debug('parse: %r gave possible result address %s' % (s, result))
+        result_list.append(result)
 
     if not result_list:
         raise ParsingError("Failed to parse location %r" % location)
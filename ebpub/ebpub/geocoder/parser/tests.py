@@ -338,5 +338,22 @@ class LocationTestCase(unittest.TestCase):
     #     )
 
 
+class MatchingCombinationsTestCase(unittest.TestCase):
+
+    def test_same_as_brute_force(self):
+        from ebpub.geocoder.parser.benchmark import brute_force_combinations
+        from ebpub.geocoder.parser.benchmark import DEFAULT_CORPUS
+        from ebpub.geocoder.parser.parsing import matching_combinations
+        from ebpub.geocoder.parser.parsing import normalize, strip_unit, token_split
+        for address in open(DEFAULT_CORPUS):
+            tokens = token_split(strip_unit(normalize(address.strip())))
+            self.assertEqual(matching_combinations(tokens),
+                             brute_force_combinations(tokens))
+
+    def test_no_tokens(self):
+        from ebpub.geocoder.parser.parsing import matching_combinations
+        self.assertEqual(matching_combinations([]), [])
+        self.assertRaises(ParsingError, parse, '')
+
 if __name__ == "__main__":
     unittest.main()
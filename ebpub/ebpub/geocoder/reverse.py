@@ -16,69 +16,178 @@
 #   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import unittest
-from psycopg2 import Binary
+"""
+Reverse geocoding: finding the nearest Block to a point.
+"""
+
 from django.contrib.gis.geos import Point
 from django.db import connection
+import logging
+
+logger = logging.getLogger('ebpub.geocoder.reverse')
+
+# With PostGIS 2.0 or later, the "<->" operator finds the blocks whose
+# bounding boxes are nearest, using the spatial index; we then pick the
+# nearest of this many candidates by actual distance.
+KNN_CANDIDATES = 10
+
+# Without "<->", we look for blocks within this distance (in degrees)
+# of the points, and if there aren't any, keep doubling it up to
+# MAX_SEARCH_RADIUS.
+MIN_SEARCH_RADIUS = 0.007
+MAX_SEARCH_RADIUS = 2.0
+
+# A max_distance (in degrees) for callers that only want a block near
+# the point.  Roughly 700 meters north-south.
+NEARBY_DISTANCE = 0.007
+
+_postgis_version = []
+
 
 class ReverseGeocodeError(Exception):
     pass
 
-def reverse_geocode(point):
-    """
-    Looks up the nearest block to the point.
 
-    Argument can be either a Point instance, or an (x, y) tuple, or a
-    WKT string.
+def _has_knn():
+    # Whether the database supports the "<->" operator.
+    if not _postgis_version:
+        version = getattr(connection.ops, 'spatial_version', None)
+        if version is None:
+            cursor = connection.cursor()
+            cursor.execute("SELECT postgis_lib_version()")
+            version = tuple([int(part) for part in cursor.fetchone()[0].split('.')[:2]])
+        _postgis_version.append(tuple(version))
+    return _postgis_version[0] >= (2, 0)
 
-    Returns (block, distance (in degrees I think??))
-    """
-    # Defer import to avoid cyclical import.
-    from ebpub.streets.models import Block
 
+def _to_point(point):
+    # Accepts a Point, an (x, y) tuple or list, or a WKT string.
     if isinstance(point, basestring):
         from django.contrib.gis.geos import fromstr
         point = fromstr(point, srid=4326)
     elif isinstance(point, tuple) or isinstance(point, list):
         point = Point(tuple(point))
-    # In degrees for now because transforming to a projected space is
-    # too slow for this purpose. TODO: store projected versions of the
-    # locations alongside the canonical lng/lat versions.
-    min_distance = 0.007
-    # We use min_distance to cut down on the searchable space, because
-    # the distance query we do next that actually compares distances
-    # between geometries does not use the spatial index. TODO: convert
-    # this to GeoDjango syntax. Should be possible but there are some
-    # subtleties / performance issues with the DB API.
-    cursor = connection.cursor()
-    # Switched to WKT rather than WKB, because constructing WKB as a
-    # string leads to psycopg2 getting confused by '%' as per
-    # http://stackoverflow.com/questions/1734814/why-isnt-psycopg2-executing-any-of-my-sql-functions-indexerror-tuple-index-ou
-    # We could probably do something like
-    # str(Binary(point.wkb)).replace('%', '%%') ... but I don't know
-    # if that could have other problems?
-    # Or maybe a Binary() could be passed as a parameter to cursor.execute().
-    # Anyway, WKT is safe.
-    params = {'field_list': ', '.join([f.column for f in Block._meta.fields]),
-              'pt_wkt': point.wkt,
-              'geom_fieldname': 'geom',
-              'tablename': Block._meta.db_table,
-              'min_distance': min_distance
-              }
+    return point
+
+
+def _distance_sql(a, b, projection):
+    # SQL for the distance between two geometry expressions, in
+    # degrees or in the units of the projection.
+    if projection:
+        return 'ST_Distance(ST_Transform(%s, %d), ST_Transform(%s, %d))' % (
+            a, int(projection), b, int(projection))
+    return 'ST_Distance(%s, %s)' % (a, b)
+
+
+def _nearest_blocks(points, projection, radius=None):
+    """
+    Returns a list of the nearest block to each of the points and its
+    distance, or (None, None), with one query.
+    """
+    from ebpub.streets.models import Block
+    table = Block._meta.db_table
+    fields = ', '.join(['c.%s' % connection.ops.quote_name(f.column) for f in Block._meta.fields])
+    distance = _distance_sql('c.geom', 'p.geom', projection)
+    if radius is None:
+        candidates = """
+            SELECT id, geom FROM %(table)s
+            ORDER BY geom <-> p.geom LIMIT %(knn)d""" % {
+            'table': table, 'knn': KNN_CANDIDATES}
+    else:
+        candidates = """
+            SELECT id, geom FROM %(table)s
+            WHERE ST_DWithin(geom, p.geom, %(radius)f)""" % {
+            'table': table, 'radius': radius}
+    values = ', '.join(['(%s, ST_GeomFromText(%%s, 4326))' % i for i in range(len(points))])
     sql = """
-        SELECT %(field_list)s, ST_Distance(ST_GeomFromText('%(pt_wkt)s', 4326), %(geom_fieldname)s) AS "dist"
-        FROM %(tablename)s
-        WHERE id IN
-            (SELECT id
-             FROM %(tablename)s
-             WHERE ST_DWithin(%(geom_fieldname)s, ST_GeomFromText('%(pt_wkt)s', 4326), %(min_distance)s))
-        ORDER BY "dist"
-        LIMIT 1;
-    """ % params
-    cursor.execute(sql)
+        SELECT %(fields)s, %(outer_distance)s
+        FROM (
+            SELECT p.idx, p.geom, (
+                SELECT c.id FROM (%(candidates)s) AS c
+                ORDER BY %(distance)s LIMIT 1) AS block_id
+            FROM (VALUES %(values)s) AS p(idx, geom)
+        ) AS p
+        LEFT OUTER JOIN %(table)s AS c ON c.id = p.block_id
+        ORDER BY p.idx
+    """ % {'fields': fields, 'outer_distance': distance, 'candidates': candidates,
+           'distance': distance, 'values': values, 'table': table}
+    cursor = connection.cursor()
+    cursor.execute(sql, [point.wkt for point in points])
     num_fields = len(Block._meta.fields)
-    rows = cursor.fetchall()
-    if not rows:
+    results = []
+    for row in cursor.fetchall():
+        if row[0] is None:
+            results.append((None, None))
+            continue
+        block = Block(*row[:num_fields])
+        block._state.adding = False
+        block._state.db = Block.objects.db
+        results.append((block, row[-1]))
+    return results
+
+
+def reverse_geocode_many(points, projection=None, max_distance=None):
+    """
+    Looks up the nearest block to each of a list of points, with one
+    query (or, on PostGIS before 2.0, a few).
+
+    Points can be Point instances, (x, y) tuples, or WKT strings, in
+    WGS84 longitude/latitude.
+
+    Returns a list of the same length, of (block, distance) tuples, or
+    None where no block was found (ie. if there are no blocks at all,
+    or none within ``max_distance``; or, on PostGIS before 2.0, none
+    within MAX_SEARCH_RADIUS degrees).
+
+    Distances, including ``max_distance``, are in degrees; or, if
+    ``projection`` is the SRID of a projected coordinate system (eg.
+    the UTM zone or State Plane for your area), in its units.
+    """
+    points = [_to_point(point) for point in points]
+    if not points:
+        return []
+    if _has_knn():
+        found = _nearest_blocks(points, projection)
+    else:
+        found = [(None, None)] * len(points)
+        radius = MIN_SEARCH_RADIUS
+        max_radius = MAX_SEARCH_RADIUS
+        if max_distance is not None and not projection:
+            # No point searching further.
+            max_radius = min(max_radius, max(max_distance, MIN_SEARCH_RADIUS))
+        todo = range(len(points))
+        while todo and radius <= max_radius:
+            for i, result in zip(todo, _nearest_blocks(
+                    [points[i] for i in todo], projection, radius)):
+                found[i] = result
+            todo = [i for i in todo if found[i][0] is None]
+            radius *= 2
+    results = []
+    for block, dist in found:
+        if block is None or (max_distance is not None and dist > max_distance):
+            results.append(None)
+        else:
+            results.append((block, dist))
+    return results
+
+
+def reverse_geocode(point, projection=None, max_distance=None):
+    """
+    Looks up the nearest block to the point, optionally no further
+    than ``max_distance`` away.
+
+    Argument can be either a Point instance, or an (x, y) tuple, or a
+    WKT string.
+
+    Returns (block, distance), where the distance is in degrees; or, if
+    ``projection`` is the SRID of a projected coordinate system, in
+    its units.
+
+    Raises ReverseGeocodeError if there are no blocks near enough; see
+    :py:func:`reverse_geocode_many`.
+    """
+    result = reverse_geocode_many([point], projection=projection,
+                                  max_distance=max_distance)[0]
+    if result is None:
         raise ReverseGeocodeError('No results')
-    block, distance = [(Block(*row[:num_fields]), row[-1]) for row in rows][0]
-    return block, distance
+    return result
@@ -45,6 +45,21 @@ class TestSmartGeocoder(django.test.TestCase):
         result = self.geocoder.geocode('220 S Wabash')
         self.assertEqual(result['address'], '220 S Wabash Ave.')
 
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_address_geocoder__misspelled_street(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        result = self.geocoder.geocode('200 S Wabsh Ave')
+        self.assertEqual(result['address'], '200 S Wabash Ave.')
+        # Unless it's turned off.
+        from django.conf import settings
+        old_fuzzy = getattr(settings, 'EBPUB_GEOCODER_FUZZY_STREETS', 2)
+        settings.EBPUB_GEOCODER_FUZZY_STREETS = 0
+        try:
+            self.assertRaises(DoesNotExist, self.geocoder.geocode, '200 S Wabsh Ave')
+        finally:
+            settings.EBPUB_GEOCODER_FUZZY_STREETS = old_fuzzy
+
     @mock.patch('ebpub.streets.models.get_metro')
     def test_address_geocoder_ambiguous(self, mock_get_metro):
         mock_get_metro.return_value = {'city_name': 'CHICAGO',
@@ -67,6 +82,186 @@ class TestSmartGeocoder(django.test.TestCase):
         address = self.geocoder.geocode('Wabash and Jackson')
         self.assertEqual(address['city'], 'CHICAGO')
 
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_geocode_many(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        queries = ['200 S Wabash Ave', '100000 S Wabash', '220 Wabash',
+                   'Wabash and Jackson', '200 s. wabash ave', '200 block of Wabash',
+                   '200 S Wabsh Ave']
+        results = self.geocoder.geocode_many(queries)
+        self.assertEqual(len(results), len(queries))
+        for query, result in zip(queries, results):
+            try:
+                expected = self.geocoder.geocode(query)
+            except Exception, e:
+                self.assertEqual(type(result), type(e))
+            else:
+                self.assertEqual(result['point'], expected['point'])
+                self.assertEqual(result['address'], expected['address'])
+
+
+class TestSmartGeocoderBlockIndex(TestSmartGeocoder):
+    """
+    Same tests, using the in-memory block index.
+    """
+
+    def setUp(self):
+        from ebpub.streets.dataversion import streets_changed
+        streets_changed()
+        self.geocoder = SmartGeocoder(use_cache=False, use_block_index=True)
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_index_search_matches_db(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        from ebpub.streets.models import Block
+        searches = [
+            dict(street='WABASH'),
+            dict(street='WABASH', number='200'),
+            dict(street='WABASH', number='220', predir='S'),
+            dict(street='WABASH', number='220', predir='N'),
+            dict(street='WABASH', number='221', suffix='AVE', city='CHICAGO'),
+            dict(street='WABASH', number='100000'),
+            dict(street='JACKSON', number='1', zipcode='60604'),
+            dict(street='NO SUCH STREET', number='1'),
+            ]
+        for kwargs in searches:
+            expected = [(b.id, pt and pt.coords) for (b, pt) in Block.objects.search(**kwargs)]
+            got = [(b.id, pt and pt.coords) for (b, pt) in Block.objects.search(use_index=True, **kwargs)]
+            self.assertEqual(expected, got, kwargs)
+
+    def test_index_cleared_on_save(self):
+        from ebpub.streets.blockindex import get_block_index
+        from ebpub.streets.models import Block
+        index = get_block_index()
+        self.assertTrue(get_block_index() is index)
+        block = Block.objects.all()[0]
+        block.save()
+        self.assertFalse(get_block_index() is index)
+
+
+class TestGeocoderCache(django.test.TestCase):
+    fixtures = ['wabash.yaml']
+
+    def setUp(self):
+        from ebpub.geocoder import cache
+        from ebpub.streets.dataversion import streets_changed
+        self.cache = cache
+        streets_changed()
+        cache.reset_cache_stats()
+        self.geocoder = SmartGeocoder(use_cache=True)
+
+    def test_lru(self):
+        lru = self.cache.LRUCache(4)
+        for i in range(4):
+            lru.set(i, str(i), 60)
+        self.assertEqual(lru.get(0), '0')
+        # Full; adding one more drops the least recently used.
+        lru.set(4, '4', 60)
+        self.assertEqual(len(lru), 4)
+        self.assertEqual(lru.get(1), None)
+        self.assertEqual(lru.get(0), '0')
+        # Expiry.
+        lru.set(5, '5', -1)
+        self.assertEqual(lru.get(5), None)
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_tiers(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        result = self.geocoder.geocode('200 S Wabash Ave')
+        self.assertEqual(self.cache.get_cache_stats()['misses'], 1)
+        again = self.geocoder.geocode('200 s. wabash ave')
+        self.assertEqual(again['point'], result['point'])
+        self.assertEqual(self.cache.get_cache_stats()['local_hits'], 1)
+        # Forget it locally; it's still in the database.
+        self.cache._local_cache.clear()
+        again = self.geocoder.geocode('200 S Wabash Ave')
+        self.assertEqual(again['point'], result['point'])
+        self.assertEqual(self.cache.get_cache_stats()['db_hits'], 1)
+
+    def test_failures_cached(self):
+        self.assertRaises(InvalidBlockButValidStreet,
+                          self.geocoder.geocode, '100000 S Wabash')
+        with mock.patch.object(self.geocoder, '_do_geocode') as mock_do_geocode:
+            self.assertRaises(InvalidBlockButValidStreet,
+                              self.geocoder.geocode, '100000 S Wabash')
+            self.assertEqual(mock_do_geocode.call_count, 0)
+        self.assertEqual(self.cache.get_cache_stats()['failure_hits'], 1)
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_new_generation_on_save(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        from ebpub.streets.models import Block
+        self.geocoder.geocode('200 S Wabash Ave')
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, '200 S Nowhere Ave')
+        generation = self.cache.get_generation()
+        Block.objects.all()[0].save()
+        self.assertNotEqual(self.cache.get_generation(), generation)
+        self.geocoder.geocode('200 S Wabash Ave')
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, '200 S Nowhere Ave')
+        stats = self.cache.get_cache_stats()
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['local_hits'] + stats['shared_hits'] + stats['db_hits'], 0)
+
+
+class TestReverseGeocode(django.test.TestCase):
+    fixtures = ['wabash.yaml']
+
+    def test_reverse_geocode(self):
+        from ebpub.geocoder.reverse import reverse_geocode
+        block, distance = reverse_geocode((-87.6261, 41.8790))
+        self.assertEqual(block.id, 1000)
+        self.assert_(distance < 0.0001)
+
+    def test_reverse_geocode__far_away(self):
+        # Nowhere near any blocks, but still finds the nearest.
+        from ebpub.geocoder.reverse import reverse_geocode
+        block, distance = reverse_geocode('POINT(-87.5 41.0)')
+        self.assertEqual(block.street, 'WABASH')
+        self.assert_(distance > 0.8)
+
+    def test_reverse_geocode__max_distance(self):
+        from ebpub.geocoder.reverse import reverse_geocode, reverse_geocode_many
+        from ebpub.geocoder.reverse import ReverseGeocodeError, NEARBY_DISTANCE
+        self.assertRaises(ReverseGeocodeError, reverse_geocode, 'POINT(-87.5 41.0)',
+                          max_distance=NEARBY_DISTANCE)
+        results = reverse_geocode_many([(-87.6261, 41.8790), (-87.5, 41.0)],
+                                       max_distance=NEARBY_DISTANCE)
+        self.assertEqual(results[0][0].id, 1000)
+        self.assertEqual(results[1], None)
+        # In the projection's units.
+        self.assertRaises(ReverseGeocodeError, reverse_geocode, (-87.6261, 41.8800),
+                          projection=32616, max_distance=10)
+
+    def test_reverse_geocode__projected(self):
+        from ebpub.geocoder.reverse import reverse_geocode
+        # UTM zone 16N, in meters.
+        block, distance = reverse_geocode((-87.6261, 41.8800), projection=32616)
+        self.assertEqual(block.id, 1000)
+        self.assert_(40 < distance < 60, distance)
+
+    def test_reverse_geocode_many(self):
+        from ebpub.geocoder.reverse import reverse_geocode, reverse_geocode_many
+        points = [(-87.6261, 41.8790), (-87.5, 41.0), (-87.6261, 41.8790)]
+        results = reverse_geocode_many(points)
+        self.assertEqual(len(results), 3)
+        for point, (block, distance) in zip(points, results):
+            expected_block, expected_distance = reverse_geocode(point)
+            self.assertEqual(block.id, expected_block.id)
+            self.assertAlmostEqual(distance, expected_distance)
+        self.assertEqual(reverse_geocode_many([]), [])
+
+    def test_no_blocks(self):
+        from ebpub.geocoder.reverse import reverse_geocode, reverse_geocode_many
+        from ebpub.geocoder.reverse import ReverseGeocodeError
+        from ebpub.streets.models import Block
+        Block.objects.all().delete()
+        self.assertEqual(reverse_geocode_many([(-87.6261, 41.8790)]), [None])
+        self.assertRaises(ReverseGeocodeError, reverse_geocode, (-87.6261, 41.8790))
+
 
 class TestFullGeocode(django.test.TestCase):
 
@@ -59,8 +59,10 @@ class NewsItemForm(NewsItemFormBase):
             if cleaned_data.get('location'):
                 from ebpub.geocoder.reverse import reverse_geocode
                 from ebpub.geocoder.reverse import ReverseGeocodeError
+                from ebpub.geocoder.reverse import NEARBY_DISTANCE
                 try:
-                    block, distance = reverse_geocode(cleaned_data['location'])
+                    block, distance = reverse_geocode(cleaned_data['location'],
+                                                      max_distance=NEARBY_DISTANCE)
                     cleaned_data['location_name'] = block.pretty_name
                 except ReverseGeocodeError:
                     logger.info("Saving NewsItem with no location_name because reverse-geocoding %(location)s failed" % cleaned_data)
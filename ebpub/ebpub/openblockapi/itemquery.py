@@ -40,23 +40,30 @@ from django.contrib.gis import geos
 from ebpub.utils.dates import parse_date
 from ebpub.db.models import NewsItem
 from ebpub.streets.models import Place
+import base64
 import pyrfc3339
 import re
 
-__all__ = ['build_item_query', 'build_place_query']
+__all__ = ['build_item_query', 'build_place_query', 'next_page_cursor']
 
 
 class QueryError(Exception):
     def __init__(self, message):
         self.message = message
 
-def build_item_query(request):
+def build_item_query(request, state=None):
     """
     builds a NewsItem QuerySet according to the request parameters given as
     specified in the API documentation.  raises QueryError if
     invalid query parameters are specified.
 
     Returns the queryset, and a dictionary of *unused* parameters.
+
+    If ``state`` is given, it's a dictionary that will be updated with
+    information from the filters, eg. state['limit'] is the page
+    size, for use with next_page_cursor().  If state['geojson'] is
+    true, each item also gets a ``geojson`` attribute: its location
+    already encoded as GeoJSON by the database.
     """
     params = _copy_nomulti(request.GET)
     # some different ordering may be more optimal here /
@@ -66,11 +73,12 @@ def build_item_query(request):
                _id_filter,
                _daterange_filter, _predefined_place_filter,
                _radius_filter, _bbox_filter, _attributes_filter, _order_by,
-               _object_limit]
+               _geojson_filter, _object_limit]
 
     query = NewsItem.objects.by_request(request)
     params = dict(params)
-    state = {}
+    if state is None:
+        state = {}
     for f in filters:
         query, params, state = f(query, params, state)
 
@@ -252,7 +260,13 @@ def _radius_filter(query, params, state):
 def _object_limit(query, params, state):
     """
     handles limiting the number of results and skipping results
-    parameters: limit, offset
+    parameters: limit, offset, cursor
+
+    cursor is only understood if the results were ordered by
+    _order_by(); it's an opaque value from next_page_cursor(),
+    and selects the items that sort after that one.  Unlike offset,
+    this is as fast for page 100 as for page 1, and isn't thrown off
+    by new items.
     """
     try: 
         offset = int(params.get('offset', 0))
@@ -271,19 +285,71 @@ def _object_limit(query, params, state):
     if 'offset' in params: 
         del params['offset']
 
+    if state.get('keyset') and 'cursor' in params:
+        if offset:
+            raise QueryError('cursor and offset cannot be used together')
+        item_date, item_id = _decode_cursor(params.pop('cursor'))
+        # A row comparison, so Postgres can use the (item_date, id) index.
+        query = query.extra(where=['(db_newsitem.item_date, db_newsitem.id) < (%s, %s)'],
+                            params=[item_date, item_id])
+
     query = query[offset:offset+limit]
+    state['limit'] = limit
     
     return query, params, state
 
+def _geojson_filter(query, params, state):
+    """
+    Not really a filter: if state['geojson'] is true, selects each
+    item's location as GeoJSON text too, so it can be written out
+    as-is.  Must come before _object_limit, as extra columns can't be
+    added to a sliced query.
+    """
+    if state.get('geojson'):
+        query = query.geojson()
+    return query, params, state
+
 def _order_by(query, params, state):
     """
     handles order of results.
     parameters: None, currently fixed
     """
-    # it is always by item date currently
-    query = query.order_by('-item_date')
+    # it is always by item date currently; id breaks ties, so that
+    # the cursor parameter (see _object_limit) is unambiguous.
+    query = query.order_by('-item_date', '-id')
+    state['keyset'] = ('item_date', 'id')
     return query, params, state
 
+def _encode_cursor(item_date, item_id):
+    value = '%s,%d' % (item_date.strftime('%Y-%m-%d'), item_id)
+    return base64.urlsafe_b64encode(value).rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        item_date, item_id = value.split(',')
+        item_date = parse_date(item_date, '%Y-%m-%d')
+        if item_date is None:
+            raise ValueError(value)
+        return item_date, int(item_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise QueryError('Invalid cursor "%s"' % cursor)
+
+def next_page_cursor(last_item, num_items, state):
+    """
+    Given the last item returned by a query from build_item_query(),
+    the number of items it returned, and the ``state`` dictionary
+    passed to it, returns the value of the ``cursor`` parameter that
+    fetches the next page of results; or None if this was the last
+    page.
+
+    (It takes the last item and count, rather than the list of items,
+    so that the results can be streamed rather than kept in memory.)
+    """
+    if not (state.get('keyset') and last_item is not None) or num_items < state['limit']:
+        return None
+    return _encode_cursor(last_item.item_date, last_item.id)
+
 
 ###################################
 # Some piggy-backing for Places API
@@ -0,0 +1,202 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Streaming GeoJSON output for long lists of NewsItems (or any other
+model with a ``location`` geometry).
+
+Rather than building a whole FeatureCollection in memory and encoding
+it in one go, :py:class:`FeatureCollectionStream` fetches and encodes
+a chunk of items at a time.  Views should join the stream into the
+response content themselves, not hand it to the response as an
+iterator: Django closes the database connection when the view
+returns, before the response content is iterated.  Geometries that PostGIS has already
+encoded -- see ``GeoQuerySet.geojson()`` -- are spliced into the
+output as-is, without being decoded and re-encoded.
+"""
+
+from django.db import connections
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import simplejson
+import itertools
+
+_cursor_names = itertools.count()
+
+def _can_use_server_side_cursor(queryset):
+    if not isinstance(queryset, QuerySet) or isinstance(queryset, ValuesQuerySet):
+        return False
+    if queryset._result_cache is not None:
+        # Already evaluated; no point querying again.
+        return False
+    connection = connections[queryset.db]
+    if getattr(connection, 'vendor', None) != 'postgresql':
+        return False
+    if getattr(connection.features, 'uses_autocommit', False):
+        # Named cursors only work inside a transaction.
+        return False
+    query = queryset.query
+    # We build model instances from the raw rows ourselves, so this
+    # only works for plain querysets.
+    return not (query.select_related or query.deferred_loading[0]
+                or query.aggregate_select or getattr(query, 'custom_select', None))
+
+
+def iter_chunks(items, chunk_size=500):
+    """
+    Yields lists of up to ``chunk_size`` items from ``items``.
+
+    If ``items`` is an unevaluated QuerySet, its rows are fetched from
+    a server-side cursor, ``chunk_size`` at a time, so neither the
+    raw rows nor the model instances for the whole result are ever in
+    memory at once.  This needs PostgreSQL, not in autocommit mode;
+    and a "plain" QuerySet, without select_related(), defer(), only()
+    or annotations.  Other QuerySets are just iterated normally.
+    """
+    if not _can_use_server_side_cursor(items):
+        if isinstance(items, QuerySet) and items._result_cache is None:
+            # At least don't keep all the instances around.
+            items = items.iterator()
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    try:
+        sql, params = items.query.get_compiler(using=items.db).as_sql()
+    except EmptyResultSet:
+        return
+    connection = connections[items.db]
+    connection.cursor()  # Make sure we're connected.
+    cursor = connection.connection.cursor('openblock_stream_%d' % _cursor_names.next())
+    # Like Django's own cursors.
+    cursor.tzinfo_factory = None
+    try:
+        cursor.execute(sql, params)
+        model = items.model
+        # Same column order as Django's own QuerySet.iterator():
+        # extra(select=...) columns, then the model's fields.
+        extra_select = items.query.extra_select.keys()
+        start = len(extra_select)
+        end = start + len(model._meta.fields)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                obj = model(*row[start:end])
+                obj._state.db = items.db
+                obj._state.adding = False
+                for i, name in enumerate(extra_select):
+                    setattr(obj, name, row[i])
+                chunk.append(obj)
+            yield chunk
+    finally:
+        cursor.close()
+
+
+class FeatureCollectionStream(object):
+    """
+    An iterable that generates a GeoJSON FeatureCollection of
+    ``items``, as a series of strings.
+
+    ``properties`` is a function that takes an item and returns a
+    dictionary of the Feature's properties.
+
+    ``preload``, if given, is called with each chunk of items (a list)
+    before they're encoded, eg. to fetch their related objects in
+    bulk.  It may return a replacement list.
+
+    ``extra``, if given, is called after all the Features are encoded,
+    with this stream as its argument, and returns a dictionary of any
+    other members of the FeatureCollection.  It can use
+    ``stream.count`` (the number of items seen) and
+    ``stream.last_item``.
+
+    ``indent`` and ``default`` are passed to ``simplejson.dumps()``.
+    The default indent of None gives the most compact output.
+
+    Each item's geometry is taken from its ``geojson`` attribute if it
+    has one (see ``GeoQuerySet.geojson()``), or else encoded from its
+    ``location``. Items with neither are skipped.
+    """
+
+    def __init__(self, items, properties, preload=None, extra=None,
+                 indent=None, default=None, chunk_size=500):
+        self.items = items
+        self.properties = properties
+        self.preload = preload
+        self.extra = extra
+        self.indent = indent
+        self.default = default
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.last_item = None
+
+    def dumps(self, obj):
+        if self.indent is None:
+            separators = (',', ':')
+        else:
+            separators = (', ', ': ')
+        return simplejson.dumps(obj, indent=self.indent, separators=separators,
+                                default=self.default)
+
+    def geometry(self, item):
+        geojson = getattr(item, 'geojson', None)
+        if geojson:
+            return geojson
+        if item.location is None:
+            return None
+        return item.location.geojson
+
+    def __iter__(self):
+        if self.indent is None:
+            header = '{"type":"FeatureCollection","features":['
+            feature_template = '{"type":"Feature","geometry":%s,"properties":%s}'
+            separator = ','
+        else:
+            header = '{"type": "FeatureCollection", "features": [\n'
+            feature_template = '{"type": "Feature", "geometry": %s, "properties": %s}'
+            separator = ',\n'
+        self.count = 0
+        self.last_item = None
+        yield header
+        first = True
+        for chunk in iter_chunks(self.items, self.chunk_size):
+            if self.preload is not None:
+                chunk = self.preload(chunk) or chunk
+            features = []
+            for item in chunk:
+                self.count += 1
+                self.last_item = item
+                geometry = self.geometry(item)
+                if geometry is None:
+                    continue
+                features.append(feature_template % (geometry, self.dumps(self.properties(item))))
+            if features:
+                yield (first and '' or separator) + separator.join(features)
+                first = False
+        yield ']'
+        if self.extra is not None:
+            for key, value in self.extra(self).items():
+                yield ',%s:%s' % (self.dumps(key), self.dumps(value))
+        yield '}'
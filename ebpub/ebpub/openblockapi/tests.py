@@ -482,6 +482,33 @@ class TestItemSearchAPI(BaseTestCase):
             assert self._items_exist_in_xml_result(items, response.content)
 
 
+    def test_items_num_queries(self):
+        # The number of queries shouldn't depend on the number of items.
+        from django.db import connection
+        schema = Schema.objects.get(slug='test-schema')
+        items = _make_items(6, schema)
+        for i, item in enumerate(items):
+            item.save()
+            if i % 2:
+                # Some items have no attributes at all.
+                item.attributes = {'varchar': u'Hi', 'lookup': '7701,7700',
+                                   'date': datetime.date(2001, 01, 02)}
+
+        def count_queries(url):
+            connection.queries = []
+            with self.settings(DEBUG=True):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                num_queries = len(connection.queries)
+            connection.queries = []
+            return num_queries
+
+        for url in (reverse('items_json'), reverse('items_atom')):
+            # Warm up any caches.
+            count_queries(url + '?limit=1')
+            self.assertEqual(count_queries(url + '?limit=2'),
+                             count_queries(url + '?limit=6'))
+
     def test_items_filter_daterange_rfc3339(self):
         import pyrfc3339
         import pytz
@@ -605,6 +632,91 @@ class TestItemSearchAPI(BaseTestCase):
             assert len(ritems['features']) == 5
             assert self._items_exist_in_result(items[2:7], ritems)
 
+    def test_items_cursor(self):
+        zone = 'Europe/Vienna'
+        with self.settings(TIME_ZONE=zone):
+            schema1 = Schema.objects.get(slug='type1')
+            items = _make_items(5, schema1) + _make_items(5, schema1, 'same day ')
+            for item in items:
+                item.save()
+            seen = []
+            url = reverse('items_json') + '?limit=4'
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                ritems = simplejson.loads(response.content)
+                seen.extend([f['properties']['id'] for f in ritems['features']])
+                url = ritems.get('next')
+                if url:
+                    self.assert_(url.startswith('http://testserver/'))
+                    self.assert_('cursor=' in url)
+                    self.assert_('limit=4' in url)
+                    # A new item shouldn't shift the following pages.
+                    _make_items(1, schema1, 'new ')[0].save()
+            self.assertEqual(len(seen), 10)
+            self.assertEqual(sorted(seen), sorted([item.id for item in items]))
+
+    def test_items_cursor__errors(self):
+        response = self.client.get(reverse('items_json') + '?cursor=bogus')
+        self.assertEqual(response.status_code, 400)
+        from ebpub.openblockapi.itemquery import _encode_cursor
+        cursor = _encode_cursor(datetime.date(2012, 1, 1), 123)
+        response = self.client.get(reverse('items_json') + '?offset=2&cursor=' + cursor)
+        self.assertEqual(response.status_code, 400)
+
+    def test_items_json__compact(self):
+        schema1 = Schema.objects.get(slug='type1')
+        for item in _make_items(3, schema1):
+            item.save()
+        response = self.client.get(reverse('items_json') + '?limit=2')
+        self.assertEqual(response.status_code, 200)
+        # Compact, with the geometry as written by the database.
+        self.assert_(response.content.startswith(
+                '{"type":"FeatureCollection","features":[{"type":"Feature","geometry":{"type":"Point"'))
+        out = simplejson.loads(response.content)
+        self.assertEqual(len(out['features']), 2)
+        self.assert_('cursor=' in out['next'])
+
+    def test_feature_collection_stream(self):
+        from ebpub.openblockapi.streaming import FeatureCollectionStream
+        schema1 = Schema.objects.get(slug='type1')
+        items = _make_items(5, schema1)
+        items[2].location = None
+        for item in items:
+            item.save()
+        qs = NewsItem.objects.filter(id__in=[item.id for item in items]).order_by('id')
+        # Several chunks, with and without geometries from the database;
+        # items without a location are skipped.
+        for query in (qs, qs.geojson()):
+            stream = FeatureCollectionStream(query, lambda item: {'id': item.id},
+                                             extra=lambda s: {'count': s.count},
+                                             chunk_size=2)
+            out = simplejson.loads(''.join(stream))
+            self.assertEqual([f['properties']['id'] for f in out['features']],
+                             [items[i].id for i in (0, 1, 3, 4)])
+            self.assertEqual(out['features'][0]['geometry'],
+                             {'type': 'Point', 'coordinates': [0, 0]})
+            self.assertEqual(out['count'], 5)
+            self.assertEqual(stream.last_item.id, items[4].id)
+
+        # Lists work too, and can be indented.
+        stream = FeatureCollectionStream(list(qs), lambda item: {'id': item.id}, indent=1)
+        self.assertEqual(simplejson.loads(''.join(stream))['features'], out['features'])
+
+    def test_items_atom_next_link(self):
+        schema1 = Schema.objects.get(slug='type1')
+        for item in _make_items(3, schema1):
+            item.save()
+        response = self.client.get(reverse('items_atom') + '?limit=2')
+        feed = feedparser.parse(response.content)
+        next_links = [l['href'] for l in feed['feed']['links'] if l['rel'] == 'next']
+        self.assertEqual(len(next_links), 1)
+        self.assert_(next_links[0].startswith('http://testserver/'))
+        response = self.client.get(next_links[0])
+        feed = feedparser.parse(response.content)
+        self.assertEqual(len(feed['entries']), 1)
+        self.assertEqual([l for l in feed['feed']['links'] if l['rel'] == 'next'], [])
+
     def test_items_predefined_location(self):
         zone = 'Europe/Zurich'
         with self.settings(TIME_ZONE=zone):
@@ -725,6 +837,31 @@ class TestGeocoderAPI(BaseTestCase):
         response = self.client.get(reverse('geocoder_api'))
         self.assertEqual(response.status_code, 400)
 
+    def test_batch(self):
+        queries = ['100 Adams St', 'Adams and Chestnut', '100 Nowhere St',
+                   'Chestnut and Chestnut', '100 adams st.']
+        response = self.client.post(reverse('geocoder_batch_api'),
+                                    simplejson.dumps(queries),
+                                    content_type=views.JSON_CONTENT_TYPE)
+        self.assertEqual(response.status_code, 200)
+        features = simplejson.loads(response.content)['features']
+        self.assertEqual([f['properties']['query'] for f in features], queries)
+        self.assertEqual(features[0]['properties']['address'], '100 Adams St.')
+        self.assertEqual(features[1]['properties']['address'], 'Adams St. & Chestnut St.')
+        self.assertEqual(features[2]['geometry'], None)
+        self.assertEqual(features[2]['properties']['error'], 'not_found')
+        self.assertEqual(features[3]['properties']['error'], 'ambiguous')
+        self.assertEqual(features[4]['geometry'], features[0]['geometry'])
+
+    def test_batch_bad_requests(self):
+        url = reverse('geocoder_batch_api')
+        self.assertEqual(self.client.get(url).status_code, 405)
+        response = self.client.post(url, 'not json', content_type=views.JSON_CONTENT_TYPE)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, simplejson.dumps({'q': 'x'}),
+                                    content_type=views.JSON_CONTENT_TYPE)
+        self.assertEqual(response.status_code, 400)
+
     def test_address(self):
         qs = '?q=100+Adams+St'
         response = self.client.get(reverse('geocoder_api') + qs)
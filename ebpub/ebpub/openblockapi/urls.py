@@ -22,6 +22,7 @@ urlpatterns = patterns(
     '',
     url(r'^$', views.check_api_available, name="check_api_available"),
     url(r'^geocode/$', views.geocode, name='geocoder_api'),
+    url(r'^geocode/batch/$', views.geocode_batch, name='geocoder_batch_api'),
     url(r'^items.json$', views.items_json, name="items_json"),
     url(r'^items.atom$', views.items_atom, name="items_atom"),
     url(r'^items/types.json$', views.list_types_json, name="list_types_json"),
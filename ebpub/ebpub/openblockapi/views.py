@@ -30,11 +30,18 @@ from django.utils import feedgenerator
 from django.utils import simplejson
 from django.utils.cache import patch_response_headers
 from django.utils.cache import patch_vary_headers
+from django.views.decorators.csrf import csrf_exempt
 from ebpub.db import models
+from ebpub.db.utils import populate_attributes
+from ebpub.db.utils import populate_schemas
 from ebpub.geocoder import DoesNotExist
+from ebpub.geocoder import AmbiguousResult, InvalidBlockButValidStreet
+from ebpub.geocoder import ParsingError, SmartGeocoder
 from ebpub.geocoder.base import full_geocode
 from ebpub.openblockapi.itemquery import _copy_nomulti
 from ebpub.openblockapi.itemquery import build_item_query, build_place_query, QueryError
+from ebpub.openblockapi.itemquery import next_page_cursor
+from ebpub.openblockapi.streaming import FeatureCollectionStream
 from ebpub.streets.models import PlaceType
 from ebpub.utils.dates import parse_date, parse_time
 from ebpub.utils.geodjango import ensure_valid
@@ -55,6 +62,9 @@ JAVASCRIPT_CONTENT_TYPE = 'application/javascript'
 
 LOCAL_TZ = pytz.timezone(settings.TIME_ZONE)
 
+# Most location strings geocode_batch() will take at once.
+MAX_GEOCODE_BATCH = 1000
+
 logger = logging.getLogger('openblockapi')
 
 ############################################################
@@ -70,10 +80,15 @@ def APIGETResponse(request, body, **kw):
 
     This may alter the content type of the response
     if JSONP/JSONPX is triggered. Status is preserved.
+
+    body may also be a FeatureCollectionStream, which is encoded
+    here, while the request's database connection is still open.
     """
     jsonp = request.GET.get(JSONP_QUERY_PARAM)
     format = kw.setdefault('content_type', JSON_CONTENT_TYPE)
-    if format == JSON_CONTENT_TYPE and not isinstance(body, basestring):
+    if isinstance(body, FeatureCollectionStream):
+        body = ''.join(body)
+    elif format == JSON_CONTENT_TYPE and not isinstance(body, basestring):
         body = simplejson.dumps(body, indent=1, default=_serialize_unknown)
     if jsonp is None:
         return HttpResponse(body, **kw)
@@ -109,18 +124,31 @@ def api_items_geojson(items):
     helper to produce the geojson of the same form as the 
     API in other contexts (not a view)
     """
-    body = {'type': 'FeatureCollection',
-            'features': [item for item in items if item.location]}
-    return simplejson.dumps(body, indent=1, default=_serialize_unknown)
+    stream = FeatureCollectionStream(items, _item_properties, preload=_preload_items,
+                                     default=_serialize_unknown)
+    return ''.join(stream)
+
+def _preload_items(items):
+    # Fetches the Schemas, attributes and Lookups of a whole list of
+    # NewsItems in a constant number of queries, so that serializing
+    # them with _item_properties() or _items_atom() doesn't need any
+    # more. Returns the list.
+    items = list(items)
+    schemas = populate_schemas(items)
+    populate_attributes(items, schemas.values())
+    return items
 
 def _item_geojson_dict(item):
     # Prepare a single NewsItem as a structure that can be JSON-encoded.
+    # (Lists of items are better done with FeatureCollectionStream.)
+    return {'type': 'Feature',
+            'geometry': simplejson.loads(item.location.geojson),
+            'properties': _item_properties(item),
+            }
+
+def _item_properties(item):
+    # The GeoJSON properties of a NewsItem.
     props = {}
-    geom = simplejson.loads(item.location.geojson)
-    result = {
-        'type': 'Feature',
-        'geometry': geom,
-        }
     for attr in item.attributes_for_template():
         key = attr.sf.name
         if attr.sf.is_many_to_many_lookup():
@@ -144,8 +172,7 @@ def _item_geojson_dict(item):
          'color': item.schema.map_color,
          'location_name': item.location_name,
          })
-    result['properties'] = props
-    return result
+    return props
 
 def _serialize_unknown(obj):
     # Handle NewsItems and various other types that default json serializer
@@ -299,13 +326,19 @@ def items_json(request):
     # adding extra info eg. popup html.  Together, that would allow
     # this to replace ebub.db.views.newsitems_geojson. See #81
     try:
-        items, params = build_item_query(request)
+        # Have the database encode the geometries.
+        state = {'geojson': True}
+        items, params = build_item_query(request, state)
         # could test for extra params aside from jsonp...
-        items = [item for item in items if item.location is not None]
-        items_geojson_dict = {'type': 'FeatureCollection',
-                              'features': items
-                              }
-        return APIGETResponse(request, items_geojson_dict, content_type=JSON_CONTENT_TYPE)
+        def _next(stream):
+            # Only known once all the items have been written.
+            next_url = _next_page_url(request, stream.last_item, stream.count, state)
+            if next_url:
+                return {'next': next_url}
+            return {}
+        body = FeatureCollectionStream(items, _item_properties, preload=_preload_items,
+                                       extra=_next, default=_serialize_unknown)
+        return APIGETResponse(request, body, content_type=JSON_CONTENT_TYPE)
     except QueryError as err:
         return HttpResponseBadRequest(err.message)
 
@@ -315,10 +348,16 @@ def items_atom(request):
     handles the items.atom API endpoint
     """
     try:
-        items, params = build_item_query(request)
+        state = {}
+        items, params = build_item_query(request, state)
         # could test for extra params aside from jsonp...
-        items = [item for item in items if item.location is not None]
-        return APIGETResponse(request, _items_atom(items), content_type=ATOM_CONTENT_TYPE)
+        items = list(items)
+        if items:
+            next_url = _next_page_url(request, items[-1], len(items), state)
+        else:
+            next_url = None
+        items = _preload_items([item for item in items if item.location is not None])
+        return APIGETResponse(request, _items_atom(items, next_url), content_type=ATOM_CONTENT_TYPE)
     except QueryError as err:
         return HttpResponseBadRequest(err.message)
 
@@ -444,14 +483,28 @@ def single_item_json(request, id_=None):
 
 
 
-def _items_atom(items):
+def _next_page_url(request, last_item, num_items, state):
+    # URL of the next page of results, or None if there isn't one.
+    # last_item and num_items must be from the full page, before any
+    # further filtering.
+    cursor = next_page_cursor(last_item, num_items, state)
+    if cursor is None:
+        return None
+    params = request.GET.copy()
+    params.pop('offset', None)
+    params['cursor'] = cursor
+    return request.build_absolute_uri('%s?%s' % (request.path, params.urlencode()))
+
+
+def _items_atom(items, next_url=None):
     # XXX needs tests
     feed_url = reverse('items_atom')
     atom = OpenblockAtomFeed(
         title='openblock news item atom feed', description='',
         link=reverse('items_json'),  # For the rel=alternate link.
         feed_url=feed_url,
-        id=feed_url,)
+        id=feed_url,
+        next_url=next_url)
 
     for item in items:
         location = item.location
@@ -495,6 +548,64 @@ def geocode(request):
                           content_type=JSON_CONTENT_TYPE, status=status)
 
 
+@csrf_exempt
+@rest_view(['POST'])
+def geocode_batch(request):
+    """
+    POST: Takes a JSON list of address, block or intersection strings,
+    and returns a GeoJSON FeatureCollection with one Feature for each,
+    in the same order.  Features for strings that couldn't be geocoded
+    have a null geometry, and an 'error' property: one of
+    'not_found', 'ambiguous', 'invalid_block' or 'unparseable'.
+
+    Unlike the GET geocoder API, this doesn't look for Locations or
+    Places.
+    """
+    try:
+        queries = simplejson.loads(request.raw_post_data)
+    except ValueError:
+        return HttpResponseBadRequest('Request body is not valid JSON.')
+    if not isinstance(queries, list) or not all(
+        [isinstance(q, basestring) for q in queries]):
+        return HttpResponseBadRequest('Expected a JSON list of strings.')
+    if len(queries) > MAX_GEOCODE_BATCH:
+        return HttpResponseBadRequest('At most %d strings at once, please.' % MAX_GEOCODE_BATCH)
+
+    geocoder = SmartGeocoder(use_cache=getattr(settings, 'EBPUB_CACHE_GEOCODER', False))
+    features = []
+    for query, result in zip(queries, geocoder.geocode_many(queries)):
+        if isinstance(result, Exception):
+            if isinstance(result, InvalidBlockButValidStreet):
+                error = 'invalid_block'
+            elif isinstance(result, AmbiguousResult):
+                error = 'ambiguous'
+            elif isinstance(result, ParsingError):
+                error = 'unparseable'
+            else:
+                error = 'not_found'
+            features.append({'type': 'Feature', 'geometry': None,
+                             'properties': {'query': query, 'error': error}})
+            continue
+        features.append({
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [result.lng, result.lat],
+                    },
+                'properties': {
+                    'type': 'address',
+                    'address': result.get('address'),
+                    'city': result.get('city'),
+                    'state': result.get('state'),
+                    'zip': result.get('zip'),
+                    'query': query,
+                    }
+                })
+    collection = {'type': 'FeatureCollection', 'features': features}
+    return HttpResponse(simplejson.dumps(collection, indent=1),
+                        content_type=JSON_CONTENT_TYPE)
+
+
 def _geocode_geojson(query):
     """Geocode a string and return the result as a list of
     GeoJSON Features.
@@ -712,6 +823,12 @@ class OpenblockAtomFeed(feedgenerator.Atom1Feed):
         attrs['xmlns:openblock'] = 'http://openblock.org/ns/0'
         return attrs
 
+    def add_root_elements(self, handler):
+        super(OpenblockAtomFeed, self).add_root_elements(handler)
+        if self.feed.get('next_url'):
+            handler.addQuickElement(u'link', '', {u'rel': u'next',
+                                                  u'href': self.feed['next_url']})
+
     def add_item_elements(self, handler, item):
         super(OpenblockAtomFeed, self).add_item_elements(handler, item)
         location = item['location']
@@ -26,8 +26,10 @@ from django.utils import simplejson
 from django.utils.cache import patch_response_headers
 from ebpub.db.models import NewsItem
 from ebpub.db.schemafilters import FilterChain
+from ebpub.db.utils import populate_schemas
 from ebpub.db.views import _get_filter_schemafields
 from ebpub.openblockapi.itemquery import build_item_query
+from ebpub.openblockapi.streaming import FeatureCollectionStream
 from ebpub.openblockapi.views import JSON_CONTENT_TYPE
 from ebpub.streets.models import Place, PlaceType
 from ebpub.utils.view_utils import eb_render
@@ -500,15 +502,14 @@ def map_items_json(request):
     rendition of the REST api's geojson response. includes
     only attributes used by the map.
     """
-    items, params = build_item_query(request)
+    # Have the database encode the geometries.
+    items, params = build_item_query(request, {'geojson': True})
 
-    def _item_to_feature(item):
-        geom = simplejson.loads(item.location.geojson)
-        result = {
-            'type': 'Feature',
-            'geometry': geom,
-            }
+    def _preload(items):
+        populate_schemas(items)
+        return items
 
+    def _item_properties(item):
         # Uh-oh, this is not y10k compliant :-p
         sort_key = '%d-%d-%d-%s-%d' % (9999 - item.item_date.year,
                                     13 - item.item_date.month,
@@ -521,15 +522,9 @@ def map_items_json(request):
                  'color': item.schema.map_color,
                  'sort': sort_key
                 }
-        result['properties'] = props
-        return result
+        return props
 
-    items = [_item_to_feature(item) for item in items if item.location is not None]
-    items_geojson_dict = {'type': 'FeatureCollection',
-                          'features': items
-                          }
-    
-    body = simplejson.dumps(items_geojson_dict)
-    response = HttpResponse(body, content_type=JSON_CONTENT_TYPE)
+    body = FeatureCollectionStream(items, _item_properties, preload=_preload)
+    response = HttpResponse(''.join(body), content_type=JSON_CONTENT_TYPE)
     patch_response_headers(response, cache_timeout=3600)
     return response
@@ -413,6 +413,26 @@ RECAPTCHA_PRIVATE_KEY = ''
 EBPUB_CACHE_GEOCODER = True
 required_settings.append('EBPUB_CACHE_GEOCODER')
 
+# Set this True to make the geocoder look up blocks in an in-memory
+# index of the whole blocks table, instead of querying the database.
+# Much faster for bulk geocoding, but each process has to load the
+# index (a few seconds, and some memory) the first time.
+# Scripts that geocode lots of addresses turn it on regardless.
+EBPUB_GEOCODER_BLOCK_INDEX = False
+
+# How long (in seconds) to cache geocoder results, and failures;
+# and how many results each process keeps in memory.
+# See ebpub.geocoder.cache.
+EBPUB_GEOCODER_CACHE_TTL = 60 * 60 * 24 * 30
+EBPUB_GEOCODER_CACHE_FAILURE_TTL = 60 * 60
+EBPUB_GEOCODER_CACHE_SIZE = 1000
+
+# When an address' street isn't known, and isn't in the
+# StreetMisspelling table, the geocoder tries the closest known street
+# name within this many typos (fewer for short names).  0 turns it off.
+# See ebpub.streets.fuzzy.
+EBPUB_GEOCODER_FUZZY_STREETS = 2
+
 # Required by openblockapi.apikey to associate keys with user profiles.
 AUTH_PROFILE_MODULE = 'preferences.Profile'
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark for :py:mod:`ebpub.streets.fuzzy`.
+
+Makes random typos (one or two insertions, deletions, substitutions
+or transpositions) in a sample of street names, and reports:
+
+* Accuracy: how many typos were corrected to the original name, how
+  many to some other name, and how many not at all.
+* Latency: microseconds per lookup via the BK-tree, versus comparing
+  the typo with every street name.  Also checks that both find the
+  same names.
+
+Street names come from the blocks table, or from the files given as
+arguments (one name per line).
+"""
+
+from ebpub.streets import fuzzy
+from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
+import logging
+import random
+import string
+import time
+
+logger = logging.getLogger('ebpub.streets.bin.benchmark_street_names')
+
+
+def make_typo(name, edits=1, rng=random):
+    """
+    Returns ``name`` with ``edits`` random single-character typos.
+    """
+    letters = string.ascii_uppercase
+    for i in range(edits):
+        pos = rng.randrange(len(name))
+        kind = rng.choice(['insert', 'delete', 'substitute', 'transpose'])
+        if kind == 'insert':
+            name = name[:pos] + rng.choice(letters) + name[pos:]
+        elif kind == 'delete' and len(name) > 1:
+            name = name[:pos] + name[pos + 1:]
+        elif kind == 'transpose' and pos < len(name) - 1:
+            name = name[:pos] + name[pos + 1] + name[pos] + name[pos + 2:]
+        else:
+            name = name[:pos] + rng.choice(letters) + name[pos + 1:]
+    return name
+
+
+def _median_us(timings):
+    timings = sorted(timings)
+    return timings[len(timings) / 2] * 1000000
+
+
+def benchmark(matcher, samples=1000, edits=1, max_distance=2, seed=0):
+    """
+    Returns a dict of accuracy counts and median lookup times for
+    ``samples`` random typos.  Raises AssertionError if the tree and
+    the full scan find different names.
+    """
+    rng = random.Random(seed)
+    names = sorted(matcher.names)
+    counts = dict.fromkeys(['correct', 'wrong', 'none', 'skipped'], 0)
+    tree_timings, scan_timings = [], []
+    for i in range(samples):
+        name = rng.choice(names)
+        typo = make_typo(name, edits, rng)
+        if typo in matcher:
+            # Typo'd into another real street; nobody could fix that.
+            counts['skipped'] += 1
+            continue
+        allowed = matcher.allowed_distance(typo, max_distance)
+
+        start = time.time()
+        found = matcher.search(typo, allowed)
+        tree_timings.append(time.time() - start)
+        start = time.time()
+        scanned = matcher.scan(typo, allowed)
+        scan_timings.append(time.time() - start)
+        assert sorted(found) == sorted(scanned), 'Tree and scan differ for %r' % typo
+
+        match = matcher.match(typo, max_distance)
+        if match is None:
+            counts['none'] += 1
+        elif match == name:
+            counts['correct'] += 1
+        else:
+            counts['wrong'] += 1
+            logger.debug('%r -> %r, corrected to %r' % (name, typo, match))
+    counts['tree_median_us'] = tree_timings and _median_us(tree_timings) or 0
+    counts['scan_median_us'] = scan_timings and _median_us(scan_timings) or 0
+    return counts
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='''usage: %prog [options] [names.txt ...]
+
+Benchmarks fuzzy street name matching on random typos.
+''')
+    optparser.add_option('-n', '--samples', type='int', default=1000,
+                         help='Number of typos to try. Default 1000.')
+    optparser.add_option('-e', '--edits', type='int', default=1,
+                         help='Number of typos per name. Default 1.')
+    optparser.add_option('-d', '--max-distance', type='int', default=2,
+                         help='Maximum edit distance to match. Default 2.')
+    optparser.add_option('--seed', type='int', default=0,
+                         help='Random seed. Default 0.')
+    add_verbosity_options(optparser)
+    opts, args = optparser.parse_args(argv)
+    setup_logging_from_opts(opts, logger)
+
+    names = None
+    if args:
+        names = set()
+        for filename in args:
+            names.update([line.strip().upper() for line in open(filename) if line.strip()])
+    start = time.time()
+    matcher = fuzzy.StreetNameMatcher(names)
+    print "%d street names, loaded in %.2f seconds" % (len(matcher.names), time.time() - start)
+    if not matcher.names:
+        optparser.error('There are no street names; import some blocks first.')
+
+    results = benchmark(matcher, opts.samples, opts.edits, opts.max_distance, opts.seed)
+    tried = opts.samples - results['skipped']
+    print "%d typos with %d edit(s) each (%d skipped as real names)" % (
+        tried, opts.edits, results['skipped'])
+    for key in ('correct', 'wrong', 'none'):
+        print "%-8s %6d  %5.1f%%" % (key.capitalize() + ':', results[key],
+                                    100.0 * results[key] / max(tried, 1))
+    print "Median lookup: %8.1f us via tree, %8.1f us via full scan" % (
+        results['tree_median_us'], results['scan_median_us'])
+
+if __name__ == '__main__':
+    main()
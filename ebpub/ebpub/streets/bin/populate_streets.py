@@ -32,22 +32,23 @@ blocks of an intersection have different ZIP Codes. This is
 not described here: there should be a ZIP Code importer script
 suitable for your city.
 
-Next, populate the streets from the blocks table, by calling populate_streets().
-
-This is the part that takes the longest: populate the
-db_blockintersection table.
-In this module, execute the populate_block_intersections() function.
-
-This goes through each block (and remember, there are on the order of
-tens of thousands of blocks in each city) and calculates all the other
-blocks which intersect with it. This is inherently slow, even with the
-heavy-lifting offloaded to pgsql/postgis; but this is a one-time cost.
-
-When that completes, execute the populate_intersections()
-function. This is a comparatively fast operation which just looks
-up the pre-calculated intersections for each block and creates
-a new object representing a particular intersection, eliminating
-potential duplicates.
+Next, populate the streets from the blocks table, by calling
+populate_streets().  This can be re-run at any time; it only changes
+the streets that need it.
+
+Then populate the db_blockintersection table, by calling
+populate_block_intersections().  This finds every pair of blocks that
+cross at a point with a spatial join of the blocks table against
+itself, a range of block ids at a time, and inserts the pairs in bulk.
+
+When that completes, call populate_intersections().  This creates
+one Intersection for each distinct pair of street names among the
+block intersections, looking up ZIP Codes (and cities) where the
+blocks disagree with a spatial join against the Locations, and links
+the block intersections to them.
+
+Both take a ``city`` argument, to recalculate just the blocks in that
+city (eg. after re-importing them) and leave everything else alone.
 """
 
 import logging
@@ -55,13 +56,19 @@ import sys
 import optparse
 from django.contrib.gis.geos import fromstr
 from django.db import connection, transaction
-from ebpub.db.models import Location
+from ebpub.db.bin.update_aggregates import smart_update
+from ebpub.db.models import Location, LocationType
+from ebpub.geocoder.parser.parsing import normalize
 from ebpub.metros.allmetros import get_metro
+from ebpub.streets.dataversion import streets_changed
 from ebpub.streets.models import Block, BlockIntersection, Intersection, Street
-from ebpub.streets.name_utils import make_dir_street_name, pretty_name_from_blocks, slug_from_blocks
+from ebpub.streets.name_utils import pretty_name_from_blocks, slug_from_blocks
 
 logger = logging.getLogger()
 
+# How many blocks' worth of intersections to calculate in each query.
+CHUNK_SIZE = 10000
+
 def timer(func):
     # a decorator that logs how long func took to run
     def wrapper(*args, **kwargs):
@@ -104,7 +111,7 @@ def intersecting_blocks(block):
     return intersections
 
 def intersection_from_blocks(block_a, block_b, intersection_pt, city, state, zip):
-    pretty_name = pretty_name_from_blocks(block_a, block_b),
+    pretty_name = pretty_name_from_blocks(block_a, block_b)
     slug = slug_from_blocks(block_a, block_b)
     obj, created = Intersection.objects.get_or_create(
         pretty_name=pretty_name,
@@ -134,139 +141,325 @@ def intersection_from_blocks(block_a, block_b, intersection_pt, city, state, zip
         logger.debug("Already have intersection %s" % obj.pretty_name)
     return obj
 
+def _street_rows(cursor):
+    """
+    Returns a list of dictionaries of Street field values, one per
+    distinct (street_slug, city, state) on either side of any block.
+    Where blocks disagree about a street's name, the block with the
+    highest id wins.
+    """
+    sides = []
+    for side in ('left', 'right'):
+        sides.append("""
+            SELECT id, street_slug, street_pretty_name, prefix, suffix,
+                   UPPER(TRIM(%(side)s_city)) AS city, UPPER(TRIM(%(side)s_state)) AS state
+            FROM %(table)s""" % {'side': side, 'table': Block._meta.db_table})
+    cursor.execute("""
+        SELECT DISTINCT ON (street_slug, city, state)
+            street_slug, city, state, street_pretty_name, prefix, UPPER(TRIM(suffix))
+        FROM (%s) AS sides
+        ORDER BY street_slug, city, state, id DESC
+        """ % ' UNION ALL '.join(sides))
+    rows = cursor.fetchall()
+    # Street.save() would do this one row at a time.
+    streets = [normalize(row[3]) for row in rows]
+    result = []
+    for (street_slug, city, state, pretty_name, prefix, suffix), street in zip(rows, streets):
+        if suffix and street.endswith(' ' + suffix):
+            street = street[:-len(suffix) - 1]
+        result.append({'street_slug': street_slug, 'city': city, 'state': state,
+                       'pretty_name': pretty_name, 'street': street,
+                       'prefix': prefix, 'suffix': suffix})
+    return result
+
 @timer
 @transaction.commit_on_success
 def populate_streets(*args, **kwargs):
     """
-    Populates the streets table from the blocks table
+    Populates the streets table from the blocks table.
+
+    The new streets are calculated with SQL and reconciled with the
+    existing ones in bulk, in one transaction: unchanged streets keep
+    their ids, and readers never see an empty table.
     """
-    print 'Populating the streets table; deleting all first'
-    Street.objects.all().delete()
-    # This is considerably slower than the old INSERT INTO ... UPDATE
-    # single SQL statement, but it's a one-time cost, and it avoids
-    # duplicate keys that we were getting.
-    for block in Block.objects.all():
-
-        cities_and_states = set([(block.left_city, block.left_state),
-                                 (block.right_city, block.right_state)
-                                 ])
-        for city, state in cities_and_states:
-            obj, created =  Street.objects.get_or_create(
-                street_slug=block.street_slug,
-                city=city,
-                state=state,
-                )
-            if (obj.pretty_name != block.street_pretty_name
-                   or obj.street != block.street
-                   or obj.suffix != block.suffix
-                   or obj.prefix != block.prefix):
-                obj.pretty_name = block.street_pretty_name
-                obj.street=block.street
-                obj.prefix=block.prefix
-                obj.suffix=block.suffix
-                obj.save()
-                logger.debug("saved %s" % obj.pretty_name)
-            elif created:
-                logger.debug("created %s" % obj.pretty_name)
-
-    #connection._commit()
+    logger.info("Populating the streets table")
+    cursor = connection.cursor()
+    rows = _street_rows(cursor)
+    inserted, updated, deleted = smart_update(
+        cursor, rows, Street._meta.db_table,
+        ['street_slug', 'city', 'state', 'pretty_name', 'street', 'prefix', 'suffix'],
+        ['street_slug', 'city', 'state'], {})
+    logger.info("Streets: %d inserted, %d updated, %d deleted" % (inserted, updated, deleted))
 
     #logger.info("Deleting extraneous cities...")
     #metro = get_metro()
     #cities = [l.name.upper() for l in Location.objects.filter(location_type__slug=metro['city_location_type']).exclude(location_type__name__startswith='Unknown')]
     #Street.objects.exclude(city__in=cities).delete()
-    return Street.objects.all().count()
+    return len(rows)
+
+def _block_id_chunks(chunk_size):
+    """
+    Yields (start, end) ranges of block ids, covering all the blocks
+    about ``chunk_size`` at a time.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT min(id), max(id) FROM %s' % Block._meta.db_table)
+    first, last = cursor.fetchone()
+    if first is None:
+        return
+    for start in xrange(first, last + 1, chunk_size):
+        yield start, min(start + chunk_size, last + 1)
+
+
+def _in_city(alias):
+    return '(%s.left_city = %%(city)s OR %s.right_city = %%(city)s)' % (alias, alias)
+
 
 @timer
 @transaction.commit_on_success
-def populate_block_intersections(*args, **kwargs):
-    logger.info("Starting to populate block_intersections")
-    logger.info("Warning, deleting all block_intersections AND intersections first")
-    BlockIntersection.objects.all().delete()  # This cascades.
-    for block in Block.objects.all():
-        logger.debug('Calculating the blocks that intersect %s' % block)
-        for iblock, intersection_pt in intersecting_blocks(block):
-            BlockIntersection.objects.get_or_create(
-                block=block,
-                intersecting_block=iblock,
-                defaults={'location': intersection_pt}
-            )
-    return BlockIntersection.objects.all().count()
+def populate_block_intersections(city=None, chunk_size=CHUNK_SIZE, *args, **kwargs):
+    """
+    Calculates the BlockIntersections: every pair of blocks, on
+    different streets, that meet at a single point.
+
+    If ``city`` is given, only replaces the BlockIntersections
+    involving blocks in that city.  Returns the number created.
+    """
+    bi_table = BlockIntersection._meta.db_table
+    block_table = Block._meta.db_table
+    cursor = connection.cursor()
+    params = {'city': city and city.upper()}
+    if city:
+        logger.info("Starting to populate block_intersections in %s" % params['city'])
+        logger.info("Deleting the existing block_intersections in %s first" % params['city'])
+        cursor.execute("""
+            DELETE FROM %s WHERE block_id IN (SELECT id FROM %s a WHERE %s)
+                OR intersecting_block_id IN (SELECT id FROM %s a WHERE %s)
+            """ % (bi_table, block_table, _in_city('a'), block_table, _in_city('a')), params)
+    else:
+        logger.info("Starting to populate block_intersections")
+        logger.warn("Deleting all block_intersections first")
+        cursor.execute("DELETE FROM %s" % bi_table)
+
+    # Pairs with either block in the city, which is all of them if
+    # there's no city.
+    city_filter = ''
+    if city:
+        city_filter = 'AND (%s OR %s)' % (_in_city('a'), _in_city('b'))
+    total = 0
+    for start, end in _block_id_chunks(chunk_size):
+        params.update({'start': start, 'end': end})
+        # Same criteria as intersecting_blocks(): the blocks meet at
+        # a point, and aren't on the same street.
+        cursor.execute("""
+            INSERT INTO %(bi_table)s (block_id, intersecting_block_id, location)
+            SELECT block_id, intersecting_block_id, location FROM (
+                SELECT a.id AS block_id, b.id AS intersecting_block_id,
+                       ST_Intersection(a.geom, b.geom) AS location
+                FROM %(block_table)s a
+                JOIN %(block_table)s b ON ST_Intersects(a.geom, b.geom)
+                WHERE a.id >= %%(start)s AND a.id < %%(end)s
+                    AND NOT (b.street = a.street AND b.suffix = a.suffix)
+                    %(city_filter)s
+                ) AS pairs
+            WHERE GeometryType(location) = 'POINT'
+            """ % {'bi_table': bi_table, 'block_table': block_table,
+                   'city_filter': city_filter}, params)
+        total += cursor.rowcount
+        logger.info("Blocks %d to %d: %d block_intersections so far" % (start, end - 1, total))
+    return total
+
+
+def _locations_of_types(type_ids):
+    # SQL for the name of the first of the Locations of the given types
+    # containing a point.
+    return """(SELECT l.name FROM %s l
+               WHERE l.location_type_id = ANY(%%(%s)s) AND l.name NOT LIKE 'Unknown%%%%'
+                   AND ST_Contains(l.location, bi.location)
+               ORDER BY l.id LIMIT 1)""" % (Location._meta.db_table, type_ids)
+
+
+def _fetch_block_intersections(cursor, start, end, params):
+    """
+    Returns a list of (id, block, intersecting block, city, zip) for
+    the BlockIntersections with no Intersection, whose blocks have ids
+    from ``start`` up to (but not including) ``end``, in order.  The
+    blocks only have the fields populate_intersections() needs.  City
+    and zip come from Locations, and are only looked up when the
+    blocks disagree about them; otherwise they're None.
+    """
+    fields_a = ['predir', 'prefix', 'street', 'suffix', 'postdir', 'left_city',
+                'right_city', 'left_state', 'right_state', 'left_zip', 'right_zip']
+    fields_b = ['predir', 'prefix', 'street', 'suffix', 'postdir', 'left_zip', 'right_zip']
+    params = dict(params, start=start, end=end)
+    cursor.execute("""
+        SELECT bi.id, %(fields)s,
+            CASE WHEN a.left_city != a.right_city THEN %(city)s END,
+            CASE WHEN a.left_zip != a.right_zip OR b.left_zip != b.right_zip
+                      OR a.left_zip != b.left_zip THEN %(zip)s END
+        FROM %(bi_table)s bi
+        JOIN %(block_table)s a ON a.id = bi.block_id
+        JOIN %(block_table)s b ON b.id = bi.intersecting_block_id
+        WHERE bi.intersection_id IS NULL
+            AND bi.block_id >= %%(start)s AND bi.block_id < %%(end)s
+        ORDER BY bi.block_id, bi.id
+        """ % {'fields': ', '.join(['a.' + f for f in fields_a] + ['b.' + f for f in fields_b]),
+               'city': _locations_of_types('city_types'),
+               'zip': _locations_of_types('zip_types'),
+               'bi_table': BlockIntersection._meta.db_table,
+               'block_table': Block._meta.db_table,
+               }, params)
+    rows = []
+    for row in cursor.fetchall():
+        values_a = row[1:1 + len(fields_a)]
+        values_b = row[1 + len(fields_a):1 + len(fields_a) + len(fields_b)]
+        rows.append((row[0], Block(**dict(zip(fields_a, values_a))),
+                     Block(**dict(zip(fields_b, values_b))), row[-2], row[-1]))
+    return rows
+
+
+def _insert_intersections(cursor, new_intersections):
+    """
+    Inserts Intersections with one statement.  ``new_intersections``
+    is a list of (field values dict, BlockIntersection id), where the
+    location comes from the BlockIntersection.  Returns a dictionary
+    mapping each pretty_name to its new id.
+    """
+    fields = ['pretty_name', 'slug', 'predir_a', 'prefix_a', 'street_a', 'suffix_a',
+              'postdir_a', 'predir_b', 'prefix_b', 'street_b', 'suffix_b', 'postdir_b',
+              'city', 'state', 'zip']
+    values = []
+    params = []
+    for intersection, bi_id in new_intersections:
+        values.append('(%s)' % ', '.join(['%s'] * (len(fields) + 1)))
+        params.extend([intersection[f] for f in fields] + [bi_id])
+    cursor.execute("""
+        INSERT INTO %s (%s, location)
+        SELECT %s, bi.location
+        FROM (VALUES %s) AS v(%s, bi_id)
+        JOIN %s bi ON bi.id = v.bi_id
+        RETURNING id, pretty_name
+        """ % (Intersection._meta.db_table, ', '.join(fields),
+               ', '.join(['v.' + f for f in fields]), ', '.join(values),
+               ', '.join(fields), BlockIntersection._meta.db_table), params)
+    return dict([(pretty_name, id) for (id, pretty_name) in cursor.fetchall()])
+
+
+def _link_block_intersections(cursor, links):
+    """
+    Sets the Intersections of many BlockIntersections with one UPDATE.
+    ``links`` is a list of (BlockIntersection id, Intersection id).
+    """
+    cursor.execute("""
+        UPDATE %s SET intersection_id = v.intersection_id
+        FROM (VALUES %s) AS v(id, intersection_id)
+        WHERE %s.id = v.id
+        """ % (BlockIntersection._meta.db_table, ', '.join(['(%s, %s)'] * len(links)),
+               BlockIntersection._meta.db_table),
+                   [value for link in links for value in link])
+
 
 @timer
 @transaction.commit_on_success
-def populate_intersections(*args, **kwargs):
+def populate_intersections(city=None, chunk_size=CHUNK_SIZE, *args, **kwargs):
+    """
+    Creates Intersections from the BlockIntersections that don't have
+    one yet, and links them up.
+
+    If ``city`` is given, first deletes only that city's
+    Intersections; otherwise deletes them all.  Returns the number of
+    Intersections.
+    """
     # On average, there are 2.3 blocks per intersection. So for
     # example in the case of Chicago, where there are 788,496 blocks,
     # we'd expect to see approximately 340,000 intersections
+    bi_table = BlockIntersection._meta.db_table
+    intersection_table = Intersection._meta.db_table
+    cursor = connection.cursor()
 
-    # NOTE, we can't do a delete here because that cascades to BlockIntersection,
-    # and then we have nothing to work with.
-    # So the two functions should really always be called together.
+    # Use SQL, not Intersection.objects.delete(), which would delete the
+    # BlockIntersections too, and then we'd have nothing to work with.
     logger.info("Starting to populate intersections, this can take some minutes...")
-    logger.warn("Deleting all %d existing intersections first" % Intersection.objects.all().count())
-    Intersection.objects.all().delete()
+    where, params = '', []
+    if city:
+        city = city.upper()
+        where, params = 'WHERE city = %s', [city]
+        logger.warn("Deleting the existing intersections in %s first" % city)
+    else:
+        logger.warn("Deleting all %d existing intersections first" % Intersection.objects.all().count())
+    cursor.execute("UPDATE %s SET intersection_id = NULL WHERE intersection_id IN (SELECT id FROM %s %s)"
+                   % (bi_table, intersection_table, where), params)
+    cursor.execute("DELETE FROM %s %s" % (intersection_table, where), params)
 
     logger.info("We have %d blockintersections" % BlockIntersection.objects.all().count())
     metro = get_metro()
-    zipcodes = Location.objects.filter(location_type__name__istartswith="zip").exclude(name__startswith='Unknown')
-    def lookup_zipcode(pt):
-        for zipcode in zipcodes:
-            if zipcode.location.contains(pt):
-                return zipcode
+    city_types = []
+    if metro['multiple_cities']:
+        city_types = LocationType.objects.filter(slug=metro['city_location_type'])
+        city_types = list(city_types.exclude(name__startswith='Unknown').values_list('id', flat=True))
+    zip_types = list(LocationType.objects.filter(name__istartswith='zip').values_list('id', flat=True))
+    params = {'city_types': city_types, 'zip_types': zip_types}
+
+    # Since intersections are symmetrical---eg., "N. Kimball Ave. & W.
+    # Diversey Ave." == "W. Diversey Ave. & N. Kimball Ave."---we
+    # remember both orderings of each name.
     intersections_seen = {}
-    for i in Intersection.objects.all():
-        intersections_seen[i.pretty_name] = i.id
-        intersections_seen[i.reverse_pretty_name()] = i.id
-    for bi in BlockIntersection.objects.iterator():
-        street_name = make_dir_street_name(bi.block)
-        i_street_name = make_dir_street_name(bi.intersecting_block)
-        # This tuple enables us to skip over intersections
-        # we've already seen. Since intersections are
-        # symmetrical---eg., "N. Kimball Ave. & W. Diversey
-        # Ave." == "W. Diversey Ave. & N. Kimball Ave."---we
-        # use both orderings.
-        seen_intersection = (u"%s & %s" % (street_name, i_street_name),
-                             u"%s & %s" % (i_street_name, street_name))
-        if seen_intersection[0] not in intersections_seen and \
-           seen_intersection[1] not in intersections_seen:
-            if bi.block.left_city != bi.block.right_city:
-                # If we have Locations representing cities,
-                # find one that contains this bi's center.
-                from ebpub.db.models import get_city_locations
-                overlapping_cities = get_city_locations().filter(location__contains=bi.location)
-                if overlapping_cities:
-                    city = overlapping_cities[0].name.upper()
-                else:
-                    city = metro['city_name'].upper()
+    for pretty_name, id in Intersection.objects.values_list('pretty_name', 'id'):
+        intersections_seen[pretty_name] = id
+        intersections_seen[Intersection(pretty_name=pretty_name).reverse_pretty_name()] = id
+
+    created = 0
+    for start, end in _block_id_chunks(chunk_size):
+        rows = _fetch_block_intersections(cursor, start, end, params)
+        # [(field values, BlockIntersection id)], and
+        # {pretty_name: [BlockIntersection id, ...]} for the new ones.
+        new_intersections, new_links = [], {}
+        links = []
+        for bi_id, block, iblock, location_city, location_zip in rows:
+            pretty_name = pretty_name_from_blocks(block, iblock)
+            reverse_name = pretty_name_from_blocks(iblock, block)
+            if pretty_name in new_links or reverse_name in new_links:
+                new_links.get(pretty_name, new_links.get(reverse_name)).append(bi_id)
+                continue
+            seen = intersections_seen.get(pretty_name, intersections_seen.get(reverse_name))
+            if seen is not None:
+                links.append((bi_id, seen))
+                continue
+            if block.left_city != block.right_city:
+                intersection_city = (location_city or metro['city_name']).upper()
             else:
-                city = bi.block.left_city
-            if bi.block.left_state != bi.block.right_state:
+                intersection_city = block.left_city
+            if block.left_state != block.right_state:
                 state = metro['state'].upper()
             else:
-                state = bi.block.left_state
-            if (bi.block.left_zip != bi.block.right_zip or \
-                bi.intersecting_block.left_zip != bi.intersecting_block.right_zip) or \
-               (bi.block.left_zip != bi.intersecting_block.left_zip):
-                zipcode_obj = lookup_zipcode(bi.location)
-                if zipcode_obj:
-                    zipcode = zipcode_obj.name
-                else:
-                    zipcode = bi.block.left_zip
-            else:
-                zipcode = bi.block.left_zip
-            intersection = intersection_from_blocks(bi.block, bi.intersecting_block, bi.location, city, state, zipcode)
-            intersection.save()
-            logger.debug("Created intersection %s" % intersection.pretty_name)
-            bi.intersection = intersection
-            bi.save()
-            intersections_seen[seen_intersection[0]] = intersection.id
-            intersections_seen[seen_intersection[1]] = intersection.id
-        else:
-            if not bi.intersection:
-                bi.intersection_id = intersections_seen[seen_intersection[0]]
-                bi.save()
-            logger.debug("Already seen intersection %s" % " / ".join(seen_intersection))
+                state = block.left_state
+            new_intersections.append(({
+                'pretty_name': pretty_name,
+                'slug': slug_from_blocks(block, iblock),
+                'predir_a': block.predir, 'prefix_a': block.prefix,
+                'street_a': block.street, 'suffix_a': block.suffix,
+                'postdir_a': block.postdir,
+                'predir_b': iblock.predir, 'prefix_b': iblock.prefix,
+                'street_b': iblock.street, 'suffix_b': iblock.suffix,
+                'postdir_b': iblock.postdir,
+                'city': intersection_city, 'state': state,
+                'zip': location_zip or block.left_zip,
+                }, bi_id))
+            new_links[pretty_name] = [bi_id]
+        if new_intersections:
+            ids = _insert_intersections(cursor, new_intersections)
+            for pretty_name, bi_ids in new_links.items():
+                id = ids[pretty_name]
+                intersections_seen[pretty_name] = id
+                intersections_seen[Intersection(pretty_name=pretty_name).reverse_pretty_name()] = id
+                links.extend([(bi_id, id) for bi_id in bi_ids])
+        if links:
+            _link_block_intersections(cursor, links)
+        created += len(new_intersections)
+        logger.info("Blocks %d to %d: %d intersections created so far" % (start, end - 1, created))
+
+    # The geocoder may have cached the old ones.
+    streets_changed()
     logger.info("Finished populating intersections")
     total = Intersection.objects.all().count()
     if not total:
@@ -292,6 +485,10 @@ def main(argv=None):
                                    description=__doc__)
     parser.add_option('-v', '--verbose', action='count', dest='verbosity',
                       default=0, help='verbosity, add more -v to be more verbose')
+    parser.add_option('-c', '--city', default=None,
+                      help='Only recalculate (block) intersections for blocks in this city')
+    parser.add_option('--chunk-size', type='int', default=CHUNK_SIZE,
+                      help='Number of blocks to process per query. Default %d.' % CHUNK_SIZE)
 
     opts, args = parser.parse_args(argv)
     if len(args) != 1 or args[0] not in valid_actions:
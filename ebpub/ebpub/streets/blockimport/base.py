@@ -18,6 +18,10 @@
 
 from django.contrib.gis.gdal import DataSource
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils.datastructures import SortedDict
+from ebpub.db.bin.update_aggregates import _copy_value
+from ebpub.streets.dataversion import changes_suspended, streets_changed
 from ebpub.streets.models import Block
 from ebpub.streets.name_utils import make_pretty_name
 from ebpub.streets.name_utils import make_pretty_prefix
@@ -26,32 +30,64 @@ from ebpub.utils.geodjango import geos_with_projection
 from ebpub.utils.text import slugify
 
 
+from cStringIO import StringIO
 import logging
+import time
 logger = logging.getLogger('ebpub.streets.blockimport')
 
+# The fields that identify a block, for finding existing ones.
+PRIMARY_FIELD_KEYS = ('street_slug',
+                      'from_num', 'to_num',
+                      'left_city', 'right_city',
+                      'left_zip', 'right_zip',
+                      'left_state', 'right_state',
+                      )
+
+LOOKUP_TABLE = 'block_import_lookup'
+STAGING_TABLE = 'block_import_staging'
+
 class BlockImporter(object):
     """
     Base class for importing blocks from shapefiles.
 
     Subclasses will implement the details for one particular data source.
+
+    If ``batch_size`` is given, save() imports that many features at
+    a time; see :py:meth:`save_batched`.
     """
     def __init__(self, shapefile, layer_id=0, verbose=False, encoding='utf8',
-                 reset=False,
+                 reset=False, batch_size=None,
                  ):
         self.layer = DataSource(shapefile)[layer_id]
         self.verbose = verbose
         self.encoding = encoding
         self.reset = reset
+        self.batch_size = batch_size
 
     def log(self, arg):
         "Deprecated: user logger instead"
         logger.debug(arg)
 
     def save(self):
+        """
+        Creates or updates a Block for each block in each feature of
+        the shapefile.  Returns a tuple of (number created, number of
+        existing blocks).
+
+        If the importer was created with a ``batch_size``, this
+        delegates to :py:meth:`save_batched`.
+        """
+        if self.batch_size:
+            num_created, num_updated, num_skipped = self.save_batched()
+            return num_created, num_updated
+        # Start a new version of the streets data once, not per block.
+        with changes_suspended():
+            return self._save_unbatched()
+
+    def _save_unbatched(self):
         if self.reset:
             logger.warn("Deleting all Block instances and anything that refers to them!")
             Block.objects.all().delete()
-        import time
         start = time.time()
         num_created = 0
         num_existing = 0
@@ -66,94 +102,10 @@ class BlockImporter(object):
                     # "N. Commercial Wharf" and "Commercial Wharf N.";
                     # in that case those would be yielded by gen_blocks() as
                     # two separate blocks. Is that intentional, or a bug?
-
-                    # Ensure we have unicode.
-                    for key, val in block_fields.items():
-                        if isinstance(val, str):
-                            block_fields[key] = val.decode(self.encoding)
-
-                    block_fields['geom'] = geos_with_projection(feature.geom, 4326)
-                    block_fields['prefix'] = make_pretty_prefix(block_fields['prefix'])
-
-                    block_fields['street_pretty_name'], block_fields['pretty_name'] = make_pretty_name(
-                        block_fields['left_from_num'],
-                        block_fields['left_to_num'],
-                        block_fields['right_from_num'],
-                        block_fields['right_to_num'],
-                        block_fields['predir'],
-                        block_fields['prefix'],
-                        block_fields['street'],
-                        block_fields['suffix'],
-                        block_fields['postdir']
-                    )
-
-                    block_fields['street_slug'] = slugify(
-                        u' '.join((block_fields['prefix'],
-                                   block_fields['street'],
-                                   block_fields['suffix'])))
-
-                    # Watch out for addresses like '247B' which can't be
-                    # saved as an IntegerField.
-                    # But do this *after* making pretty names.
-                    # Also attempt to fix up addresses like '19-47',
-                    # by just using the lower number.  This will give
-                    # misleading output, but it's probably better than
-                    # discarding blocks.
-                    for addr_key in ('left_from_num', 'left_to_num',
-                                     'right_from_num', 'right_to_num'):
-                        if isinstance(block_fields[addr_key], basestring):
-                            from ebpub.geocoder.parser.parsing import number_standardizer
-                            value = number_standardizer(block_fields[addr_key].strip())
-                            if not value:
-                                value = None
-                        else:
-                            try:
-                                value = str(int(value))
-                            except (ValueError, TypeError):
-                                value = None
-                        block_fields[addr_key] = value
-
-                    try:
-                        block_fields['from_num'], block_fields['to_num'] = \
-                            make_block_numbers(block_fields['left_from_num'],
-                                               block_fields['left_to_num'],
-                                               block_fields['right_from_num'],
-                                               block_fields['right_to_num'])
-                    except ValueError, e:
-                        logger.warn('Skipping %s: %s' % (block_fields['pretty_name'], e))
+                    block_fields = self._prepare_block_fields(feature, block_fields)
+                    if block_fields is None:
                         continue
-
-                    # After doing pretty names etc, standardize the fields
-                    # that get used for geocoding, since the geocoder
-                    # searches for the standardized version.
-                    from ebpub.geocoder.parser.parsing import STANDARDIZERS
-                    for key, standardizer in STANDARDIZERS.items():
-                        if key in block_fields:
-                            if key == 'street' and block_fields['prefix']:
-                                # Special case: "US Highway 101", not "US Highway 101st".
-                                continue
-
-                            block_fields[key] = standardizer(block_fields[key])
-
-                    # Separate out the uniquely identifying fields so
-                    # we can avoid duplicate blocks.
-                    # NOTE this doesn't work if you're updating from a more
-                    # recent shapefile and the street has significant
-                    # changes - eg. the street name has changed, or the
-                    # address range has changed, or the block has split...
-                    # see #257. http://developer.openblockproject.org/ticket/257
-                    primary_fields = {}
-                    primary_field_keys = ('street_slug',
-                                          'from_num', 'to_num',
-                                          'left_city', 'right_city',
-                                          'left_zip', 'right_zip',
-                                          'left_state', 'right_state',
-                                          )
-                    for key in primary_field_keys:
-                        if block_fields[key] != u'':
-                            # Some empty fields are fixed
-                            # automatically by clean().
-                            primary_fields[key] = block_fields[key]
+                    primary_fields = self._primary_fields(block_fields)
 
                     existing = list(Block.objects.filter(**primary_fields))
                     if not existing:
@@ -163,11 +115,8 @@ class BlockImporter(object):
                         # blocks data and need to overwrite blocks that have
                         # the old bad slug.  Sadly this probably can't just be
                         # fixed by a migration.
-                        _old_street_slug = slugify(
-                            u' '.join((block_fields['street'],
-                                       block_fields['suffix'])))
                         _old_primary_fields = primary_fields.copy()
-                        _old_primary_fields['street_slug'] = _old_street_slug
+                        _old_primary_fields['street_slug'] = self._old_street_slug(block_fields)
                         existing = list(Block.objects.filter(**_old_primary_fields))
                         if not existing:
                             block = Block(**block_fields)
@@ -185,17 +134,8 @@ class BlockImporter(object):
                         logger.warn("Multiple existing blocks like %s, skipping"
                                     % existing[0])
                         continue
-                    try:
-                        block.full_clean()
-                    except ValidationError:
-                        # odd bug: sometimes we get ValidationError even when
-                        # the data looks good, and then cleaning again works???
-                        try:
-                            block.full_clean()
-                        except ValidationError, e:
-                            logger.warn("validation error on %s, skipping" % str(block))
-                            logger.warn(e)
-                            continue
+                    if not self._clean_block(block):
+                        continue
                     block.save()
                     if parent_id is None:
                         parent_id = block.id
@@ -207,6 +147,307 @@ class BlockImporter(object):
                                                                time.time() - start))
         return num_created, num_existing
 
+    def save_batched(self):
+        """
+        Like save(), but imports ``batch_size`` features at a time,
+        with a handful of queries per batch instead of several per
+        block: the blocks are loaded into a temporary table with COPY,
+        matched up with existing blocks with one join, and then
+        updated and inserted in bulk.  Each batch is committed
+        separately.
+
+        The blocks are validated just as save() does.  Returns a tuple
+        of (number created, number updated, number skipped).
+        """
+        if self.reset:
+            logger.warn("Deleting all Block instances and anything that refers to them!")
+            Block.objects.all().delete()
+        start = time.time()
+        counts = [0, 0, 0]
+        batch = []
+        for feature in self.layer:
+            if self.skip_feature(feature):
+                continue
+            blocks = []
+            for block_fields in self.gen_blocks(feature):
+                block_fields = self._prepare_block_fields(feature, block_fields)
+                if block_fields is None:
+                    counts[2] += 1
+                else:
+                    blocks.append(block_fields)
+            if blocks:
+                batch.append(blocks)
+            if len(batch) >= self.batch_size:
+                self._save_batch(batch, counts)
+                batch = []
+                logger.info("%d blocks created, %d updated, %d skipped so far" % tuple(counts))
+        if batch:
+            self._save_batch(batch, counts)
+        # Block's post_save and post_delete signals would do this.
+        streets_changed()
+        logger.info("Created %d new blocks, updated %d, skipped %d in %.2f seconds"
+                    % tuple(counts + [time.time() - start]))
+        return tuple(counts)
+
+    @transaction.commit_on_success
+    def _save_batch(self, batch, counts):
+        """
+        Saves a list of features' lists of prepared block fields, and
+        adds the numbers (created, updated, skipped) to ``counts``.
+        """
+        cursor = connection.cursor()
+        all_fields = [block_fields for blocks in batch for block_fields in blocks]
+        matches = self._find_existing(cursor, all_fields)
+        # Enough new ids for every block that doesn't match an existing one.
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                       [Block._meta.db_table, len(all_fields) - len(matches)])
+        new_ids = iter([row[0] for row in cursor.fetchall()])
+
+        # Block id -> (Block, is new), in order.
+        to_save = SortedDict()
+        # Primary field values -> Block id, so that repeated blocks
+        # in this batch update the first one, as they would in save().
+        ids_by_key = {}
+        seq = 0
+        for blocks in batch:
+            parent_id = None
+            for block_fields in blocks:
+                found = matches.get(seq, {})
+                seq += 1
+                existing = found.get(True) or found.get(False) or []
+                if len(existing) > 1:
+                    counts[2] += 1
+                    logger.warn("Multiple existing blocks like %s, skipping"
+                                % block_fields['pretty_name'])
+                    continue
+                block = Block(**block_fields)
+                if not self._clean_block(block):
+                    counts[2] += 1
+                    continue
+                key = tuple([block_fields[k] for k in PRIMARY_FIELD_KEYS])
+                if existing:
+                    block.id, is_new = existing[0], False
+                elif key in ids_by_key:
+                    block.id = ids_by_key[key]
+                    is_new = to_save[block.id][1]
+                else:
+                    block.id, is_new = new_ids.next(), True
+                ids_by_key[key] = block.id
+                if parent_id is None:
+                    parent_id = block.id
+                else:
+                    block.parent_id = parent_id
+                to_save[block.id] = (block, is_new)
+
+        fields = Block._meta.fields
+        values = []
+        for block, is_new in to_save.values():
+            row = {}
+            for f in fields:
+                value = getattr(block, f.attname)
+                if f.attname == 'geom':
+                    value = value.hexewkb
+                row[f.column] = value
+            values.append(row)
+            if is_new:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+        columns = [f.column for f in fields]
+        _stage_blocks(cursor, STAGING_TABLE, columns, values)
+        other_columns = [c for c in columns if c not in ('id', 'parent_id')]
+        # Like save(), don't forget the parent of an existing block
+        # that's the first one in its feature.
+        cursor.execute("""
+            UPDATE %(table)s b SET %(set)s, parent_id = COALESCE(s.parent_id, b.parent_id)
+            FROM %(staging)s s WHERE b.id = s.id
+            """ % {'table': Block._meta.db_table, 'staging': STAGING_TABLE,
+                   'set': ', '.join(['%s = s.%s' % (c, c) for c in other_columns])})
+        cursor.execute("""
+            INSERT INTO %(table)s (%(columns)s)
+            SELECT %(columns)s FROM %(staging)s s
+            WHERE NOT EXISTS (SELECT 1 FROM %(table)s b WHERE b.id = s.id)
+            """ % {'table': Block._meta.db_table, 'staging': STAGING_TABLE,
+                   'columns': ', '.join(columns)})
+        cursor.execute("DROP TABLE %s" % STAGING_TABLE)
+
+    def _find_existing(self, cursor, all_fields):
+        """
+        Finds the existing blocks like each of a list of prepared
+        block fields, by the same rules as save().  Returns a
+        dictionary mapping list indexes to dictionaries of {True: ids
+        of blocks with the current street slug, False: ids of blocks
+        with the old street slug}.  Blocks with no match are left out.
+        """
+        columns = ['seq', 'shape', 'old_street_slug'] + list(PRIMARY_FIELD_KEYS)
+        # Which keys are empty (matching anything, as in
+        # _primary_fields()) or None (matching NULL) varies from
+        # block to block.  Rather than testing for that in the join,
+        # which would stop Postgres using a hash join or the indexes,
+        # the blocks are grouped by which keys are which, and each
+        # group is looked up with plain equalities.
+        shapes = {}
+        values = []
+        for seq, block_fields in enumerate(all_fields):
+            shape = tuple([block_fields[k] == u'' and 'any' or block_fields[k] is None and 'null' or 'eq'
+                           for k in PRIMARY_FIELD_KEYS])
+            row = dict([(k, block_fields[k]) for k in PRIMARY_FIELD_KEYS])
+            row['seq'] = seq
+            row['shape'] = shapes.setdefault(shape, len(shapes))
+            row['old_street_slug'] = self._old_street_slug(block_fields)
+            values.append(row)
+        _stage_blocks(cursor, LOOKUP_TABLE, columns, values,
+                      extra_columns={'seq': '0', 'shape': '0', 'old_street_slug': 'street_slug'})
+        rows = []
+        for shape, shape_id in shapes.items():
+            conditions = []
+            for key, kind in zip(PRIMARY_FIELD_KEYS[1:], shape[1:]):
+                if kind == 'eq':
+                    conditions.append('b.%s = s.%s' % (key, key))
+                elif kind == 'null':
+                    conditions.append('b.%s IS NULL' % key)
+            conditions.append('s.shape = %d' % shape_id)
+            select = """
+                SELECT s.seq, b.id, %s FROM %s s JOIN %s b
+                ON %s AND %s
+                """
+            if shape[0] == 'any':
+                cursor.execute(select % ('b.street_slug = s.street_slug', LOOKUP_TABLE,
+                                         Block._meta.db_table, 'TRUE', ' AND '.join(conditions)))
+            else:
+                # Either slug, as two joins rather than an OR.
+                cursor.execute(
+                    (select % ('TRUE', LOOKUP_TABLE, Block._meta.db_table,
+                               'b.street_slug = s.street_slug', ' AND '.join(conditions)))
+                    + ' UNION ALL ' +
+                    (select % ('FALSE', LOOKUP_TABLE, Block._meta.db_table,
+                               'b.street_slug = s.old_street_slug',
+                               ' AND '.join(conditions + ['s.old_street_slug <> s.street_slug']))))
+            rows.extend(cursor.fetchall())
+        cursor.execute("DROP TABLE %s" % LOOKUP_TABLE)
+        matches = {}
+        for seq, block_id, current_slug in rows:
+            matches.setdefault(seq, {}).setdefault(current_slug, []).append(block_id)
+        return matches
+
+    def _prepare_block_fields(self, feature, block_fields):
+        """
+        Fills in the derived fields (pretty names, slug, block
+        numbers, ...) of a dictionary yielded by gen_blocks(), and
+        standardizes the rest.  Returns None if the block should be
+        skipped.
+        """
+        # Ensure we have unicode.
+        for key, val in block_fields.items():
+            if isinstance(val, str):
+                block_fields[key] = val.decode(self.encoding)
+
+        block_fields['geom'] = geos_with_projection(feature.geom, 4326)
+        block_fields['prefix'] = make_pretty_prefix(block_fields['prefix'])
+
+        block_fields['street_pretty_name'], block_fields['pretty_name'] = make_pretty_name(
+            block_fields['left_from_num'],
+            block_fields['left_to_num'],
+            block_fields['right_from_num'],
+            block_fields['right_to_num'],
+            block_fields['predir'],
+            block_fields['prefix'],
+            block_fields['street'],
+            block_fields['suffix'],
+            block_fields['postdir']
+        )
+
+        block_fields['street_slug'] = slugify(
+            u' '.join((block_fields['prefix'],
+                       block_fields['street'],
+                       block_fields['suffix'])))
+
+        # Watch out for addresses like '247B' which can't be
+        # saved as an IntegerField.
+        # But do this *after* making pretty names.
+        # Also attempt to fix up addresses like '19-47',
+        # by just using the lower number.  This will give
+        # misleading output, but it's probably better than
+        # discarding blocks.
+        for addr_key in ('left_from_num', 'left_to_num',
+                         'right_from_num', 'right_to_num'):
+            if isinstance(block_fields[addr_key], basestring):
+                from ebpub.geocoder.parser.parsing import number_standardizer
+                value = number_standardizer(block_fields[addr_key].strip())
+                if not value:
+                    value = None
+            else:
+                try:
+                    value = str(int(value))
+                except (ValueError, TypeError):
+                    value = None
+            block_fields[addr_key] = value
+
+        try:
+            block_fields['from_num'], block_fields['to_num'] = \
+                make_block_numbers(block_fields['left_from_num'],
+                                   block_fields['left_to_num'],
+                                   block_fields['right_from_num'],
+                                   block_fields['right_to_num'])
+        except ValueError, e:
+            logger.warn('Skipping %s: %s' % (block_fields['pretty_name'], e))
+            return None
+
+        # After doing pretty names etc, standardize the fields
+        # that get used for geocoding, since the geocoder
+        # searches for the standardized version.
+        from ebpub.geocoder.parser.parsing import STANDARDIZERS
+        for key, standardizer in STANDARDIZERS.items():
+            if key in block_fields:
+                if key == 'street' and block_fields['prefix']:
+                    # Special case: "US Highway 101", not "US Highway 101st".
+                    continue
+
+                block_fields[key] = standardizer(block_fields[key])
+        return block_fields
+
+    def _primary_fields(self, block_fields):
+        # Separate out the uniquely identifying fields so
+        # we can avoid duplicate blocks.
+        # NOTE this doesn't work if you're updating from a more
+        # recent shapefile and the street has significant
+        # changes - eg. the street name has changed, or the
+        # address range has changed, or the block has split...
+        # see #257. http://developer.openblockproject.org/ticket/257
+        primary_fields = {}
+        for key in PRIMARY_FIELD_KEYS:
+            if block_fields[key] != u'':
+                # Some empty fields are fixed
+                # automatically by clean().
+                primary_fields[key] = block_fields[key]
+        return primary_fields
+
+    def _old_street_slug(self, block_fields):
+        """
+        The street slug we made prior to fixing issue #264, without
+        the prefix.
+        """
+        return slugify(u' '.join((block_fields['street'],
+                                  block_fields['suffix'])))
+
+    def _clean_block(self, block):
+        """
+        Validates the block.  Returns False, after logging why, if it
+        should be skipped.
+        """
+        try:
+            block.full_clean()
+        except ValidationError:
+            # odd bug: sometimes we get ValidationError even when
+            # the data looks good, and then cleaning again works???
+            try:
+                block.full_clean()
+            except ValidationError, e:
+                logger.warn("validation error on %s, skipping" % str(block))
+                logger.warn(e)
+                return False
+        return True
+
     def skip_feature(self, feature):
         """
         Subclasses can override this method to determine whether to
@@ -226,3 +467,21 @@ class BlockImporter(object):
         """
         raise NotImplementedError('subclass must implement this method')
 
+
+def _stage_blocks(cursor, table_name, columns, values, extra_columns={}):
+    # Loads values (a list of dictionaries) into a temporary table,
+    # with one COPY.  The columns are like the blocks table's, except
+    # for extra_columns, which maps names to SQL expressions.  The
+    # caller drops the table when it's done with it: we can't rely on
+    # each batch's transaction being committed, eg. in tests.
+    select = [c in extra_columns and '%s AS %s' % (extra_columns[c], c) or c
+              for c in columns]
+    cursor.execute("CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s LIMIT 0"
+                   % (table_name, ', '.join(select), Block._meta.db_table))
+    buf = StringIO()
+    for row in values:
+        buf.write('\t'.join([_copy_value(row[c]) for c in columns]))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_from(buf, table_name, columns=columns)
+    cursor.execute("ANALYZE %s" % table_name)
@@ -120,10 +120,11 @@ class TigerImporter(BlockImporter):
     def __init__(self, edges_shp, featnames_dbf, faces_dbf, place_shp,
                  filter_city=None, filter_bounds=None, filter_locations=(),
                  verbose=False, encoding='utf8', fix_cities=False,
-                 reset=False,
+                 reset=False, batch_size=None,
                  ):
         BlockImporter.__init__(self, shapefile=edges_shp, layer_id=0,
                                verbose=verbose, encoding=encoding, reset=reset,
+                               batch_size=batch_size,
                                )
         self.fix_cities = fix_cities
         self.featnames_db = self._clean_featnames(featnames_dbf)
@@ -358,6 +359,9 @@ def main(argv=None):
     parser.add_option('-e', '--encoding', dest='encoding',
                       help='Encoding to use when reading the shapefile',
                       default='utf8')
+    parser.add_option('-B', '--batch-size', type='int', default=None,
+                      help='Import this many features at a time, in bulk. '
+                      'Much faster for large imports. Default is one block at a time.')
     (options, args) = parser.parse_args(argv)
     if len(args) != 4:
         return parser.error('must provide 4 arguments, see usage')
@@ -391,12 +395,18 @@ def main(argv=None):
                            filter_bounds=filter_bounds,
                            encoding=options.encoding,
                            reset=options.reset,
-                           fix_cities=options.fix_cities)
+                           fix_cities=options.fix_cities,
+                           batch_size=options.batch_size)
     if options.verbose:
         import logging
         logger.setLevel(logging.DEBUG)
-    num_created, num_existing = tiger.save()
-    logger.info( "Created %d new blocks; kept %d old ones" % (num_created, num_existing))
+    if options.batch_size:
+        num_created, num_existing, num_skipped = tiger.save_batched()
+        logger.info("Created %d new blocks; updated %d old ones; skipped %d"
+                    % (num_created, num_existing, num_skipped))
+    else:
+        num_created, num_existing = tiger.save()
+        logger.info( "Created %d new blocks; kept %d old ones" % (num_created, num_existing))
     logger.debug("... from %d feature names" % len(tiger.featnames_db))
     logger.debug("feature tlids with blocks: %d" % len(tiger.tlids_with_blocks))
 
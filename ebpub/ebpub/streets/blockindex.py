@@ -0,0 +1,190 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+An in-memory index of the blocks table, for geocoding lots of
+addresses without a database query (or several) per address.
+
+It's loaded, all at once, the first time it's needed in each process,
+so it's only worth it for bulk geocoding; see the
+``use_block_index`` option of :py:class:`ebpub.geocoder.base.Geocoder`.
+It's reloaded when the streets data changes; see
+:py:mod:`ebpub.streets.dataversion`.
+"""
+
+from django.contrib.gis.geos import LineString
+from ebpub.streets.dataversion import get_version
+import bisect
+import logging
+import re
+import time
+
+logger = logging.getLogger('ebpub.streets.blockindex')
+
+_block_index = {'index': None, 'version': None}
+
+
+def get_block_index():
+    """
+    Returns the current process' :py:class:`BlockIndex`, loading it if
+    it's empty or out of date.
+    """
+    state = _block_index
+    version = get_version()
+    if version != state['version']:
+        state['index'] = None
+        state['version'] = version
+    if state['index'] is None:
+        state['index'] = BlockIndex()
+    return state['index']
+
+
+class BlockIndex(object):
+    """
+    A copy of all the Blocks, and all the StreetMisspellings, that can
+    answer the same questions as the geocoder asks of the database.
+
+    Each block is kept as a tuple of its field values, with the
+    geometry as a tuple of coordinates; Block instances are only
+    created for results.  Blocks are grouped by street, and sorted by
+    address range.
+
+    If ``streets`` is given, only the blocks on those streets, and the
+    misspellings of those streets, are loaded; that's enough to
+    geocode a known batch of addresses.
+    """
+
+    def __init__(self, streets=None):
+        # Deferred import to avoid circular imports.
+        from ebpub.streets.models import Block, StreetMisspelling
+        start = time.time()
+        self.model = Block
+        self.fields = [f.attname for f in Block._meta.fields]
+        self._geom = self.fields.index('geom')
+        self._pos = dict([(name, i) for (i, name) in enumerate(self.fields)])
+        # Extra, trailing members of each row.
+        self._rank = len(self.fields)  # Position in the default Block ordering.
+        self._srid = self._rank + 1
+
+        # {street: [row, ...]} in default Block ordering.
+        self.streets = {}
+        # {street: ([from_num, ...], [row, ...])}, sorted by from_num,
+        # without blocks that have no from_num.
+        self.ranges = {}
+        # Same order as the database would give us; the id breaks ties.
+        ordering = list(Block._meta.ordering) + ['id']
+        street_pos, from_pos = self._pos['street'], self._pos['from_num']
+        blocks = Block.objects.order_by(*ordering)
+        misspellings = StreetMisspelling.objects.all()
+        if streets is not None:
+            blocks = blocks.filter(street__in=list(streets))
+            misspellings = misspellings.filter(incorrect__in=list(streets))
+        count = 0
+        for rank, block in enumerate(blocks.iterator()):
+            row = [getattr(block, name) for name in self.fields]
+            row[self._geom] = block.geom.coords
+            row = tuple(row) + (rank, block.geom.srid)
+            self.streets.setdefault(row[street_pos], []).append(row)
+            count += 1
+        for street, rows in self.streets.items():
+            numbered = sorted([row for row in rows if row[from_pos] is not None],
+                              key=lambda row: row[from_pos])
+            self.ranges[street] = ([row[from_pos] for row in numbered], numbered)
+
+        self.misspellings = dict(misspellings.values_list('incorrect', 'correct'))
+        logger.info('Loaded block index of %d blocks on %d streets in %.2f seconds'
+                    % (count, len(self.streets), time.time() - start))
+
+    def _block(self, row):
+        # Makes a Block instance from an index row.
+        values = list(row[:self._rank])
+        values[self._geom] = LineString(values[self._geom], srid=row[self._srid])
+        block = self.model(*values)
+        block._state.adding = False
+        block._state.db = self.model.objects.db
+        return block
+
+    def _get(self, row, name):
+        return row[self._pos[name]]
+
+    def search(self, street, number=None, prefix=None, predir=None,
+               suffix=None, postdir=None, city=None, state=None, zipcode=None):
+        """
+        Like :py:meth:`BlockManager.search <ebpub.streets.models.BlockManager.search>`,
+        and gives the same results, but without querying the database.
+        """
+        from ebpub.streets.models import blocks_with_points
+        tests = []
+        for name, value in (('predir', predir), ('prefix', prefix),
+                            ('suffix', suffix), ('postdir', postdir)):
+            if value:
+                tests.append((self._pos[name], value.upper()))
+        sided_tests = []
+        for name, value in (('city', city and city.upper()), ('state', state and state.upper()),
+                            ('zip', zipcode)):
+            if value:
+                sided_tests.append((self._pos['left_' + name], self._pos['right_' + name], value))
+
+        def matches(row):
+            for pos, value in tests:
+                if row[pos] != value:
+                    return False
+            for left_pos, right_pos, value in sided_tests:
+                if row[left_pos] != value and row[right_pos] != value:
+                    return False
+            return True
+
+        street = street.upper()
+        if number:
+            number = int(re.sub(r'\D', '', number))
+            to_pos = self._pos['to_num']
+            from_nums, rows = self.ranges.get(street, ([], []))
+            # Only blocks starting at or below the number can contain it.
+            rows = rows[:bisect.bisect_right(from_nums, number)]
+            rows = [row for row in rows if row[to_pos] is not None and row[to_pos] >= number]
+        else:
+            rows = self.streets.get(street, [])
+        rows = sorted([row for row in rows if matches(row)], key=lambda row: row[self._rank])
+        return blocks_with_points([self._block(row) for row in rows], number)
+
+    def street_blocks(self, street, city=None):
+        """
+        Returns a list of the Blocks on the given street (and in the
+        given city, if any), ordered by predir, from_num and to_num.
+        """
+        rows = self.streets.get(street, [])
+        if city:
+            left_pos, right_pos = self._pos['left_city'], self._pos['right_city']
+            rows = [row for row in rows if city in (row[left_pos], row[right_pos])]
+
+        def sort_key(row):
+            # Like Postgres, put NULLs last.
+            key = []
+            for name in ('predir', 'from_num', 'to_num'):
+                value = self._get(row, name)
+                key.append((value is None, value))
+            key.append(row[self._rank])
+            return key
+        return [self._block(row) for row in sorted(rows, key=sort_key)]
+
+    def correct_spelling(self, street):
+        """
+        Returns the correct spelling of the given street name per
+        StreetMisspelling, or None if there's no such misspelling.
+        """
+        return self.misspellings.get(street)
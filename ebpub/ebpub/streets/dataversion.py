@@ -0,0 +1,119 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A version of the streets data -- the Block, Intersection and
+StreetMisspelling tables -- shared by all processes via the Django
+cache.
+
+Whatever is derived from that data and kept between requests (the
+:py:mod:`block index <ebpub.streets.blockindex>`, the
+:py:mod:`street name matcher <ebpub.streets.fuzzy>`, and
+:py:mod:`cached geocoder results <ebpub.geocoder.cache>`) remembers
+the version it was built from, and is discarded when that changes.
+
+Saving or deleting any of those models starts a new version, via the
+:py:func:`streets_changed` signal handler.  If you change the tables
+with SQL, call :py:func:`streets_changed` afterward.  For bulk
+changes via the ORM, use :py:func:`changes_suspended` so that a new
+version is only started once, at the end.
+"""
+
+from django.core.cache import cache
+import contextlib
+import datetime
+import itertools
+import os
+import time
+
+# How often (in seconds) each process checks whether another process
+# has started a new version.
+CHECK_INTERVAL = 10
+
+# The version before anybody has changed anything.
+INITIAL_VERSION = '0.0-0'
+
+_version_key = 'streets_data_version'
+_version_time = 60 * 60 * 24 * 365
+
+_state = {'version': None, 'checked': 0, 'suspended': 0, 'changed': False}
+
+_counter = itertools.count()
+
+
+def _new_version():
+    # Unique even if the clock hasn't moved on since the last one.
+    return '%f-%d-%d' % (time.time(), os.getpid(), _counter.next())
+
+
+def get_version():
+    """
+    Returns the current version, a string.
+    """
+    now = time.time()
+    state = _state
+    if state['version'] is None or now - state['checked'] >= CHECK_INTERVAL:
+        state['checked'] = now
+        version = cache.get(_version_key)
+        if version is None:
+            cache.add(_version_key, state['version'] or INITIAL_VERSION, _version_time)
+            version = cache.get(_version_key)
+        # If there's no shared cache, at least honor our own changes.
+        state['version'] = version or state['version'] or INITIAL_VERSION
+    return state['version']
+
+
+def version_datetime(version):
+    """
+    Returns when the version was started, as a datetime.
+    """
+    return datetime.datetime.fromtimestamp(float(version.split('-')[0]))
+
+
+def streets_changed(sender=None, **kwargs):
+    """
+    Starts a new version, in this process and (via the Django cache)
+    in all others.  Suitable as a signal handler.
+
+    While changes are suspended, this only notes that there was a
+    change.
+    """
+    if _state['suspended']:
+        _state['changed'] = True
+        return
+    version = _new_version()
+    cache.set(_version_key, version, _version_time)
+    _state.update({'version': version, 'checked': time.time()})
+
+
+@contextlib.contextmanager
+def changes_suspended():
+    """
+    Context manager for making many changes to the streets data:
+    :py:func:`streets_changed` is only called once, on the way out,
+    if anything changed.  Until then, this process keeps using what
+    it derived from the old data.
+    """
+    _state['suspended'] += 1
+    try:
+        yield
+    finally:
+        _state['suspended'] -= 1
+        if not _state['suspended'] and _state['changed']:
+            _state['changed'] = False
+            streets_changed()
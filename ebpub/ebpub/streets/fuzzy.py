@@ -0,0 +1,223 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Fuzzy matching of street names, for correcting typos that aren't in
+the :py:class:`StreetMisspelling <ebpub.streets.models.StreetMisspelling>`
+table.
+
+The distinct street names in the blocks table are kept in a BK-tree
+(a tree that can find all words within a given edit distance of a
+word without comparing it to every one), loaded the first time it's
+needed in each process, and reloaded when the streets data changes;
+see :py:mod:`ebpub.streets.dataversion`.
+
+See ``ebpub/streets/bin/benchmark_street_names.py`` for accuracy and
+speed measurements.
+"""
+
+from django.conf import settings
+from ebpub.streets.dataversion import get_version
+import logging
+import time
+
+logger = logging.getLogger('ebpub.streets.fuzzy')
+
+_matcher = {'matcher': None, 'version': None}
+
+
+def get_street_name_matcher():
+    """
+    Returns the current process' :py:class:`StreetNameMatcher`,
+    loading it if it's empty or out of date.
+    """
+    state = _matcher
+    version = get_version()
+    if version != state['version']:
+        state['matcher'] = None
+        state['version'] = version
+    if state['matcher'] is None:
+        state['matcher'] = StreetNameMatcher()
+    return state['matcher']
+
+
+def correct_street_name(street, max_distance=None):
+    """
+    Returns the one known street name closest to ``street`` (an
+    uppercase, normalized street name without suffix), or None if
+    ``street`` is already a known street, or there's no single closest
+    one within ``max_distance`` edits.
+
+    ``max_distance`` defaults to ``settings.EBPUB_GEOCODER_FUZZY_STREETS``;
+    if that's 0, this always returns None without loading anything.
+    """
+    if max_distance is None:
+        max_distance = getattr(settings, 'EBPUB_GEOCODER_FUZZY_STREETS', 2)
+    if not max_distance:
+        return None
+    return get_street_name_matcher().match(street, max_distance)
+
+
+def edit_distance(a, b):
+    """
+    Returns the Levenshtein distance between the strings ``a`` and
+    ``b``: the number of single-character insertions, deletions and
+    substitutions needed to turn one into the other.
+    """
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a):
+        current = [i + 1]
+        for j, char_b in enumerate(b):
+            current.append(min(previous[j + 1] + 1,
+                               current[j] + 1,
+                               previous[j] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree of words.  Each node's children are keyed
+    by their edit distance from it, so by the triangle inequality a
+    search only has to visit children whose key is within
+    ``max_distance`` of the query's distance from the node.
+    """
+
+    def __init__(self, words=()):
+        # Each node is [word, {distance: child node}].
+        self.root = None
+        self.size = 0
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, word):
+        if self.root is None:
+            self.root = [word, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [word, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        """
+        Returns a list of (distance, word) for all the words within
+        ``max_distance`` of ``word``.
+        """
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            distance = edit_distance(word, node_word)
+            if distance <= max_distance:
+                results.append((distance, node_word))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+class StreetNameMatcher(object):
+    """
+    Finds the closest known street names to a misspelled one.
+
+    ``names`` defaults to all the distinct streets in the blocks table.
+    """
+
+    def __init__(self, names=None):
+        start = time.time()
+        if names is None:
+            # Deferred import to avoid circular imports.
+            from ebpub.streets.models import Block
+            names = Block.objects.values_list('street', flat=True).distinct().iterator()
+        self.names = frozenset(names)
+        self.tree = BKTree(sorted(self.names))
+        logger.info('Loaded %d street names for fuzzy matching in %.2f seconds'
+                    % (len(self.names), time.time() - start))
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def allowed_distance(self, name, max_distance):
+        """
+        How many edits to allow when matching ``name``: none for very
+        short names, where one edit makes a different but equally
+        plausible name, and one for short names; otherwise up to
+        ``max_distance``.
+        """
+        if len(name) < 4:
+            return 0
+        if len(name) < 6:
+            return min(1, max_distance)
+        return max_distance
+
+    def search(self, name, max_distance):
+        """
+        Returns a list of (distance, street name) for all the known
+        streets within ``max_distance`` edits of ``name``, via the tree.
+        """
+        return self.tree.search(name, max_distance)
+
+    def scan(self, name, max_distance):
+        """
+        Same as :py:meth:`search`, but compares ``name`` to every known
+        street; only useful for testing and benchmarks.
+        """
+        results = []
+        for known in self.names:
+            distance = edit_distance(name, known)
+            if distance <= max_distance:
+                results.append((distance, known))
+        return results
+
+    def match(self, name, max_distance):
+        """
+        Returns the single known street name closest to ``name``, or
+        None if ``name`` is itself known, or if no street is close
+        enough, or if several are equally close.
+        """
+        if not name or name in self.names:
+            return None
+        allowed = self.allowed_distance(name, max_distance)
+        if not allowed:
+            return None
+        matches = sorted(self.search(name, allowed))
+        if not matches:
+            return None
+        if len(matches) > 1 and matches[1][0] == matches[0][0]:
+            logger.debug('%r is equally close to %r and %r; not guessing'
+                         % (name, matches[0][1], matches[1][1]))
+            return None
+        return matches[0][1]
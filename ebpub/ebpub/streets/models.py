@@ -81,6 +81,8 @@ from django.contrib.gis.geos import Point
 from django.core import urlresolvers
 from django.db.models import Q
 from ebpub.geocoder.parser.parsing import normalize
+from ebpub.streets.blockindex import get_block_index
+from ebpub.streets.dataversion import streets_changed
 from ebpub.metros.allmetros import get_metro
 import logging
 import operator
@@ -138,9 +140,37 @@ def proper_city(block):
         block_city = _first_not_false(block.left_city, block.right_city, u'')
     return block_city
 
+def blocks_with_points(blocks, number):
+    """
+    Given a list of Blocks and an address number (or None), returns a
+    list of 2-tuples, (block, geocoded_pt), for the blocks that
+    contain that number, with the number's interpolated location.
+    If number is None, returns all the blocks, with geocoded_pt None.
+    """
+    if not number:
+        return [(b, None) for b in blocks]
+    block_tuples = []
+    for block in blocks:
+        contains, from_num, to_num = block.contains_number(number)
+        if contains:
+            block_tuples.append((block, from_num, to_num))
+    blocks = []
+    if block_tuples:
+        from ebpub.utils.geodjango import interpolate
+        for block, from_num, to_num in block_tuples:
+            try:
+                fraction = (float(number) - from_num) / (to_num - from_num)
+            except ZeroDivisionError:
+                fraction = 0.5
+            point = interpolate(block.geom, fraction, True)
+            blocks.append((block, Point(*list(point.coords))))
+    return blocks
+
+
 class BlockManager(models.GeoManager):
     def search(self, street, number=None, prefix=None, predir=None,
-               suffix=None, postdir=None, city=None, state=None, zipcode=None):
+               suffix=None, postdir=None, city=None, state=None, zipcode=None,
+               use_index=False):
         """
         Searches the blocks for the given address bits. Returns a list
         of 2-tuples, (block, geocoded_pt).
@@ -154,7 +184,15 @@ class BlockManager(models.GeoManager):
 
         Note we don't enforce parity (even/odd) matching.
         So 3181 would match the block 3180-3188.
+
+        If use_index is True, searches the in-memory
+        :py:mod:`ebpub.streets.blockindex` instead of the database,
+        with the same results.
         """
+        if use_index:
+            return get_block_index().search(
+                street, number=number, prefix=prefix, predir=predir, suffix=suffix,
+                postdir=postdir, city=city, state=state, zipcode=zipcode)
         filters = {'street': street.upper()}
         sided_filters = []
         if predir:
@@ -181,24 +219,8 @@ class BlockManager(models.GeoManager):
         # Block table.
         if number:
             number = int(re.sub(r'\D', '', number))
-            block_tuples = []
-            for block in qs.filter(from_num__lte=number, to_num__gte=number):
-                contains, from_num, to_num = block.contains_number(number)
-                if contains:
-                    block_tuples.append((block, from_num, to_num))
-            blocks = []
-            if block_tuples:
-                from ebpub.utils.geodjango import interpolate
-                for block, from_num, to_num in block_tuples:
-                    try:
-                        fraction = (float(number) - from_num) / (to_num - from_num)
-                    except ZeroDivisionError:
-                        fraction = 0.5
-                    point = interpolate(block.geom, fraction, True)
-                    blocks.append((block, Point(*list(point.coords))))
-        else:
-            blocks = list([(b, None) for b in qs])
-        return blocks
+            qs = qs.filter(from_num__lte=number, to_num__gte=number)
+        return blocks_with_points(list(qs), number)
 
 
 class Block(models.Model):
@@ -844,3 +866,10 @@ class Suburb(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+# Keep the block index, street name matcher and geocoder cache up to date.
+from django.db.models.signals import post_save, post_delete
+for _model in (Block, Intersection, StreetMisspelling):
+    post_save.connect(streets_changed, sender=_model)
+    post_delete.connect(streets_changed, sender=_model)
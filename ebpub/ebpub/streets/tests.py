@@ -709,3 +709,284 @@ class TestBlocks(TestCase):
                                   right_from_num=217, right_to_num=299,
                                   )
         self.assertEqual(block.url(), '/streets/wabash-ave/216-299n-s/')
+
+
+class TestStreetNameMatcher(TestCase):
+
+    fixtures = ['wabash.yaml']
+
+    names = ['WABASH', 'JACKSON', 'MICHIGAN', 'WASHINGTON', 'CLARK',
+             'CLARE', 'OAK', 'ELM', 'STATE']
+
+    def test_edit_distance(self):
+        from ebpub.streets.fuzzy import edit_distance
+        self.assertEqual(edit_distance('WABASH', 'WABASH'), 0)
+        self.assertEqual(edit_distance('WABASH', 'WABSH'), 1)
+        self.assertEqual(edit_distance('WABASH', 'WABASHE'), 1)
+        self.assertEqual(edit_distance('WABASH', 'WEBASH'), 1)
+        self.assertEqual(edit_distance('WABASH', 'WBAASH'), 2)
+        self.assertEqual(edit_distance('', 'OAK'), 3)
+
+    def test_match(self):
+        from ebpub.streets.fuzzy import StreetNameMatcher
+        matcher = StreetNameMatcher(self.names)
+        self.assertEqual(matcher.match('WABSH', 2), 'WABASH')
+        self.assertEqual(matcher.match('WBAASH', 2), 'WABASH')
+        self.assertEqual(matcher.match('JAKSON', 2), 'JACKSON')
+        self.assertEqual(matcher.match('WASHINGTN', 2), 'WASHINGTON')
+        # Known names aren't corrected.
+        self.assertEqual(matcher.match('WABASH', 2), None)
+        # Too far from anything.
+        self.assertEqual(matcher.match('HALSTED', 2), None)
+        # Short names get fewer edits, or none.
+        self.assertEqual(matcher.match('MICHGN', 2), 'MICHIGAN')
+        self.assertEqual(matcher.match('STAT', 2), 'STATE')
+        self.assertEqual(matcher.match('SAT', 2), None)
+        self.assertEqual(matcher.match('OAL', 2), None)
+        # Equally close to two names; don't guess.
+        self.assertEqual(matcher.match('CLARS', 2), None)
+
+    def test_search_matches_scan(self):
+        from ebpub.streets.fuzzy import StreetNameMatcher
+        matcher = StreetNameMatcher(self.names)
+        for name in ['WABSH', 'CLAR', 'X', 'WASHINGTON', 'ELMO', '']:
+            for distance in range(4):
+                self.assertEqual(sorted(matcher.search(name, distance)),
+                                 sorted(matcher.scan(name, distance)))
+
+    def test_matcher_cleared_on_save(self):
+        from ebpub.streets.fuzzy import get_street_name_matcher
+        matcher = get_street_name_matcher()
+        self.assert_('WABASH' in matcher)
+        self.assertTrue(get_street_name_matcher() is matcher)
+        block = Block.objects.get(pk=1000)
+        block.street = 'WABASHX'
+        block.save()
+        self.assertFalse(get_street_name_matcher() is matcher)
+        self.assert_('WABASHX' in get_street_name_matcher())
+
+
+class TestDataVersion(TestCase):
+
+    fixtures = ['wabash.yaml']
+
+    def test_new_version_on_save(self):
+        from ebpub.streets.dataversion import get_version
+        from ebpub.streets.models import StreetMisspelling
+        version = get_version()
+        Block.objects.get(pk=1000).save()
+        self.assertNotEqual(get_version(), version)
+        version = get_version()
+        StreetMisspelling.objects.create(incorrect='WABSH', correct='WABASH')
+        self.assertNotEqual(get_version(), version)
+
+    def test_changes_suspended(self):
+        from ebpub.streets import dataversion
+        version = dataversion.get_version()
+        with mock.patch('ebpub.streets.dataversion.cache') as mock_cache:
+            with dataversion.changes_suspended():
+                for block in Block.objects.all():
+                    block.save()
+                self.assertEqual(dataversion.get_version(), version)
+            self.assertEqual(mock_cache.set.call_count, 1)
+        self.assertNotEqual(dataversion.get_version(), version)
+
+
+class TestPopulateStreets(TestCase):
+
+    fixtures = ['wabash.yaml']
+
+    def test_populate_streets(self):
+        from ebpub.streets.bin.populate_streets import populate_streets
+        from ebpub.streets.models import Street
+        self.assertEqual(populate_streets(), 1)
+        street = Street.objects.get(street_slug='wabash-ave')
+        self.assertEqual((street.pretty_name, street.street, street.suffix,
+                          street.city, street.state),
+                         (u'Wabash Ave.', u'WABASH', u'AVE', u'CHICAGO', u'IL'))
+
+    def test_populate_streets__updates_in_place(self):
+        from ebpub.streets.bin.populate_streets import populate_streets
+        from ebpub.streets.models import Street
+        populate_streets()
+        old_id = Street.objects.get(street_slug='wabash-ave').id
+        Street.objects.create(street_slug='gone-st', pretty_name='Gone St.',
+                              suffix='ST', city='CHICAGO', state='IL')
+        Block.objects.filter(pk=1002).update(left_city='EVANSTON')
+        self.assertEqual(populate_streets(), 2)
+        self.assertEqual(Street.objects.get(street_slug='wabash-ave', city='CHICAGO').id,
+                         old_id)
+        self.assertEqual(Street.objects.filter(street_slug='wabash-ave', city='EVANSTON').count(), 1)
+        self.assertEqual(Street.objects.filter(street_slug='gone-st').count(), 0)
+
+
+class TestPopulateIntersections(TestCase):
+
+    fixtures = ['wabash.yaml']
+
+    def setUp(self):
+        from ebpub.db.models import Location, LocationType
+        # E. and W. Jackson Blvd. both meet the south end of block
+        # 1000, S. Wabash Ave.; only the east one is in another ZIP.
+        self.east = self._make_block('E', '-87.626095 41.878174, -87.624 41.878174', '60604')
+        self.west = self._make_block('W', '-87.628 41.878174, -87.626095 41.878174', '60605')
+        zip_type = LocationType.objects.create(
+            name='ZIP Code', plural_name='ZIP Codes', slug='zipcodes',
+            is_browsable=False, is_significant=False)
+        Location.objects.create(
+            location_type=zip_type, display_order=1, slug='60604', name='60604',
+            normalized_name='60604', city='CHICAGO', source='test', is_public=True,
+            location=geos.fromstr('POLYGON((-87.627 41.877, -87.625 41.877, -87.625 41.879, '
+                                  '-87.627 41.879, -87.627 41.877))', srid=4326))
+        self.patcher = mock.patch('ebpub.streets.bin.populate_streets.get_metro')
+        mock_get_metro = self.patcher.start()
+        mock_get_metro.return_value = {'city_name': 'CHICAGO', 'state': 'IL',
+                                       'multiple_cities': False}
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _make_block(self, predir, coords, zipcode):
+        return Block.objects.create(
+            pretty_name=u'1-99 %s. Jackson Blvd.' % predir, predir=predir,
+            street='JACKSON', street_slug='jackson-blvd',
+            street_pretty_name='Jackson Blvd.', suffix='BLVD',
+            from_num=1, to_num=99, left_zip=zipcode, right_zip=zipcode,
+            left_city='CHICAGO', right_city='CHICAGO', left_state='IL', right_state='IL',
+            geom=geos.fromstr('LINESTRING(%s)' % coords, srid=4326))
+
+    def test_populate_block_intersections(self):
+        from ebpub.streets.bin.populate_streets import populate_block_intersections
+        from ebpub.streets.models import BlockIntersection
+        # Small chunks, so the pairs are found across several queries.
+        self.assertEqual(populate_block_intersections(chunk_size=1), 4)
+        pairs = sorted(BlockIntersection.objects.values_list('block_id', 'intersecting_block_id'))
+        # Both ways round; blocks on the same street don't count.
+        self.assertEqual(pairs, sorted([(1000, self.east.id), (self.east.id, 1000),
+                                        (1000, self.west.id), (self.west.id, 1000)]))
+        for bi in BlockIntersection.objects.all():
+            self.assertAlmostEqual(bi.location.x, -87.626095)
+            self.assertAlmostEqual(bi.location.y, 41.878174)
+
+    def test_populate_intersections(self):
+        from ebpub.streets.bin.populate_streets import populate_block_intersections
+        from ebpub.streets.bin.populate_streets import populate_intersections
+        from ebpub.streets.models import BlockIntersection, Intersection
+        populate_block_intersections()
+        # The fixture's intersection is replaced.
+        self.assertEqual(populate_intersections(chunk_size=1), 2)
+        east = Intersection.objects.get(pretty_name=u'S. Wabash Ave. & E. Jackson Blvd.')
+        west = Intersection.objects.get(pretty_name=u'S. Wabash Ave. & W. Jackson Blvd.')
+        self.assertEqual(east.slug, u's-wabash-ave-and-e-jackson-blvd')
+        self.assertEqual((east.street_a, east.predir_b, east.street_b, east.suffix_b),
+                         (u'WABASH', u'E', u'JACKSON', u'BLVD'))
+        self.assertEqual((east.city, east.state), (u'CHICAGO', u'IL'))
+        # Both orderings of each pair share one Intersection.
+        self.assertEqual(BlockIntersection.objects.filter(intersection=east).count(), 2)
+        self.assertEqual(BlockIntersection.objects.filter(intersection=west).count(), 2)
+        # The blocks disagree about the ZIP Code of the east one, so
+        # it's looked up; the west one's blocks agree.
+        self.assertEqual(east.zip, u'60604')
+        self.assertEqual(west.zip, u'60605')
+
+    def test_populate_intersections__city(self):
+        from ebpub.streets.bin.populate_streets import populate_block_intersections
+        from ebpub.streets.bin.populate_streets import populate_intersections
+        from ebpub.streets.models import BlockIntersection, Intersection
+        populate_block_intersections()
+        populate_intersections()
+        intersection_ids = sorted(Intersection.objects.values_list('id', flat=True))
+        east_bi_ids = sorted(BlockIntersection.objects.filter(
+                intersection__pretty_name__contains='E. Jackson').values_list('id', flat=True))
+        Block.objects.filter(pk=self.west.id).update(left_city='EVANSTON', right_city='EVANSTON')
+        # Only the pairs involving the Evanston block are replaced.
+        self.assertEqual(populate_block_intersections(city='evanston'), 2)
+        self.assertEqual(BlockIntersection.objects.count(), 4)
+        self.assertEqual(sorted(BlockIntersection.objects.filter(
+                    intersection__pretty_name__contains='E. Jackson').values_list('id', flat=True)),
+                         east_bi_ids)
+        # The new ones are linked to the existing Intersection, which
+        # is in Chicago, either way round.
+        self.assertEqual(populate_intersections(city='evanston'), 2)
+        self.assertEqual(sorted(Intersection.objects.values_list('id', flat=True)),
+                         intersection_ids)
+        self.assertEqual(BlockIntersection.objects.filter(intersection=None).count(), 0)
+
+
+class TestBatchedBlockImport(TestCase):
+
+    def _make_importer(self, features):
+        from ebpub.streets.blockimport.base import BlockImporter
+
+        class StubImporter(BlockImporter):
+            def __init__(self, features, **kwargs):
+                self.layer = [mock.Mock(fid=i, geom=geos.fromstr(f['wkt'], srid=4326), fields=f)
+                              for i, f in enumerate(features)]
+                self.encoding = 'utf8'
+                self.reset = False
+                self.batch_size = kwargs.get('batch_size')
+
+            def skip_feature(self, feature):
+                return False
+
+            def gen_blocks(self, feature):
+                for street in feature.fields['streets']:
+                    block_fields = dict(predir='N', prefix='', street=street, suffix='AVE',
+                                        postdir='', left_from_num=feature.fields['from_num'],
+                                        left_to_num=feature.fields['to_num'],
+                                        right_from_num=None, right_to_num=None,
+                                        left_zip='60611', right_zip='60611',
+                                        left_city='CHICAGO', right_city='CHICAGO',
+                                        left_state='IL', right_state='IL')
+                    block_fields.update(feature.fields.get('overrides', {}))
+                    yield block_fields
+
+        return StubImporter(features, batch_size=2)
+
+    features = [
+        {'wkt': 'LINESTRING(-87.62 41.88, -87.62 41.89)', 'from_num': '100',
+         'to_num': '198', 'streets': ['WABASH']},
+        {'wkt': 'LINESTRING(-87.62 41.89, -87.62 41.90)', 'from_num': '200',
+         'to_num': '298', 'streets': ['WABASH', 'MICHIGAN']},
+        # Bad address numbers.
+        {'wkt': 'LINESTRING(-87.62 41.90, -87.62 41.91)', 'from_num': 'x',
+         'to_num': 'y', 'streets': ['WABASH']},
+        ]
+
+    def test_save_batched(self):
+        from ebpub.geocoder.cache import get_generation
+        generation = get_generation()
+        importer = self._make_importer(self.features)
+        self.assertEqual(importer.save_batched(), (3, 0, 1))
+        # Cached geocoder results are out of date.
+        self.assertNotEqual(get_generation(), generation)
+        self.assertEqual(Block.objects.count(), 3)
+        wabash = Block.objects.get(street='WABASH', from_num=200)
+        michigan = Block.objects.get(street='MICHIGAN')
+        self.assertEqual(wabash.pretty_name, u'200-298 N. Wabash Ave.')
+        self.assertEqual(wabash.parent_id, None)
+        self.assertEqual(michigan.parent_id, wabash.id)
+
+    def test_save_batched__updates_existing(self):
+        self._make_importer(self.features).save_batched()
+        ids = sorted(Block.objects.values_list('id', flat=True))
+        features = [dict(f) for f in self.features]
+        features[0]['wkt'] = 'LINESTRING(-87.63 41.88, -87.63 41.89)'
+        self.assertEqual(self._make_importer(features).save(), (0, 3))
+        self.assertEqual(sorted(Block.objects.values_list('id', flat=True)), ids)
+        block = Block.objects.get(street='WABASH', from_num=100)
+        self.assertAlmostEqual(block.geom.coords[0][0], -87.63)
+
+    def test_save_batched__empty_and_null_keys(self):
+        # As in save(), None only matches NULL, and an empty value
+        # matches anything.
+        features = [dict(f, overrides={'left_zip': None}) for f in self.features]
+        self.assertEqual(self._make_importer(features).save_batched(), (3, 0, 1))
+        ids = sorted(Block.objects.values_list('id', flat=True))
+        self.assertEqual(self._make_importer(features).save_batched(), (0, 3, 1))
+        features = [dict(f, overrides={'left_zip': None, 'right_city': ''}) for f in self.features]
+        self.assertEqual(self._make_importer(features).save_batched(), (0, 3, 1))
+        self.assertEqual(sorted(Block.objects.values_list('id', flat=True)), ids)
+        self.assertEqual(Block.objects.filter(right_city='').count(), 3)
+        # But a zip doesn't match NULL.
+        self.assertEqual(self._make_importer(self.features).save_batched(), (3, 0, 1))
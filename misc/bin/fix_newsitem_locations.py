@@ -40,7 +40,8 @@ def fix_newsitem_loc_name(item, dry_run=True):
     from ebpub.geocoder import reverse
     fixed = False
     try:
-        block, distance = reverse.reverse_geocode(item.location)
+        block, distance = reverse.reverse_geocode(
+            item.location, max_distance=reverse.NEARBY_DISTANCE)
         print " Reverse-geocoded point to %r" % block.pretty_name
         item.location_name = block.pretty_name
         fixed = True
@@ -202,19 +202,21 @@ def import_blocks_from_shapefiles(edges, featnames, faces, place, city=None,
         shutil.rmtree(outdir)
 
     if regenerate_intersections:
-        populate_streets_task()
+        populate_streets_task(city=city)
     return num_created
 
 @background
-def populate_streets_task():
+def populate_streets_task(city=None):
     populate_streets.populate_streets()
-    populate_block_intersections()
+    populate_block_intersections(city=city)
 
 @background
-def populate_block_intersections():
-    populate_streets.populate_block_intersections()
-    populate_intersections()
+def populate_block_intersections(city=None):
+    # If city is given, only that city's (block) intersections are
+    # recalculated.
+    populate_streets.populate_block_intersections(city=city)
+    populate_intersections(city=city)
 
 @background
-def populate_intersections():
-    populate_streets.populate_intersections()
+def populate_intersections(city=None):
+    populate_streets.populate_intersections(city=city)